@@ -44,8 +44,12 @@ def main(cfgs: list[config.Train]):
 
     os.makedirs(cfg.ckpt_path, exist_ok=True)
 
-    train_dataloader = get_dataloader(cfg, is_train=True)
-    val_dataloader = get_dataloader(cfg, is_train=False)
+    # Dataloader workers stop at uint8 images; we normalize batches on the device.
+    img_transform, img_normalize = saev.activations.split_img_transform(
+        saev.activations.make_img_transform("clip", model_ckpt)
+    )
+    train_dataloader = get_dataloader(cfg, img_transform, is_train=True)
+    val_dataloader = get_dataloader(cfg, img_transform, is_train=False)
 
     assert len(train_dataloader.dataset.classes) == len(val_dataloader.dataset.classes)
     n_classes = len(train_dataloader.dataset.classes)
@@ -63,7 +67,7 @@ def main(cfgs: list[config.Train]):
     for epoch in range(cfg.n_epochs):
         models.train()
         for batch in train_dataloader:
-            imgs_BWHC = batch["image"].to(cfg.device)
+            imgs_BWHC = img_normalize(batch["image"].to(cfg.device))
             with torch.no_grad():
                 vit_acts = vit(imgs_BWHC)
                 acts_BD = vit_acts["cls"]
@@ -87,7 +91,7 @@ def main(cfgs: list[config.Train]):
         with torch.inference_mode():
             pred_tgt_list, true_tgt_list = [], []
             for batch in val_dataloader:
-                imgs_BWHC = batch["image"].to(cfg.device)
+                imgs_BWHC = img_normalize(batch["image"].to(cfg.device))
                 with torch.no_grad():
                     vit_acts = vit(imgs_BWHC)
                     acts_BD = vit_acts["cls"]
@@ -179,8 +183,7 @@ def load_model(fpath: str, *, device: str = "cpu") -> torch.nn.Module:
 @jaxtyped(typechecker=beartype.beartype)
 def load_acts(cfg: saev.config.DataLoad) -> Float[Tensor, "n d_vit"]:
     dataset = saev.activations.Dataset(cfg)
-    acts = torch.stack([dataset[i]["act"] for i in range(len(dataset))])
-    return acts
+    return dataset.read_all()["act"]
 
 
 @jaxtyped(typechecker=beartype.beartype)
@@ -278,9 +281,7 @@ def make_models(
     return torch.nn.ModuleList(models), param_groups
 
 
-def get_dataloader(cfg: config.Train, *, is_train: bool):
-    img_transform = saev.activations.make_img_transform("clip", model_ckpt)
-
+def get_dataloader(cfg: config.Train, img_transform, *, is_train: bool):
     if is_train:
         shuffle = True
 
@@ -43,6 +43,7 @@ def score(cfg: typing.Annotated[config.Score, tyro.conf.arg(name="")]):
         shuffle=False,
         num_workers=cfg.n_workers,
         drop_last=False,
+        collate_fn=saev.activations.collate,
     )
     logger.info("Loaded data.")
 
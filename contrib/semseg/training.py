@@ -47,6 +47,7 @@ def main(cfgs: list[config.Train]):
 
     vit = DinoV2()
     vit = vit.to(cfg.device)
+    img_normalize = train_dataloader.dataset.img_normalize
     models, params = make_models(cfgs, vit.d_resid)
     models = models.to(cfg.device)
 
@@ -59,7 +60,7 @@ def main(cfgs: list[config.Train]):
     for epoch in range(cfg.n_epochs):
         models.train()
         for batch in train_dataloader:
-            imgs_BWHC = batch["image"].to(cfg.device)
+            imgs_BWHC = img_normalize(batch["image"].to(cfg.device))
             with torch.inference_mode():
                 vit_acts = vit(imgs_BWHC)
                 acts_BWHD = einops.rearrange(
@@ -99,7 +100,7 @@ def main(cfgs: list[config.Train]):
             with torch.inference_mode():
                 pred_label_list, true_label_list = [], []
                 for batch in val_dataloader:
-                    imgs_BWHC = batch["image"].to(cfg.device)
+                    imgs_BWHC = img_normalize(batch["image"].to(cfg.device))
                     with torch.inference_mode():
                         vit_acts = vit(imgs_BWHC)
                         acts_BWHD = einops.rearrange(
@@ -316,10 +317,10 @@ class DinoV2(torch.nn.Module):
 def get_dataloader(cfg: config.Train, *, is_train: bool):
     if is_train:
         shuffle = True
-        dataset = Dataset(dataclasses.replace(cfg.imgs, split="training"))
+        dataset = Dataset(dataclasses.replace(cfg.imgs, split="training"), uint8=True)
     else:
         shuffle = False
-        dataset = Dataset(dataclasses.replace(cfg.imgs, split="validation"))
+        dataset = Dataset(dataclasses.replace(cfg.imgs, split="validation"), uint8=True)
 
     return torch.utils.data.DataLoader(
         dataset,
@@ -332,7 +333,10 @@ def get_dataloader(cfg: config.Train, *, is_train: bool):
 
 @beartype.beartype
 class Dataset(torch.utils.data.Dataset):
-    def __init__(self, imgs_cfg: saev.config.Ade20kDataset):
+    def __init__(self, imgs_cfg: saev.config.Ade20kDataset, *, uint8: bool = False):
+        """
+        With `uint8`, images are uint8 and you normalize batches of them with `self.img_normalize`, which is cheaper than normalizing in dataloader workers.
+        """
         img_transform = v2.Compose([
             v2.Resize(size=(256, 256)),
             v2.CenterCrop(size=(224, 224)),
@@ -340,6 +344,11 @@ class Dataset(torch.utils.data.Dataset):
             v2.ToDtype(torch.float32, scale=True),
             v2.Normalize(mean=[0.4850, 0.4560, 0.4060], std=[0.2290, 0.2240, 0.2250]),
         ])
+        img_transform, self.img_normalize = saev.activations.split_img_transform(
+            img_transform
+        )
+        if not uint8:
+            img_transform = v2.Compose([img_transform, self.img_normalize])
         seg_transform = v2.Compose([
             v2.Resize(size=(256, 256), interpolation=v2.InterpolationMode.NEAREST),
             v2.CenterCrop((224, 224)),
@@ -29,7 +29,7 @@ def main(cfg: config.Validation):
         torch.backends.cuda.matmul.allow_tf32 = True
         torch.backends.cudnn.benchmark = True
         torch.backends.cudnn.deterministic = False
-    dataset = training.Dataset(cfg.imgs)
+    dataset = training.Dataset(cfg.imgs, uint8=True)
     dataloader = torch.utils.data.DataLoader(
         dataset,
         batch_size=cfg.batch_size,
@@ -44,7 +44,7 @@ def main(cfg: config.Validation):
     vit = vit.to(cfg.device)
     pred_label_list, true_label_list = [], []
     for batch in saev.helpers.progress(dataloader, every=1):
-        imgs_BWHC = batch["image"].to(cfg.device)
+        imgs_BWHC = dataset.img_normalize(batch["image"].to(cfg.device))
         with torch.inference_mode():
             vit_acts = vit(imgs_BWHC)
             acts_BWHD = einops.rearrange(
@@ -14,16 +14,77 @@ logger = logging.getLogger("saev")
 
 
 @beartype.beartype
-def activations(cfg: typing.Annotated[config.Activations, tyro.conf.arg(name="")]):
+def activations(
+    cfg: typing.Annotated[config.Activations, tyro.conf.arg(name="")],
+    models: str | None = None,
+):
     """
-    Save ViT activations for use later on.
+    Save ViT activations for use later on, optionally for several models in a single pass over the images.
 
     Args:
         cfg: Configuration for activations.
+        models: Path to a .toml file with a `[[models]]` table for each model to dump, which sets any of `model_family`, `model_ckpt`, `layers`, `d_vit`, `n_patches_per_img` and `cls_token`; the rest of `cfg` applies to every model.
+    """
+    import saev.activations
+
+    if models is not None:
+        with open(models, "rb") as fd:
+            cfgs = config.expand_models(cfg, tomllib.load(fd)["models"])
+        saev.activations.main(cfgs)
+    else:
+        saev.activations.main(cfg)
+
+
+@beartype.beartype
+def shuffle(cfg: typing.Annotated[config.Shuffle, tyro.conf.arg(name="")]):
+    """
+    Write a globally shuffled copy of one layer's patch activations, so that training can read them sequentially.
+
+    Args:
+        cfg: Configuration for shuffling.
+    """
+    import saev.activations
+
+    saev.activations.shuffle(cfg)
+
+
+@beartype.beartype
+def relayout(cfg: typing.Annotated[config.Relayout, tyro.conf.arg(name="")]):
+    """
+    Rewrite existing activation shards in a different on-disk layout.
+
+    Args:
+        cfg: Configuration for rewriting shards.
+    """
+    import saev.activations
+
+    saev.activations.relayout(cfg)
+
+
+@beartype.beartype
+def resize(cfg: typing.Annotated[config.Resize, tyro.conf.arg(name="")]):
+    """
+    Decode, center-crop and resize a dataset's images once, so that dumping activations for several models doesn't decode them again. Dump from the result with `data:resized-dataset --data.root ...`.
+
+    Args:
+        cfg: Configuration for resizing.
+    """
+    import saev.activations
+
+    saev.activations.resize_imgs(cfg)
+
+
+@beartype.beartype
+def side_files(shard_root: str):
+    """
+    Write [CLS] token and patch mean side files for activations that were saved without them, so that image-level training doesn't read the full shards.
+
+    Args:
+        shard_root: Directory with .bin shards and a metadata.json file.
     """
     import saev.activations
 
-    saev.activations.main(cfg)
+    saev.activations.dump_side_files(shard_root)
 
 
 @beartype.beartype
@@ -86,6 +147,10 @@ def visuals(cfg: typing.Annotated[config.Visuals, tyro.conf.arg(name="")]):
 if __name__ == "__main__":
     tyro.extras.subcommand_cli_from_dict({
         "activations": activations,
+        "shuffle": shuffle,
+        "relayout": relayout,
+        "side-files": side_files,
+        "resize": resize,
         "train": train,
         "visuals": visuals,
     })
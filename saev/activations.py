@@ -1,5 +1,5 @@
 """
-To save lots of activations, we want to do things in parallel, with lots of slurm jobs, and save multiple files, rather than just one.
+To save lots of activations, we want to do things in parallel, with lots of slurm jobs, and save multiple files, rather than just one. `main` splits the shards into contiguous ranges, one per job (see `Activations.n_jobs`), and `assemble_jobs` stitches the jobs' indices together at the end.
 
 This module handles that additional complexity.
 
@@ -7,22 +7,38 @@ Conceptually, activations are either thought of as
 
 1. A single [n_imgs x n_layers x (n_patches + 1), d_vit] tensor. This is a *dataset*
 2. Multiple [n_imgs_per_shard, n_layers, (n_patches + 1), d_vit] tensors. This is a set of sharded activations.
+
+A shard directory has the `acts*.bin` shards, a `metadata.json` file (see `Metadata`) and, since format version 2, a `shards.json` index with every shard's shape, size and checksum (see `ShardInfo`).
 """
 
+import collections
+import collections.abc
+import concurrent.futures
+import contextlib
 import dataclasses
+import fcntl
 import hashlib
+import io
+import itertools
 import json
 import logging
 import math
+import mmap
+import multiprocessing
 import os
+import queue
+import shutil
+import threading
+import time
 import typing
+import zlib
 from collections.abc import Callable
 
 import beartype
 import numpy as np
 import torch
 import torchvision.datasets
-from jaxtyping import Float, jaxtyped
+from jaxtyping import Float, Int, Shaped, UInt8, jaxtyped
 from PIL import Image
 from torch import Tensor
 
@@ -40,17 +56,41 @@ logger = logging.getLogger(__name__)
 
 @jaxtyped(typechecker=beartype.beartype)
 class Recorder(torch.nn.Module):
+    """
+    Records the residual stream of `cfg.layers` with forward hooks.
+
+    With `host_buffers`, hooks copy each layer straight to a ring of preallocated host buffers, and `activations` is a view of this batch's buffer; see `Activations.host_buffers`. Otherwise, hooks copy to one device tensor and `activations` copies it to a new host tensor. Only `worker_fn` turns them on, because the ring keeps `cfg.write_queue_size + 2` batches of (pinned) host memory around, which other users, like the web app, don't need.
+    """
+
     cfg: config.Activations
+    host_buffers: bool
     _storage: Float[Tensor, "batch n_layers all_patches dim"] | None
+    _ring: list[Float[Tensor, "batch n_layers all_patches dim"]]
+    """Ring of host buffers, each for up to the biggest batch so far."""
+    _slot: int
+    """Which of `_ring` the current batch goes into."""
+    _batch: int
+    """Number of images in the current batch."""
     _i: int
 
-    def __init__(self, cfg: config.Activations, vit: torch.nn.Module):
+    def __init__(
+        self,
+        cfg: config.Activations,
+        vit: torch.nn.Module,
+        *,
+        host_buffers: bool = False,
+    ):
         super().__init__()
 
         self.cfg = cfg
+        self.host_buffers = host_buffers
         self.patches = vit.get_patches(cfg)
         self._storage = None
+        self._ring = []
+        self._slot = -1
+        self._batch = 0
         self._i = 0
+        self._device = None
         self.logger = logging.getLogger(
             f"recorder({cfg.model_family}:{cfg.model_ckpt})"
         )
@@ -63,6 +103,10 @@ class Recorder(torch.nn.Module):
     def hook(
         self, module, args: tuple, output: Float[Tensor, "batch n_layers dim"]
     ) -> None:
+        if self.host_buffers:
+            self._hook_host(output)
+            return
+
         if self._storage is None:
             batch, _, dim = output.shape
             self._storage = self._empty_storage(batch, dim, output.device)
@@ -79,31 +123,77 @@ class Recorder(torch.nn.Module):
         self._storage[:, self._i] = output[:, self.patches, :].detach()
         self._i += 1
 
-    def _empty_storage(self, batch: int, dim: int, device: torch.device):
+    def _hook_host(self, output: Float[Tensor, "batch n_layers dim"]) -> None:
+        batch, _, dim = output.shape
+        if (
+            not self._ring
+            or batch > self._ring[0].shape[0]
+            or dim != self._ring[0].shape[-1]
+        ):
+            if self._ring:
+                _, _, _, old_dim = self._ring[0].shape
+                msg = "Output shape does not fit host buffers: (batch) %d > %d or (dim) %d != %d"
+                self.logger.warning(msg, batch, self._ring[0].shape[0], dim, old_dim)
+            n_buffers = self.cfg.write_queue_size + 2
+            pin = output.is_cuda and torch.cuda.is_available()
+            self._ring = [
+                self._empty_storage(batch, dim, torch.device("cpu"), pin_memory=pin)
+                for _ in range(n_buffers)
+            ]
+            self._slot = 0
+
+        self._batch = batch
+        self._device = output.device
+        buffer = self._ring[self._slot][:batch, self._i]
+        buffer.copy_(output[:, self.patches, :].detach(), non_blocking=True)
+        self._i += 1
+
+    def _empty_storage(
+        self, batch: int, dim: int, device: torch.device, *, pin_memory: bool = False
+    ):
         n_patches_per_img = self.cfg.n_patches_per_img
         if self.cfg.cls_token:
             n_patches_per_img += 1
 
         return torch.zeros(
-            (batch, len(self.cfg.layers), n_patches_per_img, dim), device=device
+            (batch, len(self.cfg.layers), n_patches_per_img, dim),
+            device=device,
+            pin_memory=pin_memory,
         )
 
     def reset(self):
         self._i = 0
+        if self._ring:
+            # The writer may still hold views of the last few buffers.
+            self._slot = (self._slot + 1) % len(self._ring)
 
     @property
     def activations(self) -> Float[Tensor, "batch n_layers all_patches dim"]:
+        if self.host_buffers:
+            if not self._ring:
+                raise RuntimeError("First call model()")
+            if self._device is not None and self._device.type == "cuda":
+                # Wait for the non-blocking copies.
+                torch.cuda.current_stream(self._device).synchronize()
+            return self._ring[self._slot][: self._batch]
+
         if self._storage is None:
             raise RuntimeError("First call model()")
-        return self._storage.cpu()
+        # Always copy, even from the CPU, because the next batch overwrites `_storage`.
+        return self._storage.to("cpu", copy=True)
 
 
 @jaxtyped(typechecker=beartype.beartype)
 class WrappedVisionTransformer(torch.nn.Module):
-    def __init__(self, cfg: config.Activations):
+    def __init__(self, cfg: config.Activations, *, host_buffers: bool = False):
         super().__init__()
         self.vit = make_vit(cfg)
-        self.recorder = Recorder(cfg, self.vit).register(self.vit.get_residuals())
+        residuals = self.vit.get_residuals()
+        self.recorder = Recorder(cfg, self.vit, host_buffers=host_buffers).register(
+            residuals
+        )
+        # We only need the outputs of the recorded layers, so we don't run any later blocks.
+        self.vit.truncate(max(layer % len(residuals) for layer in cfg.layers) + 1)
 
     def forward(
         self, batch: Float[Tensor, "batch 3 width height"]
@@ -140,6 +230,12 @@ class Clip(torch.nn.Module):
     def get_residuals(self) -> list[torch.nn.Module]:
         return self.model.transformer.resblocks
 
+    def truncate(self, n_blocks: int) -> None:
+        """
+        Drop every residual block after the first `n_blocks`, so `forward` stops computing there. The output is no longer the model's, but the blocks we keep compute exactly what they did before.
+        """
+        self.model.transformer.resblocks = self.model.transformer.resblocks[:n_blocks]
+
     def get_patches(self, cfg: config.Activations) -> slice:
         return slice(None, None, None)
 
@@ -177,6 +273,10 @@ class Siglip(torch.nn.Module):
     def get_residuals(self) -> list[torch.nn.Module]:
         return self.model.trunk.blocks
 
+    def truncate(self, n_blocks: int) -> None:
+        """See `Clip.truncate`."""
+        self.model.trunk.blocks = self.model.trunk.blocks[:n_blocks]
+
     def get_patches(self, cfg: config.Activations) -> slice:
         return slice(None, None, None)
 
@@ -197,6 +297,12 @@ class DinoV2(torch.nn.Module):
     def get_residuals(self) -> list[torch.nn.Module]:
         return self.model.blocks
 
+    def truncate(self, n_blocks: int) -> None:
+        """See `Clip.truncate`."""
+        # Chunked blocks group several residual blocks into one module.
+        assert not self.model.chunked_blocks
+        self.model.blocks = self.model.blocks[:n_blocks]
+
     def get_patches(self, cfg: config.Activations) -> slice:
         n_reg = self.model.num_register_tokens
         patches = torch.cat((
@@ -240,6 +346,10 @@ class Moondream2(torch.nn.Module):
     def get_residuals(self) -> list[torch.nn.Module]:
         return self.model.blocks
 
+    def truncate(self, n_blocks: int) -> None:
+        """See `Clip.truncate`."""
+        self.model.blocks = self.model.blocks[:n_blocks]
+
     def forward(
         self, batch: Float[Tensor, "batch 3 width height"]
     ) -> Float[Tensor, "batch patches dim"]:
@@ -303,11 +413,544 @@ def make_img_transform(model_family: str, model_ckpt: str) -> Callable:
         typing.assert_never(model_family)
 
 
+@beartype.beartype
+def load_img(src: str | bytes, *, min_size: int | None = None) -> Image.Image:
+    """
+    Load an RGB image from a file path or encoded bytes.
+
+    With `min_size`, JPEGs are decoded at the smallest of 1/8, 1/4, 1/2 or full scale at which both sides are still at least `min_size` pixels (see PIL's `Image.draft`). The JPEG decoder scales in the DCT domain, which skips most of the decoding work, so this is much faster than decoding the full image and resizing it down.
+    """
+    with Image.open(io.BytesIO(src) if isinstance(src, bytes) else src) as img:
+        if min_size is not None and img.format == "JPEG":
+            img.draft("RGB", (min_size, min_size))
+        return img.convert("RGB")
+
+
+@beartype.beartype
+def get_min_img_size(img_transform: Callable | None) -> int | None:
+    """
+    Get the smallest image size that `img_transform` needs to lose no detail: the size of its first step, if that step is a resize. Otherwise, return None. For a `MultiTransform`, this is the biggest size any of its transforms needs.
+    """
+    from torchvision import transforms
+    from torchvision.transforms import v2
+
+    if isinstance(img_transform, MultiTransform):
+        sizes = [get_min_img_size(t) for t in img_transform.transforms]
+        return None if None in sizes else max(sizes)
+
+    steps = getattr(img_transform, "transforms", [])
+    if not steps or not isinstance(steps[0], (transforms.Resize, v2.Resize)):
+        return None
+    size = steps[0].size
+    if size is None:
+        return None
+    return max(size) if isinstance(size, (list, tuple)) else size
+
+
+@beartype.beartype
+class MultiTransform:
+    """
+    Applies several image transforms to the same image and returns a list with every result, so that several models (see `worker_fn`) share one image load.
+    """
+
+    transforms: list[Callable]
+
+    def __init__(self, transforms: list[Callable]):
+        self.transforms = transforms
+
+    def __call__(self, img) -> list[object]:
+        return [transform(img) for transform in self.transforms]
+
+
+@beartype.beartype
+class ImgNormalize:
+    """
+    Converts a batch of uint8 images to float32 in [0, 1] and normalizes them with a per-channel mean and standard deviation, on whichever device the batch is on. These are the last steps of a model's image transform; see `split_img_transform`.
+    """
+
+    mean: list[float]
+    std: list[float]
+    reciprocal: bool
+    """Whether to scale by multiplying by 1 / 255, like torchvision's v2 `ToDtype`, rather than dividing by 255, like v1 `ToTensor`. We match whichever the original transform did, so results are the same to the bit."""
+
+    def __init__(
+        self, mean: list[float], std: list[float], *, reciprocal: bool = False
+    ):
+        self.mean = mean
+        self.std = std
+        self.reciprocal = reciprocal
+
+    @jaxtyped(typechecker=beartype.beartype)
+    def __call__(
+        self, batch: UInt8[Tensor, "*batch 3 height width"]
+    ) -> Float[Tensor, "*batch 3 height width"]:
+        mean = torch.tensor(self.mean, device=batch.device).view(-1, 1, 1)
+        std = torch.tensor(self.std, device=batch.device).view(-1, 1, 1)
+        x = batch.as_subclass(Tensor).float()
+        x = x.mul_(1.0 / 255) if self.reciprocal else x.div_(255)
+        return x.sub_(mean).div_(std)
+
+
+@beartype.beartype
+def split_img_transform(img_transform: Callable) -> tuple[Callable, ImgNormalize]:
+    """
+    Split an image transform that ends by converting to float (`ToTensor()` or `ToDtype(torch.float32, scale=True)`) and, optionally, normalizing (`Normalize(...)`), like `make_img_transform`'s, into a transform that stops at uint8 image tensors and an `ImgNormalize` that does the rest a batch at a time. See `config.Activations.uint8_imgs`.
+
+    Raises:
+        TypeError: if `img_transform` isn't a torchvision `Compose`.
+        ValueError: if it doesn't end this way.
+    """
+    from torchvision import transforms
+    from torchvision.transforms import v2
+
+    if not isinstance(img_transform, (transforms.Compose, v2.Compose)):
+        raise TypeError(f"Can't split {img_transform}; it isn't a Compose.")
+
+    steps = list(img_transform.transforms)
+    mean, std = [0.0, 0.0, 0.0], [1.0, 1.0, 1.0]
+    if steps and isinstance(steps[-1], (transforms.Normalize, v2.Normalize)):
+        normalize = steps.pop()
+        mean, std = (
+            [float(m) for m in normalize.mean],
+            [float(s) for s in normalize.std],
+        )
+
+    if steps and isinstance(steps[-1], transforms.ToTensor):
+        steps[-1] = transforms.PILToTensor()
+        reciprocal = False
+    elif (
+        steps
+        and isinstance(steps[-1], v2.ToDtype)
+        and steps[-1].dtype == torch.float32
+        and steps[-1].scale
+    ):
+        steps.pop()
+        reciprocal = True
+    else:
+        raise ValueError(
+            f"Can't split {img_transform}; it doesn't end with ToTensor() or ToDtype(torch.float32, scale=True), then optionally Normalize()."
+        )
+
+    return type(img_transform)(steps), ImgNormalize(mean, std, reciprocal=reciprocal)
+
+
 ###############
 # ACTIVATIONS #
 ###############
 
 
+@beartype.beartype
+def get_storage_dtype(dtype: str) -> np.dtype:
+    """
+    Get the numpy dtype that activations with dtype `dtype` are stored as on disk. numpy has no bfloat16, so we store bfloat16 activations as their raw 16 bits.
+    """
+    if dtype == "float32":
+        return np.dtype(np.float32)
+    elif dtype == "float16":
+        return np.dtype(np.float16)
+    elif dtype == "bfloat16":
+        return np.dtype(np.uint16)
+    elif dtype == "int8":
+        return np.dtype(np.int8)
+    else:
+        raise ValueError(f"Unknown activation dtype '{dtype}'.")
+
+
+@beartype.beartype
+def get_row_size(dtype: str, d_vit: int) -> int:
+    """
+    Get the number of `get_storage_dtype(dtype)` elements that one `d_vit`-dimensional activation takes up on disk. int8 rows end with their float32 scale (4 bytes), so every row is self-contained and any indexing that picks whole rows out of a shard also picks their scales.
+    """
+    if dtype == "int8":
+        return d_vit + np.dtype(np.float32).itemsize
+
+    # Make sure dtype is known.
+    get_storage_dtype(dtype)
+    return d_vit
+
+
+@jaxtyped(typechecker=beartype.beartype)
+def to_storage(acts: Float[Tensor, "..."], dtype: str) -> Shaped[np.ndarray, "..."]:
+    """
+    Convert activations to an array of `get_storage_dtype(dtype)` that can be written to a shard. The last dimension becomes `get_row_size(dtype, d_vit)` long.
+
+    int8 activations are quantized symmetrically per row: each row is divided by its own scale `max(abs(row)) / 127` and rounded.
+    """
+    if dtype == "bfloat16":
+        return acts.to(torch.bfloat16).view(torch.int16).numpy().view(np.uint16)
+    elif dtype == "int8":
+        acts = acts.numpy()
+        scale = np.abs(acts).max(axis=-1, keepdims=True) / 127
+        # All-zero rows get a scale of 1 so we don't divide by zero.
+        scale = np.where(scale > 0, scale, 1).astype(np.float32)
+
+        d_vit = acts.shape[-1]
+        out = np.empty((*acts.shape[:-1], get_row_size(dtype, d_vit)), dtype=np.int8)
+        out[..., :d_vit] = np.rint(acts / scale)
+        out[..., d_vit:] = scale.view(np.int8)
+        return out
+
+    return acts.numpy().astype(get_storage_dtype(dtype), copy=False)
+
+
+@jaxtyped(typechecker=beartype.beartype)
+def from_storage(
+    acts: Shaped[np.ndarray, "..."], dtype: str
+) -> Float[np.ndarray, "..."]:
+    """
+    Upcast activations read from a shard to float32. float32 activations are returned as-is, without a copy.
+    """
+    if dtype == "float32":
+        return acts
+    elif dtype == "float16":
+        return acts.astype(np.float32)
+    elif dtype == "bfloat16":
+        # bfloat16 is the upper 16 bits of a float32.
+        return (acts.astype(np.uint32) << 16).view(np.float32)
+    elif dtype == "int8":
+        d_vit = acts.shape[-1] - np.dtype(np.float32).itemsize
+        scale = np.ascontiguousarray(acts[..., d_vit:]).view(np.float32)
+        return acts[..., :d_vit].astype(np.float32) * scale
+    else:
+        raise ValueError(f"Unknown activation dtype '{dtype}'.")
+
+
+@beartype.beartype
+def open_shard(
+    fpath: str,
+    *,
+    mode: str,
+    dtype: np.dtype,
+    shape: tuple[int, int, int, int],
+    layout: str,
+) -> Shaped[np.ndarray, "n_imgs_per_shard n_layers all_patches row"]:
+    """
+    Memory-map a shard of activations. Whatever the on-disk `layout`, the returned array is indexed `[img, layer, patch, row]`.
+
+    Args:
+        fpath: Path to the .bin shard.
+        mode: `np.memmap` mode.
+        dtype: On-disk dtype; see `get_storage_dtype`.
+        shape: Logical `(n_imgs_per_shard, n_layers, all_patches, row)` shape.
+        layout: 'img-major' for `[img, layer, patch, row]` on disk or 'layer-major' for `[layer, img, patch, row]` on disk, which is returned as a transposed view so that one layer's activations are contiguous.
+    """
+    if layout == "img-major":
+        return np.memmap(fpath, mode=mode, dtype=dtype, shape=shape)
+    elif layout == "layer-major":
+        n_imgs, n_layers, *rest = shape
+        acts = np.memmap(fpath, mode=mode, dtype=dtype, shape=(n_layers, n_imgs, *rest))
+        return acts.swapaxes(0, 1)
+    else:
+        raise ValueError(f"Unknown shard layout '{layout}'.")
+
+
+@beartype.beartype
+def compress_chunk(chunk: np.ndarray, compression: str) -> bytes:
+    """
+    Compress a chunk of activations. We byte-shuffle the chunk first (all of the elements' first bytes, then all of their second bytes, and so on), which groups the slowly-varying sign and exponent bytes together and lets the codec find much more redundancy.
+    """
+    chunk = np.ascontiguousarray(chunk)
+    shuffled = chunk.view(np.uint8).reshape(-1, chunk.itemsize).T.tobytes()
+    if compression == "zlib":
+        return zlib.compress(shuffled, level=1)
+    elif compression == "zstd":
+        import zstandard
+
+        return zstandard.ZstdCompressor(level=3).compress(shuffled)
+    else:
+        raise ValueError(f"Unknown compression '{compression}'.")
+
+
+@beartype.beartype
+def decompress_chunk(
+    buf: bytes | np.ndarray,
+    compression: str,
+    *,
+    dtype: np.dtype,
+    shape: tuple[int, ...],
+) -> np.ndarray:
+    """
+    Inverse of `compress_chunk`.
+    """
+    if compression == "zlib":
+        shuffled = zlib.decompress(buf)
+    elif compression == "zstd":
+        import zstandard
+
+        shuffled = zstandard.ZstdDecompressor().decompress(buf)
+    else:
+        raise ValueError(f"Unknown compression '{compression}'.")
+
+    unshuffled = np.frombuffer(shuffled, dtype=np.uint8).reshape(dtype.itemsize, -1).T
+    return np.ascontiguousarray(unshuffled).view(dtype).reshape(shape)
+
+
+@beartype.beartype
+def compress_shard(
+    raw_fpath: str, fpath: str, *, metadata: "Metadata", shape: tuple[int, ...]
+) -> tuple[int, ...]:
+    """
+    Compress the raw (img-major) shard at `raw_fpath` into `fpath`, `metadata.n_imgs_per_chunk` images at a time.
+
+    Returns:
+        The byte offset of every chunk in `fpath`, followed by the file size.
+    """
+    raw = np.memmap(
+        raw_fpath, mode="r", dtype=get_storage_dtype(metadata.dtype), shape=shape
+    )
+    offsets = [0]
+    with open(fpath, "wb") as fd:
+        for start in range(0, len(raw), metadata.n_imgs_per_chunk):
+            chunk = raw[start : start + metadata.n_imgs_per_chunk]
+            offsets.append(
+                offsets[-1] + fd.write(compress_chunk(chunk, metadata.compression))
+            )
+    return tuple(offsets)
+
+
+@beartype.beartype
+class CompressedShard:
+    """
+    Read-only view of a compressed shard (see `compress_shard`) that can be indexed like the `[img, layer, patch, row]` memmap of an uncompressed shard, as long as the first index is an int, a slice or a 1D integer array. Indexing decompresses the chunks that hold the selected images; decompressed chunks are kept in an LRU cache shared by all of a `Dataset`'s shards.
+    """
+
+    def __init__(
+        self,
+        fpath: str,
+        info: "ShardInfo",
+        metadata: "Metadata",
+        *,
+        chunks: collections.OrderedDict,
+        max_chunks: int,
+    ):
+        self.fpath = fpath
+        self.shape = info.shape
+        self.dtype = get_storage_dtype(metadata.dtype)
+        self.offsets = info.chunk_offsets
+        self.compression = metadata.compression
+        self.n_imgs_per_chunk = metadata.n_imgs_per_chunk
+        self.chunks = chunks
+        self.max_chunks = max_chunks
+        self.buf = np.memmap(fpath, mode="r", dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def get_chunk(self, chunk: int) -> Shaped[np.ndarray, "_ n_layers all_patches row"]:
+        key = (self.fpath, chunk)
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+
+        start = chunk * self.n_imgs_per_chunk
+        n_imgs = min(self.n_imgs_per_chunk, len(self) - start)
+        acts = decompress_chunk(
+            self.buf[self.offsets[chunk] : self.offsets[chunk + 1]],
+            self.compression,
+            dtype=self.dtype,
+            shape=(n_imgs, *self.shape[1:]),
+        )
+
+        self.chunks[key] = acts
+        while len(self.chunks) > self.max_chunks:
+            self.chunks.popitem(last=False)
+        return acts
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        first, rest = key[0], key[1:]
+
+        if isinstance(first, slice):
+            pos = np.arange(len(self))[first]
+        elif isinstance(first, (int, np.integer)):
+            chunk, local = divmod(first % len(self), self.n_imgs_per_chunk)
+            return self.get_chunk(chunk)[(local, *rest)]
+        else:
+            pos = np.asarray(first)
+            if pos.ndim != 1 or not np.issubdtype(pos.dtype, np.integer):
+                raise IndexError(
+                    f"Unsupported index {first!r} into a compressed shard."
+                )
+            pos = np.where(pos < 0, pos + len(self), pos)
+
+        # Index each chunk separately; index arrays that go with `pos` are split up the same way.
+        out = None
+        chunk_P = pos // self.n_imgs_per_chunk
+        order = np.argsort(chunk_P, kind="stable")
+        bounds = np.flatnonzero(np.diff(chunk_P[order])) + 1
+        for group in np.split(order, bounds):
+            if not len(group):
+                continue
+            acts = self.get_chunk(chunk_P[group[0]].item())
+            group_rest = tuple(
+                k[group] if isinstance(k, np.ndarray) and k.shape == pos.shape else k
+                for k in rest
+            )
+            acts = acts[(pos[group] % self.n_imgs_per_chunk, *group_rest)]
+            if out is None:
+                out = np.empty((len(pos), *acts.shape[1:]), dtype=acts.dtype)
+            out[group] = acts
+
+        if out is None:
+            # Nothing selected.
+            out = np.empty((0, *self.shape[1:]), dtype=self.dtype)[(slice(None), *rest)]
+        return out
+
+
+@beartype.beartype
+class ShardCache:
+    """
+    Copies shards from slow (network) storage at `src_dpath` to a local directory on first use, so later reads are local (see `config.DataLoad.cache_dir`).
+
+    Copies run in a background thread, so the first read of a shard still comes from `src_dpath`. Every copy goes to a temporary file that is atomically renamed into place, so readers only ever see complete shards. The copier holds an exclusive `flock` on the temporary file until it is renamed, so only one process copies each shard. The kernel releases the lock when its holder dies (DataLoader workers are often killed mid-copy), so an unlocked temporary file was left behind by a dead copier: the next copy of that shard takes it over and eviction deletes it. Shards from every shard directory share `max_bytes` of space in `cache_dir`: before each copy, we delete the least recently used shards (by modification time, which we bump on every use) until the copy fits.
+    """
+
+    def __init__(self, src_dpath: str, cache_dir: str, key: str, max_bytes: int):
+        self.src_dpath = src_dpath
+        self.cache_dir = cache_dir
+        self.dpath = os.path.join(cache_dir, key)
+        self.max_bytes = max_bytes
+        os.makedirs(self.dpath, exist_ok=True)
+
+        self.done = []
+        """File names that finished copying, for the caller to pop."""
+        self._pending = {}
+        self._executor = None
+        self._pid = os.getpid()
+
+    def get_fpath(self, fname: str, nbytes: int) -> str:
+        """
+        Get the path to read shard `fname` (of `nbytes` bytes) from: the local copy if there is a complete one, and otherwise the original, in which case we start copying it.
+        """
+        local_fpath = os.path.join(self.dpath, fname)
+        if os.path.isfile(local_fpath):
+            if os.path.getsize(local_fpath) == nbytes:
+                # Mark as recently used.
+                os.utime(local_fpath)
+                return local_fpath
+            # A stale copy of a different dump.
+            os.remove(local_fpath)
+
+        if self._pid != os.getpid():
+            # Threads don't survive fork(); forked DataLoader workers start their own.
+            self._executor = None
+            self._pending = {}
+            self._pid = os.getpid()
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        if fname not in self._pending and nbytes <= self.max_bytes:
+            self._pending[fname] = self._executor.submit(self.copy, fname, nbytes)
+        return os.path.join(self.src_dpath, fname)
+
+    def resolve(self, fname: str) -> str:
+        """Get the path of `fname`'s local copy if there is one and the original otherwise, without copying anything."""
+        local_fpath = os.path.join(self.dpath, fname)
+        if os.path.isfile(local_fpath):
+            return local_fpath
+        return os.path.join(self.src_dpath, fname)
+
+    def copy(self, fname: str, nbytes: int) -> None:
+        local_fpath = os.path.join(self.dpath, fname)
+        tmp_fpath = local_fpath + ".tmp"
+        fd = lock_file(tmp_fpath, os.O_CREAT | os.O_WRONLY)
+        if fd is None:
+            # Another process is copying this shard.
+            return
+        try:
+            if os.path.isfile(local_fpath):
+                # Another process finished copying this shard.
+                os.remove(tmp_fpath)
+                return
+            # Start over if a dead copier left a partial copy behind.
+            os.ftruncate(fd, 0)
+            self.evict(nbytes)
+            src_fpath = os.path.join(self.src_dpath, fname)
+            with open(src_fpath, "rb") as src, open(fd, "wb", closefd=False) as dst:
+                shutil.copyfileobj(src, dst, length=16 * 1024**2)
+            # Rename while we still hold the lock, so nobody can take over the finished copy.
+            os.replace(tmp_fpath, local_fpath)
+            self.done.append(fname)
+        except OSError as err:
+            logger.warning("Could not cache '%s': %s", fname, err)
+            if os.path.exists(tmp_fpath):
+                os.remove(tmp_fpath)
+        finally:
+            os.close(fd)
+
+    def evict(self, nbytes: int) -> None:
+        """
+        Delete least recently used shards from anywhere in `cache_dir` until `nbytes` more bytes fit in `max_bytes`.
+        """
+        entries = []
+        for dpath, _, fnames in os.walk(self.cache_dir):
+            for fname in fnames:
+                fpath = os.path.join(dpath, fname)
+                if fname.endswith(".tmp"):
+                    fd = lock_file(fpath, os.O_RDONLY)
+                    if fd is not None:
+                        # Left behind by a dead copier.
+                        os.remove(fpath)
+                        os.close(fd)
+                        continue
+                try:
+                    stat = os.stat(fpath)
+                except FileNotFoundError:
+                    # Another process evicted it.
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, fpath))
+
+        total = sum(size for _, size, _ in entries)
+        # In-progress copies count against the budget but can't be evicted.
+        for _, size, fpath in sorted(entries):
+            if total + nbytes <= self.max_bytes:
+                break
+            if fpath.endswith(".tmp"):
+                continue
+            try:
+                os.remove(fpath)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def wait(self) -> None:
+        """Wait for every copy this process started."""
+        concurrent.futures.wait(list(self._pending.values()))
+
+    def __getstate__(self) -> dict[str, object]:
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        state["_pending"] = {}
+        state["done"] = []
+        return state
+
+
+@beartype.beartype
+def lock_file(fpath: str, flags: int) -> int | None:
+    """
+    Open `fpath` with `flags` and take an exclusive `flock` on it without waiting.
+
+    Returns:
+        The locked file descriptor, or None if `fpath` doesn't exist or another open file holds the lock. The lock is released when the descriptor is closed.
+    """
+    try:
+        fd = os.open(fpath, flags)
+    except FileNotFoundError:
+        return None
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # Whoever held the lock before us might have renamed or removed the file.
+        locked = os.stat(fpath).st_ino == os.fstat(fd).st_ino
+    except (BlockingIOError, FileNotFoundError):
+        locked = False
+
+    if not locked:
+        os.close(fd)
+        return None
+    return fd
+
+
 @jaxtyped(typechecker=beartype.beartype)
 class Dataset(torch.utils.data.Dataset):
     """
@@ -321,16 +964,27 @@ class Dataset(torch.utils.data.Dataset):
         image_i: int
         patch_i: int
 
+    class Batch(typing.TypedDict):
+        """Batch of examples, already collated. See `Dataset.__getitems__`."""
+
+        act: Float[Tensor, "batch d_vit"]
+        image_i: Int[Tensor, " batch"]
+        patch_i: Int[Tensor, " batch"]
+
     cfg: config.DataLoad
     """Configuration; set via CLI args."""
     metadata: "Metadata"
     """Activations metadata; automatically loaded from disk."""
+    index: "list[ShardInfo] | None"
+    """Shard index for format version 2 and later; automatically loaded from disk."""
     layer_index: int
     """Layer index into the shards if we are choosing a specific layer."""
     scalar: float
     """Normalizing scalar such that ||x / scalar ||_2 ~= sqrt(d_vit)."""
     act_mean: Float[Tensor, " d_vit"]
     """Mean activation."""
+    memory: "Dataset.Batch | None"
+    """Every (normalized) example, if `cfg.in_memory`; see `read_all`."""
 
     def __init__(self, cfg: config.DataLoad):
         self.cfg = cfg
@@ -340,6 +994,26 @@ class Dataset(torch.utils.data.Dataset):
         metadata_fpath = os.path.join(self.cfg.shard_root, "metadata.json")
         self.metadata = Metadata.load(metadata_fpath)
 
+        self.index = None
+        if self.metadata.version >= 2:
+            self.index = load_index(self.cfg.shard_root)
+            check_shards(self.cfg.shard_root, self.metadata, self.index)
+
+        self._shards = collections.OrderedDict()
+        self._chunks = collections.OrderedDict()
+        self._pid = os.getpid()
+        self._example_i = None
+        self._side_files = {}
+        self.memory = None
+        self._cache = None
+        if self.cfg.cache_dir:
+            self._cache = ShardCache(
+                self.cfg.shard_root,
+                self.cfg.cache_dir,
+                self.metadata.hash,
+                int(self.cfg.cache_gb * 1024**3),
+            )
+
         # Pick a really big number so that if you accidentally use this when you shouldn't, you get an out of bounds IndexError.
         self.layer_index = 1_000_000
         if isinstance(self.cfg.layer, int):
@@ -347,31 +1021,30 @@ class Dataset(torch.utils.data.Dataset):
             assert self.cfg.layer in self.metadata.layers, err_msg
             self.layer_index = self.metadata.layers.index(self.cfg.layer)
 
+        if self.shuffled and (
+            self.cfg.patches != "patches" or not isinstance(self.cfg.layer, int)
+        ):
+            raise ValueError(
+                f"Shuffled activations in '{self.cfg.shard_root}' only have patches from layer {self.metadata.layers[0]}; use patches='patches' and layer={self.metadata.layers[0]}."
+            )
+
         # Premptively set these values so that preprocess() doesn't freak out.
         self.scalar = 1.0
         self.act_mean = torch.zeros(self.d_vit)
 
         # If either of these are true, we must do this work.
         if self.cfg.scale_mean is True or self.cfg.scale_norm is True:
-            # Load a random subset of samples to calculate the mean activation and mean L2 norm.
-            perm = np.random.default_rng(seed=42).permutation(len(self))
-            perm = perm[: cfg.n_random_samples]
-
-            samples = [
-                self[p.item()]
-                for p in helpers.progress(
-                    perm, every=25_000, desc="examples to calc means"
-                )
-            ]
-            samples = torch.stack([sample["act"] for sample in samples])
-            if samples.abs().max() > 1e3:
+            stats = self.get_norm_stats(
+                centered=bool(self.cfg.scale_mean and self.cfg.scale_norm)
+            )
+            if stats["max_abs"] > 1e3:
                 raise ValueError(
-                    "You found an abnormally large activation {example.abs().max().item():.5f} that will mess up your L2 mean."
+                    f"You found an abnormally large activation {stats['max_abs']:.5f} that will mess up your L2 mean."
                 )
 
             # Activation mean
             if self.cfg.scale_mean:
-                self.act_mean = samples.mean(axis=0)
+                self.act_mean = stats["act_mean"].float()
                 if (self.act_mean > 1e3).any():
                     raise ValueError(
                         "You found an abnormally large activation that is messing up your activation mean."
@@ -379,7 +1052,10 @@ class Dataset(torch.utils.data.Dataset):
 
             # Norm
             if self.cfg.scale_norm:
-                l2_mean = torch.linalg.norm(samples - self.act_mean, axis=1).mean()
+                if self.cfg.scale_mean:
+                    l2_mean = stats["l2_mean_centered"].float()
+                else:
+                    l2_mean = stats["l2_mean"].float()
                 if l2_mean > 1e3:
                     raise ValueError(
                         "You found an abnormally large activation that is messing up your L2 mean."
@@ -393,15 +1069,170 @@ class Dataset(torch.utils.data.Dataset):
             # Load scalar normalization from disk
             self.scalar = torch.load(self.cfg.scale_norm).item()
 
-    def transform(self, act: Float[np.ndarray, " d_vit"]) -> Float[Tensor, " d_vit"]:
+        if self.cfg.in_memory:
+            self.memory = self.read_all()
+
+    def get_norm_stats(self, *, centered: bool = True) -> dict[str, Tensor]:
+        """
+        Get the statistics we normalize activations with: the mean activation (`act_mean`), the mean L2 norm with and without subtracting the mean (`l2_mean_centered` and `l2_mean`) and the largest absolute value (`max_abs`) of `cfg.n_random_samples` random (clamped) examples.
+
+        If `ShardWriter` saved statistics of every activation while dumping (see `get_dump_stats`), we use those instead, except for `l2_mean_centered`, which we still estimate from the random examples, centered on the exact mean. With `centered=False`, we leave `l2_mean_centered` out, so with dump statistics we don't read any activations. Otherwise, we read the examples in sorted order, a batch at a time with `cfg.n_stats_workers` DataLoader workers, and merge per-batch means in float64 (Chan et al.'s parallel version of Welford's algorithm), which takes two passes because the centered norm needs the mean. The statistics are saved in the shard directory under a key of the metadata hash and everything else they depend on, so every later `Dataset` over the same activations loads them in milliseconds. If the shard directory is read-only, we just recompute them next time.
+        """
+        stats = self.get_dump_stats()
+        if stats is not None and not centered:
+            return stats
+
+        key = {
+            "metadata": self.metadata.hash,
+            "patches": self.cfg.patches,
+            "layer": self.cfg.layer,
+            "clamp": self.cfg.clamp,
+            "n_random_samples": self.cfg.n_random_samples,
+        }
+        if stats is not None:
+            key["act_mean"] = "dump"
+        key = json.dumps(key, sort_keys=True)
+        stats_fpath = os.path.join(
+            self.cfg.shard_root,
+            "stats",
+            hashlib.sha256(key.encode("utf-8")).hexdigest() + ".pt",
+        )
+        if os.path.isfile(stats_fpath):
+            return torch.load(stats_fpath, weights_only=True)
+
+        # Same random subset of examples as always, read in order.
+        perm = np.random.default_rng(seed=42).permutation(len(self))
+        indices = np.sort(perm[: self.cfg.n_random_samples]).tolist()
+
+        def batches():
+            dataloader = torch.utils.data.DataLoader(
+                self,
+                batch_size=16_384,
+                sampler=indices,
+                num_workers=self.cfg.n_stats_workers,
+                collate_fn=collate,
+            )
+            for batch in helpers.progress(dataloader, every=8, desc="norm stats"):
+                yield batch["act"].double()
+
+        if stats is None:
+            n, l2_mean, max_abs = 0, 0.0, 0.0
+            act_mean = torch.zeros(self.d_vit, dtype=torch.float64)
+            for x_BD in batches():
+                n += len(x_BD)
+                act_mean += (x_BD.mean(dim=0) - act_mean) * len(x_BD) / n
+                norm = torch.linalg.norm(x_BD, dim=1).mean().item()
+                l2_mean += (norm - l2_mean) * len(x_BD) / n
+                max_abs = max(max_abs, x_BD.abs().max().item())
+            stats = {
+                "act_mean": act_mean,
+                "l2_mean": torch.tensor(l2_mean, dtype=torch.float64),
+                "max_abs": torch.tensor(max_abs, dtype=torch.float64),
+            }
+
+        n, l2_mean_centered = 0, 0.0
+        act_mean = stats["act_mean"].double()
+        for x_BD in batches():
+            n += len(x_BD)
+            norm = torch.linalg.norm(x_BD - act_mean, dim=1).mean().item()
+            l2_mean_centered += (norm - l2_mean_centered) * len(x_BD) / n
+        stats["l2_mean_centered"] = torch.tensor(l2_mean_centered, dtype=torch.float64)
+        try:
+            os.makedirs(os.path.dirname(stats_fpath), exist_ok=True)
+            tmp_fpath = stats_fpath + f".{os.getpid()}.tmp"
+            torch.save(stats, tmp_fpath)
+            os.replace(tmp_fpath, stats_fpath)
+        except OSError as err:
+            logger.warning("Could not save normalization statistics: %s", err)
+        return stats
+
+    def read_all(
+        self, n_examples_per_batch: int = 65_536, *, device: str = "cpu"
+    ) -> Batch:
+        """
+        Read every example, in order, into one contiguous `[n, d_vit]` tensor (plus image and patch indices) on `device`, `n_examples_per_batch` examples at a time through `__getitems__`. Batches go straight to `device`, so with a GPU the examples never all sit in RAM at once.
+
+        On the CPU, with `cfg.pin_memory`, the tensors are in page-locked memory, so copies to the GPU are faster and can be asynchronous; with `cfg.share_memory`, they are in shared memory, so DataLoader workers use them without a copy.
+
+        Returns `memory` (moved to `device`) if it is already loaded.
+        """
+        if self.memory is not None:
+            return self.Batch(**{
+                key: tensor.to(device) for key, tensor in self.memory.items()
+            })
+
+        on_cpu = torch.device(device).type == "cpu"
+        if self.cfg.pin_memory and self.cfg.share_memory:
+            raise ValueError("Activations can't be both pinned and in shared memory.")
+        pin_memory = on_cpu and self.cfg.pin_memory and torch.cuda.is_available()
+        if on_cpu and self.cfg.pin_memory and not pin_memory:
+            logger.warning("Not pinning activations because CUDA is not available.")
+
+        n = len(self)
+        logger.info(
+            "Loading %d activations (%.1f GB) onto %s.",
+            n,
+            n * self.d_vit * 4 / 1e9,
+            device,
+        )
+        kwargs = {"device": device, "pin_memory": pin_memory}
+        memory = self.Batch(
+            act=torch.empty((n, self.d_vit), **kwargs),
+            image_i=torch.empty((n,), dtype=torch.int64, **kwargs),
+            patch_i=torch.empty((n,), dtype=torch.int64, **kwargs),
+        )
+        if on_cpu and self.cfg.share_memory:
+            for tensor in memory.values():
+                tensor.share_memory_()
+
+        starts = range(0, n, n_examples_per_batch)
+        for start in helpers.progress(starts, every=16, desc="read all"):
+            end = min(start + n_examples_per_batch, n)
+            batch = self.__getitems__(list(range(start, end)))
+            for key, tensor in memory.items():
+                tensor[start:end] = batch[key]
+        return memory
+
+    def get_dump_stats(self) -> dict[str, Tensor] | None:
+        """
+        Get the normalization statistics (see `get_norm_stats`) of every activation from the `ActStats` that `ShardWriter` saved while dumping, or None if there aren't any for this layer and kind of patch. We only use them when `cfg.clamp` doesn't clamp anything, because they are of unclamped activations. `ActStats.l2_mean_centered` is only approximate, so we leave it out.
+        """
+        if self.shuffled or not isinstance(self.cfg.layer, int):
+            return None
+        if self.cfg.patches not in ("cls", "patches"):
+            return None
+
+        stats = load_act_stats(self.cfg.shard_root).get(self.cfg.patches)
+        n = self.metadata.n_imgs
+        if self.cfg.patches == "patches":
+            n *= self.metadata.n_patches_per_img
+        if stats is None or stats.n != n:
+            # Missing or from an unfinished dump.
+            return None
+
+        layer = self.layer_index
+        if stats.max_abs[layer] > self.cfg.clamp:
+            return None
+
+        return {
+            "act_mean": torch.from_numpy(stats.mean[layer]),
+            "l2_mean": torch.tensor(stats.l2_mean[layer]),
+            "max_abs": torch.tensor(stats.max_abs[layer]),
+        }
+
+    def transform(
+        self, act: Float[np.ndarray, "*batch d_vit"]
+    ) -> Float[Tensor, "*batch d_vit"]:
         """
         Apply a scalar normalization so the mean squared L2 norm is same as d_vit. This is from 'Scaling Monosemanticity':
 
         > As a preprocessing step we apply a scalar normalization to the model activations so their average squared L2 norm is the residual stream dimension
 
         So we divide by self.scalar which is the datasets (approximate) L2 mean before normalization divided by sqrt(d_vit).
+
+        Works on a single activation or a whole batch of activations. `clamp` is not in-place, so the result never shares memory with `act` (which might be a memmap).
         """
-        act = torch.from_numpy(act.copy())
+        act = torch.from_numpy(act)
         act = act.clamp(-self.cfg.clamp, self.cfg.clamp)
         return (act - self.act_mean) / self.scalar
 
@@ -410,8 +1241,66 @@ class Dataset(torch.utils.data.Dataset):
         """Dimension of the underlying vision transformer's embedding space."""
         return self.metadata.d_vit
 
+    @property
+    def shuffled(self) -> bool:
+        """Whether the shards were written by `shuffle` and are already in a random order."""
+        return self.metadata.shuffle_seed is not None
+
+    @property
+    def example_i(self) -> Int[np.ndarray, " n"]:
+        """For shuffled activations, the original (unshuffled) example index of every example."""
+        if self._example_i is None:
+            example_i_fpath = os.path.join(self.cfg.shard_root, "example_i.npy")
+            self._example_i = np.load(example_i_fpath, mmap_mode="r")
+        return self._example_i
+
+    def get_side_file(
+        self, name: str
+    ) -> Float[np.ndarray, "n_imgs n_layers d_vit"] | None:
+        """
+        Get the side file `name` ('cls' for [CLS] tokens or 'meanpool' for per-layer patch means; see `ShardWriter`) if the shard directory has it.
+        """
+        if name not in self._side_files:
+            fpath = os.path.join(self.cfg.shard_root, f"{name}.npy")
+            side = np.load(fpath, mmap_mode="r") if os.path.isfile(fpath) else None
+            self._side_files[name] = side
+        return self._side_files[name]
+
+    def get_pooled(
+        self, i_B: Int[np.ndarray, " batch"]
+    ) -> Float[np.ndarray, "batch d_vit"] | None:
+        """
+        Get image-level activations for `patches='cls'` and `patches='meanpool'` from the side files, which are much smaller than the shards. Returns None if we have to read the shards instead.
+        """
+        if self.cfg.patches not in ("cls", "meanpool"):
+            return None
+
+        side = self.get_side_file(self.cfg.patches)
+        if side is None:
+            return None
+
+        match self.cfg.layer:
+            case int():
+                return np.asarray(side[i_B, self.layer_index], dtype=np.float32)
+            case "meanpool":
+                # Every layer has the same number of patches, so the mean of the per-layer means is the mean over all layers and patches.
+                return side[i_B].mean(axis=1, dtype=np.float32)
+            case _:
+                return None
+
     @jaxtyped(typechecker=beartype.beartype)
     def __getitem__(self, i: int) -> Example:
+        if self.memory is not None:
+            return self.Example(
+                act=self.memory["act"][i],
+                image_i=self.memory["image_i"][i].item(),
+                patch_i=self.memory["patch_i"][i].item(),
+            )
+
+        pooled = self.get_pooled(np.array([i]))
+        if pooled is not None:
+            return self.Example(act=self.transform(pooled[0]), image_i=i, patch_i=-1)
+
         match (self.cfg.patches, self.cfg.layer):
             case ("cls", int()):
                 img_act = self.get_img_patches(i)
@@ -439,35 +1328,33 @@ class Dataset(torch.utils.data.Dataset):
                 # Meanpool over the layers and patches
                 act = act.mean(axis=(0, 1))
                 return self.Example(act=self.transform(act), image_i=i, patch_i=-1)
-            case ("patches", int()):
-                n_imgs_per_shard = (
-                    self.metadata.n_patches_per_shard
-                    // len(self.metadata.layers)
-                    // (self.metadata.n_patches_per_img + 1)
+            case ("patches", int()) if self.shuffled:
+                shard = i // self.metadata.n_patches_per_shard
+                pos = i % self.metadata.n_patches_per_shard
+                act = self.upcast(self.get_shard(shard)[pos])
+                example_i = self.example_i[i].item()
+                return self.Example(
+                    act=self.transform(act),
+                    image_i=example_i // self.metadata.n_patches_per_img,
+                    patch_i=example_i % self.metadata.n_patches_per_img,
                 )
+            case ("patches", int()):
                 n_examples_per_shard = (
-                    n_imgs_per_shard * self.metadata.n_patches_per_img
+                    self.metadata.n_imgs_per_shard * self.metadata.n_patches_per_img
                 )
 
                 shard = i // n_examples_per_shard
                 pos = i % n_examples_per_shard
 
-                acts_fpath = os.path.join(self.cfg.shard_root, f"acts{shard:06}.bin")
-                shape = (
-                    n_imgs_per_shard,
-                    len(self.metadata.layers),
-                    self.metadata.n_patches_per_img + 1,
-                    self.metadata.d_vit,
-                )
-                acts = np.memmap(acts_fpath, mode="c", dtype=np.float32, shape=shape)
                 # Choose the layer and the non-CLS tokens.
-                acts = acts[:, self.layer_index, 1:]
+                acts = self.get_shard(shard)[:, self.layer_index, 1:]
 
                 # Choose a patch among n and the patches.
                 act = acts[
                     pos // self.metadata.n_patches_per_img,
                     pos % self.metadata.n_patches_per_img,
                 ]
+                act = self.upcast(act)
                 return self.Example(
                     act=self.transform(act),
                     # What image is this?
@@ -478,29 +1365,193 @@ class Dataset(torch.utils.data.Dataset):
                 print((self.cfg.patches, self.cfg.layer))
                 typing.assert_never((self.cfg.patches, self.cfg.layer))
 
+    def __getitems__(self, indices: list[int]) -> Batch:
+        """
+        Batched version of `__getitem__`, which `torch.utils.data.DataLoader` calls with all of a batch's indices at once.
+
+        Rather than building one `Example` per index, we group the indices by shard, gather each shard's rows with a single fancy-index and normalize the whole `[batch, d_vit]` block at once. The result is already collated, so use `collate` as the DataLoader's `collate_fn`.
+        """
+        if self.memory is not None:
+            i_B = torch.as_tensor(indices, dtype=torch.int64)
+            return self.Batch(**{
+                key: tensor[i_B] for key, tensor in self.memory.items()
+            })
+
+        i_B = np.asarray(indices, dtype=np.int64)
+
+        if self.shuffled:
+            return self._getitems_shuffled(i_B)
+
+        pooled_BD = self.get_pooled(i_B)
+        if pooled_BD is not None:
+            return self.Batch(
+                act=self.transform(pooled_BD),
+                image_i=torch.from_numpy(i_B),
+                patch_i=torch.full((len(i_B),), -1, dtype=torch.int64),
+            )
+
+        if self.cfg.patches == "patches":
+            image_i_B = i_B // self.metadata.n_patches_per_img
+            patch_i_B = i_B % self.metadata.n_patches_per_img
+        else:
+            image_i_B = i_B
+            patch_i_B = np.full_like(i_B, -1)
+
+        shard_B = image_i_B // self.metadata.n_imgs_per_shard
+        pos_B = image_i_B % self.metadata.n_imgs_per_shard
+
+        act_BD = np.empty((len(i_B), self.d_vit), dtype=np.float32)
+
+        # Visit each shard once, in order.
+        order = np.argsort(shard_B, kind="stable")
+        bounds = np.flatnonzero(np.diff(shard_B[order])) + 1
+        for group in np.split(order, bounds):
+            if not len(group):
+                continue
+            acts = self.get_shard(shard_B[group[0]].item())
+            pos = pos_B[group]
+
+            # Gather in the storage dtype, then upcast the whole group at once.
+            match (self.cfg.patches, self.cfg.layer):
+                case ("cls", int()):
+                    act_BD[group] = self.upcast(acts[pos, self.layer_index, 0])
+                case ("cls", "meanpool"):
+                    act_BD[group] = self.upcast(acts[pos, :, 0]).mean(axis=1)
+                case ("meanpool", int()):
+                    act_BD[group] = self.upcast(acts[pos, self.layer_index, 1:]).mean(
+                        axis=1
+                    )
+                case ("meanpool", "meanpool"):
+                    act_BD[group] = self.upcast(acts[pos, :, 1:]).mean(axis=(1, 2))
+                case ("patches", int()):
+                    act_BD[group] = self.upcast(
+                        acts[pos, self.layer_index, patch_i_B[group] + 1]
+                    )
+                case _:
+                    typing.assert_never((self.cfg.patches, self.cfg.layer))
+
+        return self.Batch(
+            act=self.transform(act_BD),
+            image_i=torch.from_numpy(image_i_B),
+            patch_i=torch.from_numpy(patch_i_B),
+        )
+
+    def _getitems_shuffled(self, i_B: Int[np.ndarray, " batch"]) -> Batch:
+        act_BD = np.empty((len(i_B), self.d_vit), dtype=np.float32)
+
+        shard_B = i_B // self.metadata.n_patches_per_shard
+        pos_B = i_B % self.metadata.n_patches_per_shard
+        order = np.argsort(shard_B, kind="stable")
+        bounds = np.flatnonzero(np.diff(shard_B[order])) + 1
+        for group in np.split(order, bounds):
+            if not len(group):
+                continue
+            acts = self.get_shard(shard_B[group[0]].item())
+            act_BD[group] = self.upcast(acts[pos_B[group]])
+
+        example_i_B = self.example_i[i_B].astype(np.int64)
+        return self.Batch(
+            act=self.transform(act_BD),
+            image_i=torch.from_numpy(example_i_B // self.metadata.n_patches_per_img),
+            patch_i=torch.from_numpy(example_i_B % self.metadata.n_patches_per_img),
+        )
+
     def get_shard_patches(self):
         raise NotImplementedError()
 
     def get_img_patches(
         self, i: int
     ) -> Float[np.ndarray, "n_layers all_patches d_vit"]:
-        n_imgs_per_shard = (
-            self.metadata.n_patches_per_shard
-            // len(self.metadata.layers)
-            // (self.metadata.n_patches_per_img + 1)
-        )
-        shard = i // n_imgs_per_shard
-        pos = i % n_imgs_per_shard
-        acts_fpath = os.path.join(self.cfg.shard_root, f"acts{shard:06}.bin")
-        shape = (
-            n_imgs_per_shard,
-            len(self.metadata.layers),
-            self.metadata.n_patches_per_img + 1,
-            self.metadata.d_vit,
-        )
-        acts = np.memmap(acts_fpath, mode="c", dtype=np.float32, shape=shape)
-        # Note that this is not yet copied!
-        return acts[pos]
+        shard = i // self.metadata.n_imgs_per_shard
+        pos = i % self.metadata.n_imgs_per_shard
+        # Note that float32 activations are not yet copied!
+        return self.upcast(self.get_shard(shard)[pos])
+
+    def upcast(self, acts: Shaped[np.ndarray, "..."]) -> Float[np.ndarray, "..."]:
+        """Upcast activations read from `get_shard` to float32."""
+        return from_storage(acts, self.metadata.dtype)
+
+    def get_shard(
+        self, shard: int
+    ) -> (
+        Shaped[np.ndarray, "n_imgs_per_shard n_layers all_patches row"]
+        | Shaped[np.ndarray, "n_patches_per_shard row"]
+        | CompressedShard
+    ):
+        """
+        Get the memory-mapped activations for shard `shard`, re-using an already-opened memmap if possible.
+
+        Opened memmaps are kept in a per-process LRU cache of at most `cfg.max_open_shards` entries so that fetching an example is just indexing. DataLoader workers are forked from the main process, so if the process ID changes we drop the inherited cache and each worker opens its own memmaps.
+
+        Shuffled shards (see `shuffle`) are `[n_patches_per_shard, d_vit]` rather than one row per image. Otherwise, shards are indexed `[img, layer, patch]` in either layout (see `open_shard`).
+
+        Compressed shards are returned as a `CompressedShard`, which supports the same indexing and keeps up to `cfg.max_cached_chunks` decompressed chunks in memory.
+
+        The memmap has the on-disk dtype and row size (see `get_storage_dtype` and `get_row_size`); use `upcast` on whatever you index out of it.
+        """
+        if self._pid != os.getpid():
+            self._shards.clear()
+            self._chunks.clear()
+            self._pid = os.getpid()
+
+        if self._cache is not None and self._cache.done:
+            # Re-open shards that now have a local copy.
+            while self._cache.done:
+                fname = self._cache.done.pop()
+                self._shards.pop(int(fname.removeprefix("acts")[:6]), None)
+
+        if shard in self._shards:
+            self._shards.move_to_end(shard)
+            return self._shards[shard]
+
+        if self.index is not None:
+            shape = self.index[shard].shape
+        else:
+            shape = self.metadata.get_shard_shape(shard)
+
+        fname = f"acts{shard:06}.bin"
+        acts_fpath = os.path.join(self.cfg.shard_root, fname)
+        if self._cache is not None:
+            if self.index is not None:
+                nbytes = self.index[shard].nbytes
+            else:
+                nbytes = os.path.getsize(acts_fpath)
+            acts_fpath = self._cache.get_fpath(fname, nbytes)
+
+        dtype = get_storage_dtype(self.metadata.dtype)
+        if self.metadata.compression != "none":
+            acts = CompressedShard(
+                acts_fpath,
+                self.index[shard],
+                self.metadata,
+                chunks=self._chunks,
+                max_chunks=self.cfg.max_cached_chunks,
+            )
+        elif self.shuffled:
+            acts = np.memmap(acts_fpath, mode="c", dtype=dtype, shape=shape)
+        else:
+            acts = open_shard(
+                acts_fpath,
+                mode="c",
+                dtype=dtype,
+                shape=shape,
+                layout=self.metadata.layout,
+            )
+
+        self._shards[shard] = acts
+        while len(self._shards) > self.cfg.max_open_shards:
+            self._shards.popitem(last=False)
+
+        return acts
+
+    def __getstate__(self) -> dict[str, object]:
+        # Pickling a memmap copies its entire contents, so never send open shards to (spawned) workers.
+        state = self.__dict__.copy()
+        state["_shards"] = collections.OrderedDict()
+        state["_chunks"] = collections.OrderedDict()
+        state["_example_i"] = None
+        state["_side_files"] = {}
+        return state
 
     def __len__(self) -> int:
         """
@@ -542,28 +1593,460 @@ class Dataset(torch.utils.data.Dataset):
                 typing.assert_never((self.cfg.patches, self.cfg.layer))
 
 
-##########
-# IMAGES #
-##########
-
-
 @beartype.beartype
-def setup(cfg: config.Activations):
+def collate(batch: Dataset.Batch | list[Dataset.Example]) -> Dataset.Batch:
     """
-    Run dataset-specific setup. These setup functions can assume they are the only job running, but they should be idempotent; they should be safe (and ideally cheap) to run multiple times in a row.
+    `collate_fn` for DataLoaders over a `Dataset`. `Dataset.__getitems__` already returns a collated batch, so we pass it through untouched, falling back to the default collation for lists of examples.
     """
-    if isinstance(cfg.data, config.ImagenetDataset):
-        setup_imagenet(cfg)
-    elif isinstance(cfg.data, config.ImageFolderDataset):
-        setup_imagefolder(cfg)
-    elif isinstance(cfg.data, config.Ade20kDataset):
-        setup_ade20k(cfg)
-    else:
-        typing.assert_never(cfg.data)
+    if isinstance(batch, dict):
+        return batch
+
+    return torch.utils.data.default_collate(batch)
 
 
 @beartype.beartype
-def setup_imagenet(cfg: config.Activations):
+class InMemoryLoader:
+    """
+    Loads batches from every example of a `Dataset`, held in one tensor on `device` (see `Dataset.read_all`), by indexing that tensor directly, without a DataLoader's worker processes, collation or per-example Python. Unshuffled batches are slices, so they don't copy. Shuffled batches are drawn with a permutation generated on `device`, so with a GPU, batches never leave it.
+
+    Has the `batch_size` and `drop_last` attributes and `__len__` of a DataLoader, so it works with `training.BatchLimiter`.
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        *,
+        batch_size: int,
+        shuffle: bool,
+        seed: int = 0,
+        drop_last: bool = False,
+        device: str = "cpu",
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.device = device
+        self.memory = dataset.read_all(device=device)
+        self.epoch = 0
+
+    def __len__(self) -> int:
+        n = len(self.memory["act"])
+        if self.drop_last:
+            return n // self.batch_size
+        return math.ceil(n / self.batch_size)
+
+    def __iter__(self) -> collections.abc.Iterator[Dataset.Batch]:
+        n = len(self.memory["act"])
+        perm = None
+        if self.shuffle:
+            # Each epoch gets a different, but reproducible, order.
+            generator = torch.Generator(device=self.device)
+            generator.manual_seed(self.seed + self.epoch)
+            perm = torch.randperm(n, generator=generator, device=self.device)
+        self.epoch += 1
+
+        for b in range(len(self)):
+            start, end = b * self.batch_size, min((b + 1) * self.batch_size, n)
+            if perm is None:
+                yield Dataset.Batch(**{
+                    key: tensor[start:end] for key, tensor in self.memory.items()
+                })
+                continue
+
+            i_B = perm[start:end]
+            batch = {}
+            for key, tensor in self.memory.items():
+                # Gather into pinned memory if the activations are pinned, so copying the batch to the GPU can be asynchronous.
+                out = torch.empty(
+                    (len(i_B), *tensor.shape[1:]),
+                    dtype=tensor.dtype,
+                    device=tensor.device,
+                    pin_memory=tensor.is_pinned(),
+                )
+                batch[key] = torch.index_select(tensor, 0, i_B, out=out)
+            yield Dataset.Batch(**batch)
+
+
+@beartype.beartype
+class ShardReader:
+    """
+    Reads every example of a `Dataset` in order, in batches, in the current process, for sequential passes like evaluation and visuals (see `config.DataLoad.prefetch`).
+
+    Reading shards in order with a DataLoader stalls on page faults, especially at shard boundaries. Instead, when we start a shard, we tell the kernel we'll read it sequentially (`madvise` and `posix_fadvise`), ask for the next shard (`WILLNEED`) and read the next shard's bytes in a background thread so they are in the page cache by the time we get there. With `drop_behind`, we also drop the pages we've already read from the page cache so a pass over shards bigger than RAM doesn't evict everything else.
+
+    Has the `batch_size` and `drop_last` attributes and `__len__` of a DataLoader. After (or during) iteration, `n_bytes_read` is the number of shard bytes the batches covered, `n_bytes_prefetched` is the number of bytes the background thread read and `stall_s` is how long we spent waiting for batches.
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        *,
+        batch_size: int,
+        drop_last: bool = False,
+        drop_behind: bool = True,
+        chunk_size: int = 16 * 1024**2,
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.drop_behind = drop_behind
+        self.chunk_size = chunk_size
+
+        self.n_bytes_read = 0
+        self.n_bytes_prefetched = 0
+        self.stall_s = 0.0
+        self._thread = None
+
+        # Unit (image, or patch for shuffled activations) of each example; shards hold n_imgs_per_shard units.
+        self._n_examples_per_unit = 1
+        if dataset.cfg.patches == "patches" and not dataset.shuffled:
+            self._n_examples_per_unit = dataset.metadata.n_patches_per_img
+        # Pooled side files and in-memory datasets don't read shards.
+        self._reads_shards = (
+            dataset.memory is None and dataset.get_pooled(np.array([0])) is None
+        )
+
+    def __len__(self) -> int:
+        n = len(self.dataset)
+        if self.drop_last:
+            return n // self.batch_size
+        return math.ceil(n / self.batch_size)
+
+    def __iter__(self) -> collections.abc.Iterator[Dataset.Batch]:
+        md = self.dataset.metadata
+        n = len(self.dataset)
+        current = -1
+        for b in range(len(self)):
+            start, end = b * self.batch_size, min((b + 1) * self.batch_size, n)
+            first = start // self._n_examples_per_unit
+            last = (end - 1) // self._n_examples_per_unit
+
+            if self._reads_shards:
+                for shard in range(current + 1, last // md.n_imgs_per_shard + 1):
+                    self.start_shard(shard)
+                    current = shard
+
+            stall_start = time.perf_counter()
+            batch = self.dataset.__getitems__(list(range(start, end)))
+            self.stall_s += time.perf_counter() - stall_start
+
+            if self._reads_shards:
+                self.n_bytes_read += self.get_nbytes(first, last + 1)
+                if self.drop_behind:
+                    # Everything before the next batch's first unit has been read.
+                    next_first = end // self._n_examples_per_unit
+                    shard = next_first // md.n_imgs_per_shard
+                    if shard < md.n_shards:
+                        pos = next_first % md.n_imgs_per_shard
+                        self.advise(shard, 0, pos, "DONTNEED")
+
+            yield batch
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        logger.info(
+            "Read %.1f MB (%.1f MB prefetched) and waited %.1fs for batches.",
+            self.n_bytes_read / 1e6,
+            self.n_bytes_prefetched / 1e6,
+            self.stall_s,
+        )
+
+    def start_shard(self, shard: int) -> None:
+        """
+        Hint that we're about to read `shard` sequentially, drop the previous shard and prefetch the next one.
+        """
+        md = self.dataset.metadata
+        self.advise(shard, 0, self.get_n_units(shard), "SEQUENTIAL")
+        if self.drop_behind and shard > 0:
+            self.advise(shard - 1, 0, self.get_n_units(shard - 1), "DONTNEED")
+        if md.compression != "none":
+            # We can't tell which bytes a batch needs, so count the whole file.
+            self.n_bytes_read += os.path.getsize(self.get_fpath(shard))
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if shard + 1 < md.n_shards:
+            self.advise(shard + 1, 0, self.get_n_units(shard + 1), "WILLNEED")
+            self._thread = threading.Thread(
+                target=self.prefetch, args=(shard + 1,), daemon=True
+            )
+            self._thread.start()
+
+    def prefetch(self, shard: int) -> None:
+        """
+        Read the bytes of `shard` that we'll need into the page cache, `chunk_size` bytes at a time.
+        """
+        buf = memoryview(bytearray(self.chunk_size))
+        with open(self.get_fpath(shard), "rb", buffering=0) as fd:
+            for offset, length in self.get_ranges(shard, 0, self.get_n_units(shard)):
+                end = offset + length
+                while offset < end:
+                    n = os.preadv(fd.fileno(), [buf[: end - offset]], offset)
+                    if n <= 0:
+                        break
+                    offset += n
+                    self.n_bytes_prefetched += n
+
+    def advise(self, shard: int, first: int, last: int, advice: str) -> None:
+        """
+        Give the kernel `advice` ('SEQUENTIAL', 'WILLNEED' or 'DONTNEED') about the bytes of units `[first, last)` of `shard`: `posix_fadvise` for the page cache and, if we have the shard memory-mapped, `madvise` for our mapping. Mapped pages can't leave the page cache, so 'DONTNEED' needs both. Does nothing on platforms without them.
+        """
+        if last <= first:
+            return
+        ranges = self.get_ranges(shard, first, last)
+
+        buf = self.dataset._shards.get(shard)
+        while isinstance(buf, np.ndarray):
+            buf = buf.base
+        if isinstance(buf, mmap.mmap) and hasattr(mmap, f"MADV_{advice}"):
+            for offset, length in ranges:
+                # madvise needs page-aligned ranges; only advise whole pages inside the range.
+                start = -(-offset // mmap.PAGESIZE) * mmap.PAGESIZE
+                end = (offset + length) // mmap.PAGESIZE * mmap.PAGESIZE
+                if start < end:
+                    buf.madvise(getattr(mmap, f"MADV_{advice}"), start, end - start)
+
+        if hasattr(os, "posix_fadvise"):
+            with open(self.get_fpath(shard), "rb") as fd:
+                for offset, length in ranges:
+                    os.posix_fadvise(
+                        fd.fileno(), offset, length, getattr(os, f"POSIX_FADV_{advice}")
+                    )
+
+    def get_fpath(self, shard: int) -> str:
+        fname = f"acts{shard:06}.bin"
+        if self.dataset._cache is not None:
+            return self.dataset._cache.resolve(fname)
+        return os.path.join(self.dataset.cfg.shard_root, fname)
+
+    def get_n_units(self, shard: int) -> int:
+        md = self.dataset.metadata
+        if self.dataset.index is not None:
+            return self.dataset.index[shard].shape[0]
+        return md.get_shard_shape(shard)[0]
+
+    def get_ranges(self, shard: int, first: int, last: int) -> list[tuple[int, int]]:
+        """
+        Get the `(offset, length)` byte ranges of `shard` that hold units `[first, last)` of the layers we read. Compressed shards are always the whole file.
+        """
+        md = self.dataset.metadata
+        if md.compression != "none":
+            return [(0, os.path.getsize(self.get_fpath(shard)))]
+
+        row_nbytes = (
+            get_row_size(md.dtype, md.d_vit) * get_storage_dtype(md.dtype).itemsize
+        )
+        if self.dataset.shuffled:
+            return [(first * row_nbytes, (last - first) * row_nbytes)]
+
+        n_layers = len(md.layers)
+        img_nbytes = (md.n_patches_per_img + int(md.cls_token)) * row_nbytes
+        if md.layout == "img-major":
+            unit_nbytes = n_layers * img_nbytes
+            return [(first * unit_nbytes, (last - first) * unit_nbytes)]
+
+        layers = range(n_layers)
+        if isinstance(self.dataset.cfg.layer, int):
+            layers = [self.dataset.layer_index]
+        layer_nbytes = self.get_n_units(shard) * img_nbytes
+        return [
+            (layer * layer_nbytes + first * img_nbytes, (last - first) * img_nbytes)
+            for layer in layers
+        ]
+
+    def get_nbytes(self, first: int, last: int) -> int:
+        """Number of shard bytes that hold units `[first, last)` (which may span shards). Compressed shards are counted in `start_shard` instead."""
+        if self.dataset.metadata.compression != "none":
+            return 0
+
+        n_imgs_per_shard = self.dataset.metadata.n_imgs_per_shard
+        nbytes = 0
+        while first < last:
+            shard = first // n_imgs_per_shard
+            end = min(last, (shard + 1) * n_imgs_per_shard)
+            ranges = self.get_ranges(
+                shard, first % n_imgs_per_shard, end - shard * n_imgs_per_shard
+            )
+            nbytes += sum(length for _, length in ranges)
+            first = end
+        return nbytes
+
+
+@beartype.beartype
+def get_sequential_loader(
+    dataset: Dataset, *, batch_size: int, n_workers: int, drop_last: bool = False
+) -> InMemoryLoader | ShardReader | torch.utils.data.DataLoader:
+    """
+    Get a loader that reads every example of `dataset` in order: an `InMemoryLoader` with `cfg.in_memory`, a `ShardReader` with `cfg.prefetch` and otherwise a DataLoader with `n_workers` workers.
+    """
+    if dataset.cfg.in_memory:
+        return InMemoryLoader(
+            dataset, batch_size=batch_size, shuffle=False, drop_last=drop_last
+        )
+    if dataset.cfg.prefetch:
+        return ShardReader(dataset, batch_size=batch_size, drop_last=drop_last)
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=n_workers,
+        drop_last=drop_last,
+        collate_fn=collate,
+    )
+
+
+@jaxtyped(typechecker=beartype.beartype)
+class StreamingDataset(torch.utils.data.IterableDataset):
+    """
+    Infinite stream of shuffled batches from a `Dataset`.
+
+    Uniformly random access (`shuffle=True` over a `Dataset`) turns the sequential shard layout into random 4KB reads, which is fine while the shards fit in the page cache and limited by disk IOPS once they don't. Instead, each epoch we visit the shards in a random order, read each shard's chunks of `n_examples_per_chunk` consecutive examples in a random order, and mix the chunks in an in-memory shuffle buffer that batches are sampled from without replacement.
+
+    With DataLoader workers, each worker reads every `n_workers`-th chunk into its own buffer of `buffer_size // n_workers` examples. All randomness is seeded by `seed`, the epoch and the worker ID, so the stream is deterministic for a fixed number of workers.
+
+    Since this dataset yields whole batches, use it with `torch.utils.data.DataLoader(..., batch_size=None)`. Use `get_randomness` to check how well-mixed the batches are.
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        *,
+        batch_size: int,
+        buffer_size: int,
+        n_examples_per_chunk: int,
+        seed: int,
+    ):
+        if buffer_size < batch_size:
+            raise ValueError(
+                f"Shuffle buffer ({buffer_size}) must be at least as big as a batch ({batch_size})."
+            )
+
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.n_examples_per_chunk = n_examples_per_chunk
+        self.seed = seed
+
+    @property
+    def n_examples_per_shard(self) -> int:
+        metadata = self.dataset.metadata
+        if self.dataset.cfg.patches == "patches" and not self.dataset.shuffled:
+            return metadata.n_imgs_per_shard * metadata.n_patches_per_img
+        return metadata.n_imgs_per_shard
+
+    def get_chunks(self, epoch: int) -> Int[np.ndarray, "n_chunks 2"]:
+        """
+        Get the `[start, end)` example ranges to read during epoch `epoch`, in order. Chunks never cross shard boundaries.
+        """
+        n, per_shard = len(self.dataset), self.n_examples_per_shard
+
+        starts = np.concatenate([
+            np.arange(
+                shard_start, min(shard_start + per_shard, n), self.n_examples_per_chunk
+            )
+            for shard_start in range(0, n, per_shard)
+        ])
+        shards = starts // per_shard
+        ends = np.minimum(
+            np.minimum(starts + self.n_examples_per_chunk, (shards + 1) * per_shard), n
+        )
+
+        rng = np.random.default_rng(seed=(self.seed, epoch))
+        shard_rank = rng.permutation(shards.max() + 1)
+        # Sort by (random shard rank, random number) so that each shard's chunks are read together, in a random order.
+        order = np.lexsort((rng.random(len(starts)), shard_rank[shards]))
+        return np.stack((starts, ends), axis=1)[order]
+
+    def __iter__(self) -> collections.abc.Iterator[Dataset.Batch]:
+        worker = torch.utils.data.get_worker_info()
+        worker_id, n_workers = (
+            (0, 1) if worker is None else (worker.id, worker.num_workers)
+        )
+
+        capacity = max(self.buffer_size // n_workers, self.batch_size)
+        rng = np.random.default_rng(seed=(self.seed, worker_id))
+        buffer = self.dataset.Batch(
+            act=torch.empty((capacity, self.dataset.d_vit)),
+            image_i=torch.empty(capacity, dtype=torch.int64),
+            patch_i=torch.empty(capacity, dtype=torch.int64),
+        )
+        n_filled = 0
+
+        for epoch in itertools.count():
+            chunks = self.get_chunks(epoch)[worker_id::n_workers]
+            if not len(chunks):
+                # More workers than chunks; this worker has nothing to read.
+                return
+
+            for start, end in chunks.tolist():
+                chunk = self.dataset.__getitems__(list(range(start, end)))
+                n_chunk, cursor = end - start, 0
+                while cursor < n_chunk:
+                    n_take = min(capacity - n_filled, n_chunk - cursor)
+                    for key, value in buffer.items():
+                        value[n_filled : n_filled + n_take] = chunk[key][
+                            cursor : cursor + n_take
+                        ]
+                    n_filled += n_take
+                    cursor += n_take
+
+                    if n_filled < capacity:
+                        continue
+
+                    slots = rng.choice(capacity, size=self.batch_size, replace=False)
+                    yield self.dataset.Batch(**{
+                        key: value[slots] for key, value in buffer.items()
+                    })
+
+                    # Fill the holes we just sampled with the examples at the end of the buffer.
+                    n_filled = capacity - self.batch_size
+                    taken = np.zeros(capacity, dtype=bool)
+                    taken[slots] = True
+                    holes = np.flatnonzero(taken[:n_filled])
+                    movers = np.flatnonzero(~taken[n_filled:]) + n_filled
+                    for value in buffer.values():
+                        value[holes] = value[movers]
+
+
+@jaxtyped(typechecker=beartype.beartype)
+def get_randomness(image_i: Int[Tensor, " batch"], n_imgs: int) -> float:
+    """
+    Measure how random a batch of examples is: the number of distinct images in the batch divided by the number of distinct images we expect if the batch were sampled uniformly at random from `n_imgs` images.
+
+    A fully random shuffle scores about 1.0. Reading patches in order scores about `1 / n_patches_per_img`, since every image contributes all of its patches to the same batch. This is most meaningful for `patches="patches"`; when every example is a different image, every order scores 1.0.
+    """
+    expected = n_imgs * (1 - (1 - 1 / n_imgs) ** len(image_i))
+    return len(torch.unique(image_i)) / expected
+
+
+##########
+# IMAGES #
+##########
+
+
+@beartype.beartype
+def setup(cfg: config.Activations):
+    """
+    Run dataset-specific setup. These setup functions can assume they are the only job running, but they should be idempotent; they should be safe (and ideally cheap) to run multiple times in a row.
+    """
+    if isinstance(cfg.data, config.ImagenetDataset):
+        setup_imagenet(cfg)
+    elif isinstance(cfg.data, config.ImageFolderDataset):
+        setup_imagefolder(cfg)
+    elif isinstance(cfg.data, config.Ade20kDataset):
+        setup_ade20k(cfg)
+    elif isinstance(cfg.data, config.ResizedDataset):
+        pass
+    else:
+        typing.assert_never(cfg.data)
+
+
+@beartype.beartype
+def setup_imagenet(cfg: config.Activations):
     assert isinstance(cfg.data, config.ImagenetDataset)
 
 
@@ -584,44 +2067,63 @@ def setup_ade20k(cfg: config.Activations):
 
 
 @beartype.beartype
-def get_dataset(cfg: config.DatasetConfig, *, img_transform):
+def get_dataset(cfg: config.DatasetConfig, *, img_transform, draft_jpegs: bool = False):
     """
     Gets the dataset for the current experiment; delegates construction to dataset-specific functions.
 
     Args:
         cfg: Experiment config.
         img_transform: Image transform to be applied to each image.
+        draft_jpegs: Whether to decode JPEGs at a reduced scale that `img_transform` resizes to anyway; see `config.Activations.draft_jpegs`.
 
     Returns:
-        A dataset that has dictionaries with `'image'`, `'index'`, `'target'`, and `'label'` keys containing examples.
+        A dataset that has dictionaries with `'image'`, `'index'`, `'target'`, `'label'` and `'decode_s'` (seconds spent decoding the image) keys containing examples.
     """
+    min_size = get_min_img_size(img_transform) if draft_jpegs else None
     if isinstance(cfg, config.ImagenetDataset):
-        return Imagenet(cfg, img_transform=img_transform)
+        return Imagenet(cfg, img_transform=img_transform, min_size=min_size)
     elif isinstance(cfg, config.Ade20kDataset):
-        return Ade20k(cfg, img_transform=img_transform)
+        return Ade20k(cfg, img_transform=img_transform, min_size=min_size)
     elif isinstance(cfg, config.ImageFolderDataset):
-        return ImageFolder(cfg.root, transform=img_transform)
+        return ImageFolder(cfg.root, transform=img_transform, min_size=min_size)
+    elif isinstance(cfg, config.ResizedDataset):
+        return ResizedImgs(cfg, img_transform=img_transform)
     else:
         typing.assert_never(cfg)
 
 
 @beartype.beartype
-def get_dataloader(cfg: config.Activations, *, img_transform=None):
+def get_dataloader(
+    cfg: config.Activations,
+    *,
+    img_transform=None,
+    start: int = 0,
+    stop: int | None = None,
+):
     """
     Gets the dataloader for the current experiment; delegates dataloader construction to dataset-specific functions.
 
     Args:
         cfg: Experiment config.
         img_transform: Image transform to be applied to each image.
+        start: Index of the first image to load.
+        stop: Index after the last image to load, or None to load every image after `start`.
 
     Returns:
         A PyTorch Dataloader that yields dictionaries with `'image'` keys containing image batches.
     """
     if isinstance(
         cfg.data,
-        (config.ImagenetDataset, config.ImageFolderDataset, config.Ade20kDataset),
+        (
+            config.ImagenetDataset,
+            config.ImageFolderDataset,
+            config.Ade20kDataset,
+            config.ResizedDataset,
+        ),
     ):
-        dataloader = get_default_dataloader(cfg, img_transform=img_transform)
+        dataloader = get_default_dataloader(
+            cfg, img_transform=img_transform, start=start, stop=stop
+        )
     else:
         typing.assert_never(cfg.data)
 
@@ -630,7 +2132,11 @@ def get_dataloader(cfg: config.Activations, *, img_transform=None):
 
 @beartype.beartype
 def get_default_dataloader(
-    cfg: config.Activations, *, img_transform: Callable
+    cfg: config.Activations,
+    *,
+    img_transform: Callable,
+    start: int = 0,
+    stop: int | None = None,
 ) -> torch.utils.data.DataLoader:
     """
     Get a dataloader for a default map-style dataset.
@@ -638,11 +2144,18 @@ def get_default_dataloader(
     Args:
         cfg: Config.
         img_transform: Image transform to be applied to each image.
+        start: Index of the first image to load.
+        stop: Index after the last image to load, or None to load every image after `start`.
 
     Returns:
         A PyTorch Dataloader that yields dictionaries with `'image'` keys containing image batches, `'index'` keys containing original dataset indices and `'label'` keys containing label batches.
     """
-    dataset = get_dataset(cfg.data, img_transform=img_transform)
+    dataset = get_dataset(
+        cfg.data, img_transform=img_transform, draft_jpegs=cfg.draft_jpegs
+    )
+    stop = len(dataset) if stop is None else min(stop, len(dataset))
+    if start > 0 or stop < len(dataset):
+        dataset = torch.utils.data.Subset(dataset, range(start, stop))
 
     dataloader = torch.utils.data.DataLoader(
         dataset=dataset,
@@ -658,21 +2171,35 @@ def get_default_dataloader(
 
 @beartype.beartype
 class Imagenet(torch.utils.data.Dataset):
-    def __init__(self, cfg: config.ImagenetDataset, *, img_transform=None):
+    def __init__(
+        self,
+        cfg: config.ImagenetDataset,
+        *,
+        img_transform=None,
+        min_size: int | None = None,
+    ):
         import datasets
 
         self.hf_dataset = datasets.load_dataset(
             cfg.name, split=cfg.split, trust_remote_code=True
         )
+        # We decode images ourselves; see `load_img`.
+        self.hf_dataset = self.hf_dataset.cast_column(
+            "image", datasets.Image(decode=False)
+        )
 
         self.img_transform = img_transform
+        self.min_size = min_size
         self.labels = self.hf_dataset.info.features["label"].names
 
     def __getitem__(self, i):
         example = self.hf_dataset[i]
         example["index"] = i
 
-        example["image"] = example["image"].convert("RGB")
+        start_s = time.perf_counter()
+        img = example["image"]
+        example["image"] = load_img(img["bytes"] or img["path"], min_size=self.min_size)
+        example["decode_s"] = time.perf_counter() - start_s
         if self.img_transform:
             example["image"] = self.img_transform(example["image"])
         example["target"] = example.pop("label")
@@ -686,16 +2213,31 @@ class Imagenet(torch.utils.data.Dataset):
 
 @beartype.beartype
 class ImageFolder(torchvision.datasets.ImageFolder):
+    def __init__(self, root: str, *, min_size: int | None = None, **kwargs):
+        """
+        Args:
+            root: Root directory, with a subdirectory of images for each class.
+            min_size: If set, decode JPEGs at a reduced scale; see `load_img`.
+            kwargs: Passed to `torchvision.datasets.ImageFolder`.
+        """
+        super().__init__(root, **kwargs)
+        self.min_size = min_size
+
     def __getitem__(self, index: int) -> dict[str, object]:
         """
         Args:
             index: Index
 
         Returns:
-            dict with keys 'image', 'index', 'target' and 'label'.
+            dict with keys 'image', 'index', 'target', 'label' and 'decode_s'.
         """
         path, target = self.samples[index]
-        sample = self.loader(path)
+        start_s = time.perf_counter()
+        if self.loader is torchvision.datasets.folder.default_loader:
+            sample = load_img(path, min_size=self.min_size)
+        else:
+            sample = self.loader(path)
+        decode_s = time.perf_counter() - start_s
         if self.transform is not None:
             sample = self.transform(sample)
         if self.target_transform is not None:
@@ -706,6 +2248,7 @@ class ImageFolder(torchvision.datasets.ImageFolder):
             "target": target,
             "label": self.classes[target],
             "index": index,
+            "decode_s": decode_s,
         }
 
 
@@ -727,6 +2270,7 @@ class Ade20k(torch.utils.data.Dataset):
         *,
         img_transform: Callable | None = None,
         seg_transform: Callable | None = lambda x: None,
+        min_size: int | None = None,
     ):
         self.logger = logging.getLogger("ade20k")
         self.cfg = cfg
@@ -734,6 +2278,7 @@ class Ade20k(torch.utils.data.Dataset):
         self.seg_dir = os.path.join(cfg.root, "annotations")
         self.img_transform = img_transform
         self.seg_transform = seg_transform
+        self.min_size = min_size
 
         # Check that we have the right path.
         for subdir in ("images", "annotations"):
@@ -749,7 +2294,6 @@ class Ade20k(torch.utils.data.Dataset):
         split_lookup: dict[int, str] = {
             value: key for key, value in split_mapping.items()
         }
-        self.loader = torchvision.datasets.folder.default_loader
 
         assert cfg.split in set(split_lookup.values())
 
@@ -790,7 +2334,9 @@ class Ade20k(torch.utils.data.Dataset):
         # Convert to dict.
         sample = dataclasses.asdict(self.samples[index])
 
-        sample["image"] = self.loader(sample.pop("img_path"))
+        start_s = time.perf_counter()
+        sample["image"] = load_img(sample.pop("img_path"), min_size=self.min_size)
+        sample["decode_s"] = time.perf_counter() - start_s
         if self.img_transform is not None:
             image = self.img_transform(sample.pop("image"))
             if image is not None:
@@ -816,13 +2362,17 @@ class Ade20k(torch.utils.data.Dataset):
 
 
 @beartype.beartype
-def main(cfg: config.Activations):
+def main(cfg: config.Activations | list[config.Activations]):
     """
     Args:
-        cfg: Config for activations.
+        cfg: Config for activations, or one config per model to dump in the same pass over the images (see `check_models`).
     """
     logger = logging.getLogger("dump")
 
+    cfgs = cfg if isinstance(cfg, list) else [cfg]
+    check_models(cfgs)
+    cfg = cfgs[0]
+
     if not cfg.ssl:
         logger.warning("Ignoring SSL certs. Try not to do this!")
         # https://github.com/openai/whisper/discussions/734#discussioncomment-4491761
@@ -834,6 +2384,15 @@ def main(cfg: config.Activations):
     # Run any setup steps.
     setup(cfg)
 
+    # Every job dumps at least one shard of every model.
+    n_shards = min(Metadata.from_cfg(c).n_shards for c in cfgs)
+    n_jobs = max(1, min(cfg.n_jobs, n_shards))
+    cfgs = [dataclasses.replace(c, n_jobs=n_jobs) for c in cfgs]
+    jobs = [None] if n_jobs == 1 else list(range(n_jobs))
+    if n_jobs > 1:
+        for c in cfgs:
+            prepare_jobs(c)
+
     # Actually record activations.
     if cfg.slurm:
         import submitit
@@ -848,19 +2407,66 @@ def main(cfg: config.Activations):
             account=cfg.slurm_acct,
         )
 
-        job = executor.submit(worker_fn, cfg)
-        logger.info("Running job '%s'.", job.job_id)
-        job.result()
+        if n_jobs == 1:
+            job = executor.submit(worker_fn, cfgs)
+            logger.info("Running job '%s'.", job.job_id)
+            job.result()
+        else:
+            array = executor.map_array(worker_fn, [cfgs] * n_jobs, jobs)
+            logger.info("Running %d jobs in array '%s'.", n_jobs, array[0].job_id)
+            for job in array:
+                job.result()
+
+    elif n_jobs == 1:
+        worker_fn(cfgs)
 
     else:
-        worker_fn(cfg)
+        # CUDA doesn't survive a fork.
+        ctx = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(n_jobs, mp_context=ctx) as pool:
+            for _ in pool.map(worker_fn, [cfgs] * n_jobs, jobs):
+                pass
+
+    if n_jobs > 1:
+        for c in cfgs:
+            assemble_jobs(c)
+
+
+@beartype.beartype
+def check_models(cfgs: list[config.Activations]):
+    """
+    Check that configs for several models can be dumped in one pass over the images: they only differ in `config.MODEL_FIELDS` and each model has its own shard directory.
+
+    Raises:
+        ValueError: if they can't.
+    """
+    if not cfgs:
+        raise ValueError("No models to dump.")
+
+    for cfg in cfgs[1:]:
+        for field in dataclasses.fields(cfg):
+            if field.name in config.MODEL_FIELDS:
+                continue
+            if getattr(cfg, field.name) != getattr(cfgs[0], field.name):
+                raise ValueError(
+                    f"Models dumped together must share '{field.name}', but {getattr(cfgs[0], field.name)!r} != {getattr(cfg, field.name)!r}."
+                )
+
+    hashes = [Metadata.from_cfg(cfg).hash for cfg in cfgs]
+    if len(set(hashes)) != len(hashes):
+        raise ValueError(
+            "Two models have the same config and would write the same shards."
+        )
 
 
 @beartype.beartype
-def worker_fn(cfg: config.Activations):
+def worker_fn(
+    cfgs: config.Activations | list[config.Activations], job: int | None = None
+):
     """
     Args:
-        cfg: Config for activations.
+        cfgs: Config for activations, or one config per model. Models share one pass over the images: we load and decode every image once, and apply each model's image transform to it.
+        job: Which of `cfg.n_jobs` parallel jobs this is, or None to dump every shard.
     """
 
     if torch.cuda.is_available():
@@ -871,37 +2477,99 @@ def worker_fn(cfg: config.Activations):
         torch.backends.cudnn.benchmark = True
         torch.backends.cudnn.deterministic = False
 
-    logger = logging.getLogger("dump")
-
-    vit = WrappedVisionTransformer(cfg)
-    img_transform = make_img_transform(cfg.model_family, cfg.model_ckpt)
-    dataloader = get_dataloader(cfg, img_transform=img_transform)
-
-    writer = ShardWriter(cfg)
-
-    n_batches = cfg.data.n_imgs // cfg.vit_batch_size + 1
-    logger.info("Dumping %d batches of %d examples.", n_batches, cfg.vit_batch_size)
-
-    if cfg.device == "cuda" and not torch.cuda.is_available():
+    logger = logging.getLogger("dump" if job is None else f"dump-{job}")
+
+    cfgs = cfgs if isinstance(cfgs, list) else [cfgs]
+    todo = []
+    for c in cfgs:
+        writer = ShardWriter(c, job=job)
+        if writer.start >= writer.end:
+            logger.info(
+                "Images [%d, %d) are already dumped for '%s'.",
+                writer.first,
+                writer.end,
+                c.model_ckpt,
+            )
+            continue
+        if writer.start > writer.first:
+            logger.info("Resuming '%s' from image %d.", c.model_ckpt, writer.start)
+        todo.append((c, writer))
+    if not todo:
+        return
+    # Every field but the model's is the same for every config.
+    cfg = todo[0][0]
+
+    # With parallel jobs, each model's shards (and so each job's images) start at different images; we load every image that any model needs.
+    bounds = [(writer.start, writer.end) for _, writer in todo]
+    first = min(a for a, _ in bounds)
+    end = max(b for _, b in bounds)
+    # Start and stop at ViT batch boundaries, so that every image is in the same batch as in an uninterrupted, single-job run.
+    start = first // cfg.vit_batch_size * cfg.vit_batch_size
+    stop = math.ceil(end / cfg.vit_batch_size) * cfg.vit_batch_size
+
+    device = cfg.device
+    if device == "cuda" and not torch.cuda.is_available():
         logger.warning("No CUDA device available, using CPU.")
-        cfg = dataclasses.replace(cfg, device="cpu")
+        device = "cpu"
+    elif device == "cuda" and job is not None and not cfg.slurm:
+        # Spread local jobs over the local GPUs.
+        device = f"cuda:{job % torch.cuda.device_count()}"
+
+    vits, writers, img_transforms, img_normalizes = [], [], [], []
+    for c, writer in todo:
+        vit = WrappedVisionTransformer(c, host_buffers=c.host_buffers)
+        vits.append(vit.to(device))
+        # vit = torch.compile(vit)
+        img_transform = make_img_transform(c.model_family, c.model_ckpt)
+        img_normalize = None
+        if cfg.uint8_imgs:
+            img_transform, img_normalize = split_img_transform(img_transform)
+        img_transforms.append(img_transform)
+        img_normalizes.append(img_normalize)
+        if cfg.write_queue_size > 0:
+            writer = AsyncShardWriter(writer, cfg.write_queue_size)
+        writers.append(writer)
+
+    dataloader = get_dataloader(
+        cfg, img_transform=MultiTransform(img_transforms), start=start, stop=stop
+    )
 
-    vit = vit.to(cfg.device)
-    # vit = torch.compile(vit)
+    n_batches = len(dataloader)
+    logger.info(
+        "Dumping %d batches of %d examples for %d model(s).",
+        n_batches,
+        cfg.vit_batch_size,
+        len(vits),
+    )
 
-    i = 0
+    i = start
+    decode_s, n_decoded = 0.0, 0
     # Calculate and write ViT activations.
     with torch.inference_mode():
         for batch in helpers.progress(dataloader, total=n_batches):
-            images = batch.pop("image").to(cfg.device)
-            # cache has shape [batch size, n layers, n patches + 1, d vit]
-            out, cache = vit(images)
-            del out
-
-            writer[i : i + len(cache)] = cache
-            i += len(cache)
-
-    writer.flush()
+            decode_s_B = batch.pop("decode_s")
+            decode_s += decode_s_B.sum().item()
+            n_decoded += len(decode_s_B)
+            images = batch.pop("image")
+            for vit, img_normalize, writer, (a, b), x in zip(
+                vits, img_normalizes, writers, bounds, images
+            ):
+                x = x.to(device)
+                if img_normalize is not None:
+                    x = img_normalize(x)
+                # cache has shape [batch size, n layers, n patches + 1, d vit]
+                out, cache = vit(x)
+                del out
+
+                # Only write this model's images; the batch can run into the next job's images.
+                a, b = max(a, i), min(b, i + len(cache))
+                if a < b:
+                    writer[a:b] = cache[a - i : b - i]
+            i += len(decode_s_B)
+
+    for writer in writers:
+        writer.flush()
+    logger.info("Decoding took %.2fms per image.", decode_s / max(n_decoded, 1) * 1000)
 
 
 @beartype.beartype
@@ -911,34 +2579,135 @@ class ShardWriter:
     """
 
     root: str
-    shape: tuple[int, int, int, int]
+    metadata: "Metadata"
     shard: int
     acts_path: str
-    acts: Float[np.ndarray, "n_imgs_per_shard n_layers all_patches d_vit"] | None
+    acts: Shaped[np.ndarray, "n_imgs_per_shard n_layers all_patches row"] | None
     filled: int
-
-    def __init__(self, cfg: config.Activations):
+    shards: "list[ShardInfo]"
+    """Index entries of the shards written so far."""
+    side_files: dict[str, Float[np.ndarray, "n_imgs n_layers d_vit"]]
+    """Side files of image-level activations; see `Activations.side_files`."""
+    stats: "dict[str, ActStats]"
+    """Running statistics of the [CLS] tokens ('cls') and patches ('patches') written so far; see `Activations.stats`."""
+    start: int
+    """Index of the first image to write. Images before `start` are in shards from an earlier, interrupted dump (see `Activations.resume`) and writes to them are ignored."""
+    shard_range: range
+    """Shards this writer writes; every shard, unless it is one of several parallel jobs (see `Activations.n_jobs`)."""
+    index_dpath: str
+    """Where to write the `shards.json` index and `act_stats.npz`. Parallel jobs each write their own in `jobs/` until `assemble_jobs` merges them."""
+
+    def __init__(self, cfg: config.Activations, *, job: int | None = None):
         self.logger = logging.getLogger("shard-writer")
 
-        self.root = get_acts_dir(cfg)
+        if cfg.compression != "none" and cfg.layout != "img-major":
+            raise ValueError("Compressed shards are always img-major.")
 
-        n_patches_per_img = cfg.n_patches_per_img
-        if cfg.cls_token:
-            n_patches_per_img += 1
-        self.n_imgs_per_shard = (
-            cfg.n_patches_per_shard // len(cfg.layers) // n_patches_per_img
-        )
-        self.shape = (
-            self.n_imgs_per_shard,
-            len(cfg.layers),
-            n_patches_per_img,
-            cfg.d_vit,
-        )
-
-        self.shard = -1
+        self.root = get_acts_dir(cfg)
+        self.metadata = Metadata.from_cfg(cfg)
+        self.n_imgs_per_shard = self.metadata.n_imgs_per_shard
+
+        self.shard_range = range(self.metadata.n_shards)
+        self.index_dpath = self.root
+        if job is not None:
+            self.shard_range = get_job_shards(self.metadata, cfg.n_jobs, job)
+            self.index_dpath = get_job_dir(self.root, job)
+            os.makedirs(self.index_dpath, exist_ok=True)
+
+        shards = self.get_finished_shards(cfg) if cfg.resume else []
+        self.start = self.first + len(shards) * self.n_imgs_per_shard
+
+        self.side_files = {}
+        names = ["cls", "meanpool"] if cfg.cls_token else ["meanpool"]
+        for name in ("cls", "meanpool"):
+            fpath = os.path.join(self.root, f"{name}.npy")
+            if cfg.side_files and name in names:
+                self.side_files[name] = np.lib.format.open_memmap(
+                    fpath,
+                    # Parallel jobs share side files that `prepare_jobs` made.
+                    mode="r+" if shards or job is not None else "w+",
+                    dtype=np.float32,
+                    shape=(cfg.data.n_imgs, len(cfg.layers), cfg.d_vit),
+                )
+            elif os.path.isfile(fpath) and job is None:
+                # Don't leave side files from an earlier dump next to new shards.
+                os.remove(fpath)
+
+        self.stats = {}
+        stats_fpath = os.path.join(self.index_dpath, "act_stats.npz")
+        if cfg.stats and shards:
+            self.stats = load_act_stats(self.index_dpath)
+        elif cfg.stats:
+            names = ["cls", "patches"] if cfg.cls_token else ["patches"]
+            self.stats = {
+                name: ActStats.empty(len(cfg.layers), cfg.d_vit) for name in names
+            }
+        elif os.path.isfile(stats_fpath):
+            os.remove(stats_fpath)
+
+        self.shard = self.shard_range.start + len(shards) - 1
         self.acts = None
+        self.shards = shards
         self.next_shard()
 
+    @property
+    def first(self) -> int:
+        """Index of this writer's first image."""
+        return self.shard_range.start * self.n_imgs_per_shard
+
+    @property
+    def end(self) -> int:
+        """Index after this writer's last image."""
+        return min(self.shard_range.stop * self.n_imgs_per_shard, self.metadata.n_imgs)
+
+    def get_finished_shards(self, cfg: config.Activations) -> "list[ShardInfo]":
+        """
+        Find the shards that an earlier, interrupted dump with the same config finished, according to the `shards.json` index, so we can resume after them. Shards only count if they are intact and the side files and statistics that the dump needs also cover them; otherwise we start over.
+        """
+        if not os.path.isfile(os.path.join(self.index_dpath, "shards.json")):
+            return []
+
+        shards = []
+        for i, shard in zip(self.shard_range, load_index(self.index_dpath)):
+            fpath = os.path.join(self.root, shard.fname)
+            if (
+                shard.fname != f"acts{i:06}.bin"
+                or shard.shape != self.metadata.get_shard_shape(i)
+                or not os.path.isfile(fpath)
+                or os.path.getsize(fpath) != shard.nbytes
+            ):
+                break
+            shards.append(shard)
+
+        names = ["cls", "meanpool"] if cfg.cls_token else ["meanpool"]
+        shape = (cfg.data.n_imgs, len(cfg.layers), cfg.d_vit)
+        for name in names if cfg.side_files else []:
+            fpath = os.path.join(self.root, f"{name}.npy")
+            if (
+                not os.path.isfile(fpath)
+                or np.load(fpath, mmap_mode="r").shape != shape
+            ):
+                return []
+
+        if cfg.stats:
+            # We save statistics right after the index, so they can be a shard behind.
+            stats = load_act_stats(self.index_dpath)
+            n_per_img = {"cls": 1, "patches": cfg.n_patches_per_img}
+            n_imgs = {name: stat.n // n_per_img[name] for name, stat in stats.items()}
+            names = ["cls", "patches"] if cfg.cls_token else ["patches"]
+            if sorted(stats) != names or len(set(n_imgs.values())) != 1:
+                return []
+            (n_imgs,) = set(n_imgs.values())
+            n_shards, rest = divmod(n_imgs, self.n_imgs_per_shard)
+            if self.first + n_imgs == self.end:
+                # The last shard may be smaller than the rest.
+                n_shards, rest = len(self.shard_range), 0
+            if rest or n_shards > len(shards):
+                return []
+            shards = shards[:n_shards]
+
+        return shards
+
     @jaxtyped(typechecker=beartype.beartype)
     def __setitem__(
         self, i: slice, val: Float[Tensor, "_ n_layers all_patches d_vit"]
@@ -946,13 +2715,30 @@ class ShardWriter:
         assert i.step is None
         a, b = i.start, i.stop
         assert len(val) == b - a
+        if a < self.start:
+            # Already written by an earlier dump.
+            n_skip = min(b, self.start) - a
+            a, val = a + n_skip, val[n_skip:]
+        if a == b:
+            return
+
+        if self.acts is None:
+            raise IndexError(
+                f"Can't write images [{a}, {b}); there are only {self.metadata.n_imgs} images."
+            )
 
         offset = self.n_imgs_per_shard * self.shard
+        # The last shard is smaller than the rest.
+        n_imgs = len(self.acts)
 
-        if b >= offset + self.n_imgs_per_shard:
+        if b >= offset + n_imgs:
             # We have run out of space in this mmap'ed file. Let's fill it as much as we can.
-            n_fit = offset + self.n_imgs_per_shard - a
-            self.acts[a - offset : a - offset + n_fit] = val[:n_fit]
+            n_fit = offset + n_imgs - a
+            self.acts[a - offset : a - offset + n_fit] = to_storage(
+                val[:n_fit], self.metadata.dtype
+            )
+            self.write_side_files(a, val[:n_fit])
+            self.update_stats(val[:n_fit])
             self.filled = a - offset + n_fit
 
             self.next_shard()
@@ -964,12 +2750,74 @@ class ShardWriter:
             assert 0 <= a - offset <= offset + self.n_imgs_per_shard, msg
             msg = f"0 <= {b} - {offset} <= {offset} + {self.n_imgs_per_shard}"
             assert 0 <= b - offset <= offset + self.n_imgs_per_shard, msg
-            self.acts[a - offset : b - offset] = val
+            self.acts[a - offset : b - offset] = to_storage(val, self.metadata.dtype)
+            self.write_side_files(a, val)
+            self.update_stats(val)
             self.filled = b - offset
 
+    @jaxtyped(typechecker=beartype.beartype)
+    def write_side_files(
+        self, start: int, val: Float[Tensor, "_ n_layers all_patches d_vit"]
+    ) -> None:
+        """
+        Write the [CLS] tokens and per-layer patch means of images `start`, `start + 1`, ... to the side files. We pool the float32 activations, so side files are exact even if the shards are stored in lower precision.
+        """
+        end = start + len(val)
+        n_cls = int(self.metadata.cls_token)
+        if "cls" in self.side_files:
+            self.side_files["cls"][start:end] = val[:, :, 0].numpy()
+        if "meanpool" in self.side_files:
+            self.side_files["meanpool"][start:end] = (
+                val[:, :, n_cls:].mean(dim=2).numpy()
+            )
+
+    @jaxtyped(typechecker=beartype.beartype)
+    def update_stats(self, val: Float[Tensor, "_ n_layers all_patches d_vit"]) -> None:
+        """
+        Add images to the running activation statistics. Like the side files, the statistics are of the float32 activations.
+        """
+        n_cls = int(self.metadata.cls_token)
+        if "cls" in self.stats:
+            self.stats["cls"].update(val[:, :, 0])
+        if "patches" in self.stats:
+            _, n_layers, _, d_vit = val.shape
+            patches = val[:, :, n_cls:].transpose(1, 2).reshape(-1, n_layers, d_vit)
+            self.stats["patches"].update(patches)
+
     def flush(self) -> None:
+        """
+        Close the current shard, add it to the `shards.json` index and save the statistics of every image written so far to `act_stats.npz`.
+        """
         if self.acts is not None:
             self.acts.flush()
+            chunk_offsets = ()
+            if self.metadata.compression != "none":
+                # We wrote the raw shard next to where the compressed shard goes.
+                fpath = os.path.join(self.root, f"acts{self.shard:06}.bin")
+                chunk_offsets = compress_shard(
+                    self.acts_path,
+                    fpath,
+                    metadata=self.metadata,
+                    shape=self.acts.shape,
+                )
+                del self.acts
+                os.remove(self.acts_path)
+
+            # The index marks the shard as finished (see `get_finished_shards`), so the side files have to be on disk first.
+            for side in self.side_files.values():
+                side.flush()
+            self.shards.append(
+                ShardInfo.from_shard(
+                    self.root, self.shard, self.metadata, chunk_offsets=chunk_offsets
+                )
+            )
+            dump_index(self.index_dpath, self.metadata, self.shards)
+
+        for side in self.side_files.values():
+            side.flush()
+
+        if self.stats:
+            dump_act_stats(self.index_dpath, self.stats)
 
         self.acts = None
 
@@ -978,15 +2826,290 @@ class ShardWriter:
 
         self.shard += 1
         self._count = 0
+        if self.shard >= self.shard_range.stop:
+            # Every image has a shard; any more writes are out of bounds.
+            return
+
         self.acts_path = os.path.join(self.root, f"acts{self.shard:06}.bin")
-        self.acts = np.memmap(
-            self.acts_path, mode="w+", dtype=np.float32, shape=self.shape
+        if self.metadata.compression != "none":
+            # Write the raw shard first, then compress it in flush().
+            self.acts_path = os.path.join(self.root, f"acts{self.shard:06}.raw")
+        self.acts = open_shard(
+            self.acts_path,
+            mode="w+",
+            dtype=get_storage_dtype(self.metadata.dtype),
+            shape=self.metadata.get_shard_shape(self.shard),
+            layout=self.metadata.layout,
         )
         self.filled = 0
 
         self.logger.info("Opened shard '%s'.", self.acts_path)
 
 
+@beartype.beartype
+class AsyncShardWriter:
+    """
+    Writes to a `ShardWriter` on a background thread, so that copying activations into shards and flushing full shards overlaps with the ViT's next batch (see `Activations.write_queue_size`).
+
+    Batches wait in a queue of at most `max_queue` batches; when the queue is full, `__setitem__` blocks until the writer catches up, which bounds memory. Errors on the writer thread are raised on the next call from the main thread. Every time the writer opens a new shard, it logs its write throughput, the mean queue depth and how long the main thread waited for it.
+    """
+
+    writer: ShardWriter
+    queue: "queue.Queue[tuple[slice, Tensor] | None]"
+    n_bytes_written: int
+    """Bytes of float32 activations written so far."""
+    write_s: float
+    """Seconds the writer thread spent writing."""
+    wait_s: float
+    """Seconds the main thread spent waiting for room in the queue."""
+    n_puts: int
+    """Number of batches queued so far."""
+    depth_sum: int
+    """Sum of the queue depth each time a batch was queued; see `mean_depth`."""
+
+    def __init__(self, writer: ShardWriter, max_queue: int):
+        self.logger = logging.getLogger("async-shard-writer")
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error: Exception | None = None
+
+        self.n_bytes_written = 0
+        self.write_s = 0.0
+        self.wait_s = 0.0
+        self.n_puts = 0
+        self.depth_sum = 0
+
+        self.thread = threading.Thread(
+            target=self.run, name="shard-writer", daemon=True
+        )
+        self.thread.start()
+
+    def __setitem__(
+        self, i: slice, val: Float[Tensor, "_ n_layers all_patches d_vit"]
+    ) -> None:
+        self.check()
+        self.depth_sum += self.queue.qsize()
+        self.n_puts += 1
+        start_s = time.perf_counter()
+        self.queue.put((i, val))
+        self.wait_s += time.perf_counter() - start_s
+
+    def run(self) -> None:
+        shard = self.writer.shard
+        while (item := self.queue.get()) is not None:
+            i, val = item
+            if self.error is not None:
+                # Drain the queue so the main thread never blocks on a dead writer.
+                continue
+
+            try:
+                start_s = time.perf_counter()
+                self.writer[i] = val
+                self.write_s += time.perf_counter() - start_s
+                self.n_bytes_written += val.numel() * val.element_size()
+            except Exception as err:
+                self.logger.exception(
+                    "Failed to write images [%d, %d).", i.start, i.stop
+                )
+                self.error = err
+                continue
+
+            if self.writer.shard != shard:
+                shard = self.writer.shard
+                self.log()
+
+    def log(self) -> None:
+        self.logger.info(
+            "Wrote %.1f MB/s; mean queue depth %.2f; waited %.1fs for the writer.",
+            self.n_bytes_written / max(self.write_s, 1e-9) / 1e6,
+            self.mean_depth,
+            self.wait_s,
+        )
+
+    @property
+    def mean_depth(self) -> float:
+        """Mean number of batches already waiting when a batch was queued. Close to the maximum means the writer is the bottleneck."""
+        return self.depth_sum / max(self.n_puts, 1)
+
+    def check(self) -> None:
+        if self.error is not None:
+            raise RuntimeError("Writing shards failed.") from self.error
+
+    def flush(self) -> None:
+        """
+        Wait for every queued batch, stop the writer thread and flush the `ShardWriter`.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check()
+        self.writer.flush()
+        self.log()
+
+
+@beartype.beartype
+@dataclasses.dataclass
+class ActStats:
+    """
+    Per-layer statistics of every activation of one token type ([CLS] tokens or patches), accumulated in float64 a batch at a time while dumping (see `Activations.stats`). `Dataset` normalizes with these instead of sampling the shards, and `get_abs_quantile` helps pick `DataLoad.clamp`.
+    """
+
+    n: int
+    """Number of activations per layer."""
+    mean: Float[np.ndarray, "n_layers d_vit"]
+    """Mean activation."""
+    m2: Float[np.ndarray, "n_layers d_vit"]
+    """Sum of squared differences from the mean; see `var`."""
+    min: Float[np.ndarray, "n_layers d_vit"]
+    """Smallest value of each dimension."""
+    max: Float[np.ndarray, "n_layers d_vit"]
+    """Largest value of each dimension."""
+    l2_mean: Float[np.ndarray, " n_layers"]
+    """Mean L2 norm."""
+    l2_mean_centered: Float[np.ndarray, " n_layers"]
+    """Mean L2 norm after subtracting the mean. Since we don't know the mean until every activation is written, each batch is centered with the running mean including that batch, which is off by up to the distance between the running and final means; that can be large when the images are in class order, so `Dataset` doesn't normalize with it."""
+    abs_hist: Int[np.ndarray, "n_layers n_bins"]
+    """Number of values whose absolute value is below `2 ** abs_bins[0]`, in `[2 ** abs_bins[i - 1], 2 ** abs_bins[i])` and at least `2 ** abs_bins[-1]`."""
+
+    abs_bins: typing.ClassVar[np.ndarray] = np.arange(-8, 17)
+    """log2 of the `abs_hist` bin edges."""
+
+    @classmethod
+    def empty(cls, n_layers: int, d_vit: int) -> "ActStats":
+        return cls(
+            0,
+            np.zeros((n_layers, d_vit)),
+            np.zeros((n_layers, d_vit)),
+            np.full((n_layers, d_vit), np.inf),
+            np.full((n_layers, d_vit), -np.inf),
+            np.zeros(n_layers),
+            np.zeros(n_layers),
+            np.zeros((n_layers, len(cls.abs_bins) + 1), dtype=np.int64),
+        )
+
+    @jaxtyped(typechecker=beartype.beartype)
+    def update(
+        self, x: Float[Tensor, "batch n_layers d_vit"], *, chunk_size: int = 16_384
+    ) -> None:
+        """
+        Add a batch of activations, `chunk_size` at a time to bound memory, merging each chunk's statistics with the running ones (Chan et al.'s parallel version of Welford's algorithm).
+        """
+        if len(x) > chunk_size:
+            for start in range(0, len(x), chunk_size):
+                self.update(x[start : start + chunk_size], chunk_size=chunk_size)
+            return
+
+        batch = len(x)
+        if batch == 0:
+            return
+        n = self.n + batch
+
+        # Chunks are small enough to reduce in float32; we merge them in float64.
+        mean_LD = x.mean(dim=0)
+        m2_LD = (x - mean_LD).square_().sum(dim=0).double().numpy()
+        delta_LD = mean_LD.double().numpy() - self.mean
+        self.m2 += m2_LD + delta_LD**2 * self.n * batch / n
+        self.mean += delta_LD * batch / n
+
+        self.min = np.minimum(self.min, x.amin(dim=0).numpy())
+        self.max = np.maximum(self.max, x.amax(dim=0).numpy())
+
+        norm_L = torch.linalg.vector_norm(x, dim=2).mean(dim=0).double().numpy()
+        self.l2_mean += (norm_L - self.l2_mean) * batch / n
+        centered_L = torch.linalg.vector_norm(
+            x - torch.from_numpy(self.mean).float(), dim=2
+        )
+        centered_L = centered_L.mean(dim=0).double().numpy()
+        self.l2_mean_centered += (centered_L - self.l2_mean_centered) * batch / n
+
+        # floor(log2(|x|)) is the float32 exponent; zeros and subnormals land in the first bin.
+        n_layers, n_bins = x.shape[1], len(self.abs_bins) + 1
+        bins_BLD = (x.contiguous().view(torch.int32) >> 23) & 0xFF
+        bins_BLD -= 127 + self.abs_bins[0] - 1
+        bins_BLD.clamp_(0, n_bins - 1)
+        bins_BLD += torch.arange(n_layers, dtype=torch.int32).view(1, -1, 1) * n_bins
+        counts = torch.bincount(bins_BLD.view(-1), minlength=n_layers * n_bins)
+        self.abs_hist += counts.view(n_layers, n_bins).numpy()
+
+        self.n = n
+
+    def merge(self, other: "ActStats") -> None:
+        """
+        Add the statistics of other activations, such as another parallel job's (see `assemble_jobs`).
+        """
+        n = self.n + other.n
+        if other.n == 0:
+            return
+
+        delta_LD = other.mean - self.mean
+        self.m2 += other.m2 + delta_LD**2 * self.n * other.n / n
+        self.mean += delta_LD * other.n / n
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.l2_mean += (other.l2_mean - self.l2_mean) * other.n / n
+        self.l2_mean_centered += (
+            (other.l2_mean_centered - self.l2_mean_centered) * other.n / n
+        )
+        self.abs_hist += other.abs_hist
+        self.n = n
+
+    @property
+    def var(self) -> Float[np.ndarray, "n_layers d_vit"]:
+        """Variance of each dimension."""
+        return self.m2 / max(self.n, 1)
+
+    @property
+    def max_abs(self) -> Float[np.ndarray, " n_layers"]:
+        """Largest absolute value of any dimension."""
+        return np.maximum(np.abs(self.min), np.abs(self.max)).max(axis=1)
+
+    def get_abs_quantile(self, q: float) -> Float[np.ndarray, " n_layers"]:
+        """
+        Get an upper bound on the `q` quantile of absolute values, per layer; a `clamp` of this value clamps at most a fraction `1 - q` of the values. The bound is the next power of two, or `max_abs` if that is smaller.
+        """
+        cum = np.cumsum(self.abs_hist, axis=1) / self.abs_hist.sum(
+            axis=1, keepdims=True
+        )
+        edges = np.exp2(np.append(self.abs_bins, np.inf))
+        bound = edges[np.argmax(cum >= q, axis=1)]
+        return np.minimum(bound, self.max_abs)
+
+
+@beartype.beartype
+def dump_act_stats(shard_root: str, stats: dict[str, ActStats]):
+    """
+    Save activation statistics to `act_stats.npz` in `shard_root`, replacing the file atomically.
+    """
+    arrays = {
+        f"{name}.{field.name}": np.asarray(getattr(stat, field.name))
+        for name, stat in stats.items()
+        for field in dataclasses.fields(stat)
+    }
+    tmp_fpath = os.path.join(shard_root, "act_stats.tmp.npz")
+    np.savez(tmp_fpath, **arrays)
+    os.replace(tmp_fpath, os.path.join(shard_root, "act_stats.npz"))
+
+
+@beartype.beartype
+def load_act_stats(shard_root: str) -> dict[str, ActStats]:
+    """
+    Load the activation statistics in `shard_root` written by `ShardWriter`, keyed by token type ('cls' or 'patches'). Returns an empty dict if there are none.
+    """
+    fpath = os.path.join(shard_root, "act_stats.npz")
+    if not os.path.isfile(fpath):
+        return {}
+
+    stats = {}
+    with np.load(fpath) as arrays:
+        for name in {key.split(".")[0] for key in arrays.files}:
+            fields = {
+                field.name: arrays[f"{name}.{field.name}"]
+                for field in dataclasses.fields(ActStats)
+            }
+            stats[name] = ActStats(**{**fields, "n": fields["n"].item()})
+    return stats
+
+
 @beartype.beartype
 @dataclasses.dataclass(frozen=True)
 class Metadata:
@@ -1000,6 +3123,20 @@ class Metadata:
     n_imgs: int
     n_patches_per_shard: int
     data: str
+    shuffle_seed: int | None = None
+    """If not None, these are a single layer's patches, globally shuffled by `shuffle` with this seed."""
+    dtype: str = "float32"
+    """On-disk activation dtype; see `get_storage_dtype`."""
+    layout: str = "img-major"
+    """On-disk shard layout; see `open_shard`."""
+    compression: str = "none"
+    """Codec for compressed shards (see `compress_shard`), or 'none' for uncompressed shards."""
+    n_imgs_per_chunk: int = 4
+    """Number of images per independently compressed chunk of a compressed shard."""
+    draft_jpegs: bool = False
+    """Whether JPEGs were decoded at a reduced scale; see `config.Activations.draft_jpegs`."""
+    version: int = 1
+    """Shard format version. Version 1 allocates every shard, including the last, for `n_imgs_per_shard` images. Version 2 trims the last shard to the images it holds and writes a `shards.json` index (see `ShardInfo`). Not part of `hash`."""
 
     @classmethod
     def from_cfg(cls, cfg: config.Activations) -> "Metadata":
@@ -1014,6 +3151,14 @@ class Metadata:
             cfg.data.n_imgs,
             cfg.n_patches_per_shard,
             str(cfg.data),
+            dtype=cfg.dtype,
+            layout=cfg.layout,
+            compression=cfg.compression,
+            n_imgs_per_chunk=cfg.n_imgs_per_chunk,
+            # Resized images were decoded once, by `resize_imgs`.
+            draft_jpegs=cfg.draft_jpegs
+            and not isinstance(cfg.data, config.ResizedDataset),
+            version=2,
         )
 
     @classmethod
@@ -1029,9 +3174,176 @@ class Metadata:
 
     @property
     def hash(self) -> str:
-        cfg_str = json.dumps(dataclasses.asdict(self), sort_keys=True)
+        dct = dataclasses.asdict(self)
+        # Leave out optional fields that are at their defaults so that shards written before those fields existed keep their directory names.
+        for field in dataclasses.fields(self):
+            if (
+                field.default is not dataclasses.MISSING
+                and dct[field.name] == field.default
+            ):
+                del dct[field.name]
+        # The shard format doesn't change the activations, so dumping a config again in a newer format reuses its directory.
+        dct.pop("version", None)
+        cfg_str = json.dumps(dct, sort_keys=True)
         return hashlib.sha256(cfg_str.encode("utf-8")).hexdigest()
 
+    @property
+    def n_imgs_per_shard(self) -> int:
+        """
+        Number of images in every shard but the last. Shuffled shards (see `shuffle`) hold individual patches, so for shuffled activations this is the number of patches per shard.
+        """
+        if self.shuffle_seed is not None:
+            return self.n_patches_per_shard
+
+        n_patches_per_img = self.n_patches_per_img + int(self.cls_token)
+        return self.n_patches_per_shard // len(self.layers) // n_patches_per_img
+
+    @property
+    def n_shards(self) -> int:
+        """Number of shards."""
+        n = self.n_imgs
+        if self.shuffle_seed is not None:
+            n *= self.n_patches_per_img
+        return math.ceil(n / self.n_imgs_per_shard)
+
+    def get_shard_shape(self, shard: int) -> tuple[int, ...]:
+        """
+        Get the shape of shard `shard` as `(n_imgs, n_layers, all_patches, row)` (see `open_shard` and `get_row_size`), or `(n_patches, row)` for shuffled activations. Shuffled shards and version 2 shards only allocate the last shard for the images it holds.
+        """
+        row_size = get_row_size(self.dtype, self.d_vit)
+        if self.shuffle_seed is not None:
+            n_patches = self.n_imgs * self.n_patches_per_img
+            n_rows = min(
+                self.n_imgs_per_shard, n_patches - shard * self.n_imgs_per_shard
+            )
+            return (n_rows, row_size)
+
+        n_imgs = self.n_imgs_per_shard
+        if self.version >= 2:
+            n_imgs = min(n_imgs, self.n_imgs - shard * self.n_imgs_per_shard)
+        n_patches_per_img = self.n_patches_per_img + int(self.cls_token)
+        return (n_imgs, len(self.layers), n_patches_per_img, row_size)
+
+
+@beartype.beartype
+@dataclasses.dataclass(frozen=True)
+class ShardInfo:
+    """
+    One shard's entry in a shard directory's `shards.json` index. Shards have no header of their own; data starts at byte 0 of the file.
+    """
+
+    fname: str
+    """Shard file name, relative to the shard directory."""
+    start: int
+    """Index of the shard's first image (or, for shuffled activations, first patch)."""
+    shape: tuple[int, ...]
+    """Logical shape; see `Metadata.get_shard_shape`."""
+    nbytes: int
+    """File size in bytes."""
+    crc32: int
+    """CRC-32 checksum of the file."""
+    chunk_offsets: tuple[int, ...] = ()
+    """For compressed shards, the byte offset of every chunk followed by the file size."""
+
+    @classmethod
+    def from_shard(
+        cls,
+        shard_root: str,
+        shard: int,
+        metadata: Metadata,
+        *,
+        chunk_offsets: tuple[int, ...] = (),
+    ) -> "ShardInfo":
+        fname = f"acts{shard:06}.bin"
+        fpath = os.path.join(shard_root, fname)
+        return cls(
+            fname,
+            shard * metadata.n_imgs_per_shard,
+            metadata.get_shard_shape(shard),
+            os.path.getsize(fpath),
+            get_crc32(fpath),
+            chunk_offsets,
+        )
+
+
+@beartype.beartype
+def get_crc32(fpath: str, chunk_size: int = 64 * 1024**2) -> int:
+    """Get the CRC-32 checksum of a file, reading `chunk_size` bytes at a time."""
+    crc = 0
+    with open(fpath, "rb") as fd:
+        while chunk := fd.read(chunk_size):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+@beartype.beartype
+def dump_index(shard_root: str, metadata: Metadata, shards: list[ShardInfo]):
+    """
+    Write the `shards.json` index for `shards`. The index is replaced atomically, so readers never see a half-written index.
+    """
+    index = {
+        "version": metadata.version,
+        "dtype": metadata.dtype,
+        "layout": metadata.layout,
+        "compression": metadata.compression,
+        "shards": [dataclasses.asdict(shard) for shard in shards],
+    }
+    tmp_fpath = os.path.join(shard_root, "shards.json.tmp")
+    with open(tmp_fpath, "w") as fd:
+        json.dump(index, fd, indent=4)
+    os.replace(tmp_fpath, os.path.join(shard_root, "shards.json"))
+
+
+@beartype.beartype
+def load_index(shard_root: str) -> list[ShardInfo]:
+    """Load the `shards.json` index of a shard directory."""
+    with open(os.path.join(shard_root, "shards.json")) as fd:
+        index = json.load(fd)
+
+    return [
+        ShardInfo(**{
+            **shard,
+            "shape": tuple(shard["shape"]),
+            "chunk_offsets": tuple(shard.get("chunk_offsets", ())),
+        })
+        for shard in index["shards"]
+    ]
+
+
+@beartype.beartype
+def check_shards(
+    shard_root: str,
+    metadata: Metadata,
+    shards: list[ShardInfo],
+    *,
+    checksums: bool = False,
+):
+    """
+    Check that the shards in `shard_root` match their index: every shard is present, has the shape `metadata` expects and has the right size. With `checksums`, also read every shard and compare its CRC-32 checksum, which is slow.
+
+    Raises:
+        RuntimeError: if a shard is missing, truncated or corrupted.
+    """
+    if len(shards) != metadata.n_shards:
+        raise RuntimeError(
+            f"Expected {metadata.n_shards} shards in '{shard_root}', but the index has {len(shards)}; is the dump finished?"
+        )
+
+    for i, shard in enumerate(shards):
+        fpath = os.path.join(shard_root, shard.fname)
+        if shard.shape != metadata.get_shard_shape(i):
+            raise RuntimeError(
+                f"Shard '{fpath}' has shape {shard.shape}, expected {metadata.get_shard_shape(i)}."
+            )
+        if not os.path.isfile(fpath):
+            raise RuntimeError(f"Shard '{fpath}' is missing.")
+        if os.path.getsize(fpath) != shard.nbytes:
+            raise RuntimeError(
+                f"Shard '{fpath}' has {os.path.getsize(fpath)} bytes, expected {shard.nbytes}."
+            )
+        if checksums and get_crc32(fpath) != shard.crc32:
+            raise RuntimeError(f"Shard '{fpath}' does not match its checksum.")
+
 
 @beartype.beartype
 def get_acts_dir(cfg: config.Activations) -> str:
@@ -1053,3 +3365,521 @@ def get_acts_dir(cfg: config.Activations) -> str:
     metadata.dump(os.path.join(acts_dir, "metadata.json"))
 
     return acts_dir
+
+
+@beartype.beartype
+def get_job_shards(metadata: Metadata, n_jobs: int, job: int) -> range:
+    """
+    Get the contiguous range of shards that job `job` of `n_jobs` parallel jobs dumps. Jobs get as close to the same number of shards as possible.
+    """
+    if not 0 <= job < n_jobs:
+        raise ValueError(f"Job {job} is not one of {n_jobs} jobs.")
+    n_shards = metadata.n_shards
+    return range(job * n_shards // n_jobs, (job + 1) * n_shards // n_jobs)
+
+
+@beartype.beartype
+def get_job_dir(shard_root: str, job: int) -> str:
+    """Directory for parallel job `job`'s own `shards.json` index and `act_stats.npz`."""
+    return os.path.join(shard_root, "jobs", f"{job:04}")
+
+
+@beartype.beartype
+def prepare_jobs(cfg: config.Activations):
+    """
+    Get a shard directory ready for `cfg.n_jobs` parallel jobs. Jobs write disjoint rows of the same side files, so we create those here, once, rather than letting every job create them. If we can't resume (see `Activations.resume`), we also forget every job's progress.
+
+    The shard directory's own `shards.json` and `act_stats.npz` only describe a finished dump; we remove them until `assemble_jobs` writes them again.
+    """
+    root = get_acts_dir(cfg)
+    shape = (cfg.data.n_imgs, len(cfg.layers), cfg.d_vit)
+    names = ["cls", "meanpool"] if cfg.cls_token else ["meanpool"]
+    names = names if cfg.side_files else []
+    fpaths = [os.path.join(root, f"{name}.npy") for name in names]
+
+    resume = cfg.resume and all(
+        os.path.isfile(fpath) and np.load(fpath, mmap_mode="r").shape == shape
+        for fpath in fpaths
+    )
+    if not resume:
+        shutil.rmtree(os.path.join(root, "jobs"), ignore_errors=True)
+        for fpath in fpaths:
+            side = np.lib.format.open_memmap(
+                fpath, mode="w+", dtype=np.float32, shape=shape
+            )
+            side.flush()
+            del side
+
+    for name in ("cls", "meanpool"):
+        fpath = os.path.join(root, f"{name}.npy")
+        if fpath not in fpaths and os.path.isfile(fpath):
+            os.remove(fpath)
+
+    for fname in ("shards.json", "act_stats.npz"):
+        if os.path.isfile(os.path.join(root, fname)):
+            os.remove(os.path.join(root, fname))
+
+
+@beartype.beartype
+def assemble_jobs(cfg: config.Activations) -> str:
+    """
+    Once every one of `cfg.n_jobs` parallel jobs is done, check that their shards cover every image, then merge their indices and statistics into the shard directory's `shards.json` and `act_stats.npz` and write `metadata.json`.
+
+    Raises:
+        RuntimeError: if a job didn't finish its shards.
+
+    Returns:
+        The shard directory.
+    """
+    root = get_acts_dir(cfg)
+    metadata = Metadata.from_cfg(cfg)
+
+    shards = []
+    stats = {}
+    for job in range(cfg.n_jobs):
+        job_dpath = get_job_dir(root, job)
+        job_shards = get_job_shards(metadata, cfg.n_jobs, job)
+        index_fpath = os.path.join(job_dpath, "shards.json")
+        index = load_index(job_dpath) if os.path.isfile(index_fpath) else []
+        if [shard.fname for shard in index] != [f"acts{i:06}.bin" for i in job_shards]:
+            raise RuntimeError(
+                f"Job {job} wrote {len(index)} of its {len(job_shards)} shards ({job_shards.start} to {job_shards.stop - 1})."
+            )
+        shards.extend(index)
+
+        for name, stat in load_act_stats(job_dpath).items():
+            if name in stats:
+                stats[name].merge(stat)
+            else:
+                stats[name] = stat
+
+    check_shards(root, metadata, shards)
+    dump_index(root, metadata, shards)
+    if stats:
+        dump_act_stats(root, stats)
+    metadata.dump(os.path.join(root, "metadata.json"))
+    return root
+
+
+@beartype.beartype
+def dump_side_files(shard_root: str, n_imgs_per_batch: int = 256):
+    """
+    Write the [CLS] token and per-layer patch mean side files (see `Activations.side_files`) for activations that were dumped without them.
+
+    Unlike `ShardWriter`, this pools the stored activations, so for float16, bfloat16 and int8 shards the side files match what `Dataset` computes from the shards rather than the original float32 activations.
+
+    Args:
+        shard_root: Directory with .bin shards and a metadata.json file.
+        n_imgs_per_batch: Number of images to read at once.
+    """
+    logger = logging.getLogger("side-files")
+
+    metadata = Metadata.load(os.path.join(shard_root, "metadata.json"))
+    if metadata.shuffle_seed is not None:
+        raise ValueError(f"Activations in '{shard_root}' are shuffled patches.")
+
+    dataset = Dataset(
+        config.DataLoad(
+            shard_root=shard_root,
+            patches="patches",
+            layer=metadata.layers[0],
+            scale_mean=False,
+            scale_norm=False,
+            max_open_shards=1,
+        )
+    )
+    shape = (metadata.n_imgs, len(metadata.layers), metadata.d_vit)
+    names = ["cls", "meanpool"] if metadata.cls_token else ["meanpool"]
+    sides = {
+        name: np.lib.format.open_memmap(
+            os.path.join(shard_root, f"{name}.npy.tmp"),
+            mode="w+",
+            dtype=np.float32,
+            shape=shape,
+        )
+        for name in names
+    }
+    n_cls = int(metadata.cls_token)
+    for shard in helpers.progress(range(metadata.n_shards), every=1, desc="pool"):
+        acts = dataset.get_shard(shard)
+        offset = shard * metadata.n_imgs_per_shard
+        n_imgs = min(metadata.n_imgs_per_shard, metadata.n_imgs - offset)
+        for start in range(0, n_imgs, n_imgs_per_batch):
+            end = min(start + n_imgs_per_batch, n_imgs)
+            img_acts = dataset.upcast(acts[start:end])
+            a, b = offset + start, offset + end
+            if "cls" in sides:
+                sides["cls"][a:b] = img_acts[:, :, 0]
+            sides["meanpool"][a:b] = img_acts[:, :, n_cls:].mean(axis=2)
+
+    for name, side in sides.items():
+        side.flush()
+        os.replace(
+            os.path.join(shard_root, f"{name}.npy.tmp"),
+            os.path.join(shard_root, f"{name}.npy"),
+        )
+    logger.info("Wrote side files to '%s'.", shard_root)
+
+
+############
+# RELAYOUT #
+############
+
+
+@beartype.beartype
+def relayout(cfg: config.Relayout) -> str:
+    """
+    Rewrite the shards in `cfg.shard_root` in layout `cfg.layout` (see `open_shard`), one layer of one shard at a time.
+
+    Shards are written to a temporary directory that replaces the output directory at the end. Upgrading a version 1 dump in the same layout keeps its hash (see `Metadata.hash`), so with the same `dump_to`, the output directory is `cfg.shard_root` itself, which we read from until every shard is rewritten.
+
+    Args:
+        cfg: Configuration for rewriting shards.
+
+    Returns:
+        Directory with the rewritten shards.
+    """
+    logger = logging.getLogger("relayout")
+
+    # Any valid layer works; we only use the dataset to open the source shards.
+    layers = Metadata.load(os.path.join(cfg.shard_root, "metadata.json")).layers
+    dataset = Dataset(
+        config.DataLoad(
+            shard_root=cfg.shard_root,
+            patches="patches",
+            layer=layers[0],
+            scale_mean=False,
+            scale_norm=False,
+            max_open_shards=1,
+        )
+    )
+    if dataset.shuffled:
+        raise ValueError(
+            f"Activations in '{cfg.shard_root}' are shuffled and only have one layer."
+        )
+
+    # Always write the current, uncompressed shard format.
+    metadata = dataclasses.replace(
+        dataset.metadata, layout=cfg.layout, compression="none", version=2
+    )
+    if metadata == dataset.metadata:
+        logger.info("Activations in '%s' are already %s.", cfg.shard_root, cfg.layout)
+        return cfg.shard_root
+
+    shard_root = os.path.join(cfg.dump_to, metadata.hash)
+    tmp_dpath = shard_root + ".tmp"
+    if os.path.isdir(tmp_dpath):
+        # Left behind by an interrupted relayout.
+        shutil.rmtree(tmp_dpath)
+    os.makedirs(tmp_dpath)
+
+    shards = []
+    for shard in helpers.progress(range(metadata.n_shards), every=1, desc="relayout"):
+        src = dataset.get_shard(shard)
+        dst = open_shard(
+            os.path.join(tmp_dpath, f"acts{shard:06}.bin"),
+            mode="w+",
+            dtype=src.dtype,
+            shape=metadata.get_shard_shape(shard),
+            layout=metadata.layout,
+        )
+        for layer in range(len(metadata.layers)):
+            # Version 1 shards have empty space at the end of the last shard.
+            dst[:, layer] = src[: len(dst), layer]
+        dst.flush()
+        del dst
+        shards.append(ShardInfo.from_shard(tmp_dpath, shard, metadata))
+
+    for fname in ("cls.npy", "meanpool.npy", "act_stats.npz"):
+        fpath = os.path.join(cfg.shard_root, fname)
+        if os.path.isfile(fpath):
+            shutil.copyfile(fpath, os.path.join(tmp_dpath, fname))
+
+    dump_index(tmp_dpath, metadata, shards)
+    metadata.dump(os.path.join(tmp_dpath, "metadata.json"))
+    # Close the source shards before we (possibly) delete them.
+    del dataset
+
+    if os.path.isdir(shard_root):
+        old_dpath = shard_root + ".old"
+        if os.path.isdir(old_dpath):
+            shutil.rmtree(old_dpath)
+        os.replace(shard_root, old_dpath)
+        os.replace(tmp_dpath, shard_root)
+        shutil.rmtree(old_dpath)
+    else:
+        os.replace(tmp_dpath, shard_root)
+    logger.info("Wrote %s activations to '%s'.", metadata.layout, shard_root)
+    return shard_root
+
+
+##################
+# RESIZED IMAGES #
+##################
+
+
+@beartype.beartype
+class ResizedImgs(torch.utils.data.Dataset):
+    """
+    Images that `resize_imgs` already decoded, center-cropped and resized, read from one memory-mapped uint8 array. Getting an image is a copy, not a decode, so dumping from resized images is bound by the ViT rather than by dataloader workers.
+    """
+
+    def __init__(self, cfg: config.ResizedDataset, *, img_transform=None):
+        with open(os.path.join(cfg.root, "resized.json")) as fd:
+            info = json.load(fd)
+        self.imgs = np.load(os.path.join(cfg.root, "imgs.npy"), mmap_mode="r")
+        self.targets = np.load(os.path.join(cfg.root, "targets.npy"))
+        self.indices = np.load(os.path.join(cfg.root, "indices.npy"))
+        self.classes = info["classes"]
+        self.img_transform = img_transform
+
+    def __getitem__(self, i: int) -> dict[str, object]:
+        """
+        Returns:
+            dict with keys 'image', 'index', 'target', 'label', 'decode_s' (the time to copy the image out of the array) and 'src_index' (the image's index in the original dataset).
+        """
+        start_s = time.perf_counter()
+        image = Image.fromarray(np.array(self.imgs[i]))
+        decode_s = time.perf_counter() - start_s
+        if self.img_transform is not None:
+            image = self.img_transform(image)
+
+        target = self.targets[i].item()
+        return {
+            "image": image,
+            "index": i,
+            "target": target,
+            "label": self.classes[target],
+            "decode_s": decode_s,
+            "src_index": self.indices[i].item(),
+        }
+
+    def __len__(self) -> int:
+        return len(self.imgs)
+
+
+@beartype.beartype
+def resize_imgs(cfg: config.Resize) -> str:
+    """
+    Decode every image in `cfg.data`, resize its shorter side to `cfg.size`, center-crop it to a `cfg.size` x `cfg.size` square and write it to `imgs.npy`, a single [n_imgs, size, size, 3] uint8 array that `ResizedImgs` memory-maps. `targets.npy` and `indices.npy` hold every image's class and index in `cfg.data`, and `resized.json` the class names. We write `resized.json` last, so a `ResizedDataset` only finds finished directories.
+
+    Args:
+        cfg: Configuration for resizing.
+
+    Returns:
+        The directory with the resized images.
+    """
+    from torchvision.transforms import v2
+
+    logger = logging.getLogger("resize")
+
+    img_transform = v2.Compose([
+        v2.Resize(size=cfg.size, antialias=True),
+        v2.CenterCrop(size=(cfg.size, cfg.size)),
+        v2.PILToTensor(),
+    ])
+    dataset = get_dataset(cfg.data, img_transform=img_transform, draft_jpegs=True)
+    dataloader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=cfg.batch_size,
+        num_workers=cfg.n_workers,
+        shuffle=False,
+        drop_last=False,
+    )
+
+    os.makedirs(cfg.dump_to, exist_ok=True)
+    info_fpath = os.path.join(cfg.dump_to, "resized.json")
+    if os.path.isfile(info_fpath):
+        os.remove(info_fpath)
+
+    n_imgs = len(dataset)
+    imgs = np.lib.format.open_memmap(
+        os.path.join(cfg.dump_to, "imgs.npy"),
+        mode="w+",
+        dtype=np.uint8,
+        shape=(n_imgs, cfg.size, cfg.size, 3),
+    )
+    targets = np.zeros(n_imgs, dtype=np.int64)
+    indices = np.zeros(n_imgs, dtype=np.int64)
+    classes = {}
+
+    i, decode_s = 0, 0.0
+    for batch in helpers.progress(dataloader, desc="resize"):
+        n = len(batch["image"])
+        imgs[i : i + n] = batch["image"].permute(0, 2, 3, 1).numpy()
+        targets[i : i + n] = batch["target"].numpy()
+        indices[i : i + n] = batch["index"].numpy()
+        classes.update(zip(batch["target"].tolist(), batch["label"]))
+        decode_s += batch["decode_s"].sum().item()
+        i += n
+    assert i == n_imgs
+
+    imgs.flush()
+    np.save(os.path.join(cfg.dump_to, "targets.npy"), targets)
+    np.save(os.path.join(cfg.dump_to, "indices.npy"), indices)
+    info = {
+        "data": str(cfg.data),
+        "size": cfg.size,
+        "n_imgs": n_imgs,
+        "classes": [classes.get(t, "") for t in range(max(classes, default=-1) + 1)],
+    }
+    with open(info_fpath, "w") as fd:
+        json.dump(info, fd, indent=4)
+
+    logger.info(
+        "Resized %d images to '%s' (%.2fms per image to decode).",
+        n_imgs,
+        cfg.dump_to,
+        decode_s / max(n_imgs, 1) * 1000,
+    )
+    return cfg.dump_to
+
+
+#############
+# SHUFFLING #
+#############
+
+
+@beartype.beartype
+def shuffle(cfg: config.Shuffle) -> str:
+    """
+    Write a globally shuffled copy of one layer's patch activations so that training can read them sequentially (`shuffle=False`) at disk bandwidth instead of randomly.
+
+    This is an out-of-core external shuffle with bounded memory:
+
+    1. Read the source shards in order, one chunk at a time, and scatter each example into one of `n_buckets` temporary bucket files chosen uniformly at random. `n_buckets` is picked so that a bucket fits in `cfg.max_memory_gb`.
+    2. Load each bucket, shuffle it in memory, and append it to the output shards.
+
+    A uniformly random bucket followed by a uniformly random order within the bucket is a uniformly random permutation.
+    The output directory has `[n_patches_per_shard, d_vit]` shards, an `example_i.npy` file with each example's original index (so `Dataset` still reports the right `image_i` and `patch_i`), and a `metadata.json` with `shuffle_seed` set.
+
+    Args:
+        cfg: Configuration for shuffling.
+
+    Returns:
+        Directory with the shuffled shards.
+    """
+    logger = logging.getLogger("shuffle")
+
+    if cfg.data.patches != "patches" or not isinstance(cfg.data.layer, int):
+        raise ValueError("Can only shuffle patches from a single layer.")
+
+    # Write raw activations; normalization happens when the shuffled activations are loaded.
+    dataset = Dataset(
+        dataclasses.replace(
+            cfg.data, clamp=math.inf, scale_mean=False, scale_norm=False
+        )
+    )
+    if dataset.shuffled:
+        raise ValueError(
+            f"Activations in '{cfg.data.shard_root}' are already shuffled."
+        )
+
+    metadata = dataclasses.replace(
+        dataset.metadata,
+        layers=(cfg.data.layer,),
+        n_patches_per_shard=cfg.n_patches_per_shard,
+        shuffle_seed=cfg.seed,
+        compression="none",
+        version=2,
+    )
+    shard_root = os.path.join(cfg.dump_to, metadata.hash)
+    tmp_dpath = os.path.join(shard_root, "tmp")
+    if os.path.isdir(tmp_dpath):
+        # Buckets are appended to, so don't append to an interrupted shuffle's.
+        shutil.rmtree(tmp_dpath)
+    os.makedirs(tmp_dpath)
+
+    n_patches = metadata.n_imgs * metadata.n_patches_per_img
+    # Buckets hold upcast float32 activations.
+    row_bytes = metadata.d_vit * np.dtype(np.float32).itemsize
+    max_bytes = int(cfg.max_memory_gb * 1024**3)
+    # Leave some room for buckets that are bigger than average, and for the shuffled copy.
+    n_buckets = max(1, math.ceil(n_patches * row_bytes * 2.5 / max_bytes))
+    n_rows_per_chunk = max(1, max_bytes // (row_bytes * 3))
+    logger.info("Shuffling %d patches with %d buckets.", n_patches, n_buckets)
+
+    rng = np.random.default_rng(seed=cfg.seed)
+
+    # 1. Scatter examples into buckets. Each chunk opens its buckets a group at a time, so we never hold more than `max_open_buckets` pairs of files open, however many buckets there are.
+    max_open_buckets = 256
+    for start in helpers.progress(
+        range(0, n_patches, n_rows_per_chunk), desc="scatter"
+    ):
+        end = min(start + n_rows_per_chunk, n_patches)
+        example_i = np.arange(start, end, dtype=np.int64)
+        acts = dataset.__getitems__(example_i.tolist())["act"].numpy()
+
+        bucket = rng.integers(n_buckets, size=len(example_i))
+        order = np.argsort(bucket, kind="stable")
+        bounds = np.searchsorted(bucket[order], np.arange(n_buckets + 1))
+        for first in range(0, n_buckets, max_open_buckets):
+            group = bounds[first : first + max_open_buckets + 1]
+            with contextlib.ExitStack() as stack:
+                for b, (lo, hi) in enumerate(itertools.pairwise(group), start=first):
+                    acts_fd = stack.enter_context(
+                        open(os.path.join(tmp_dpath, f"acts{b:06}.bin"), "ab")
+                    )
+                    example_i_fd = stack.enter_context(
+                        open(os.path.join(tmp_dpath, f"example_i{b:06}.bin"), "ab")
+                    )
+                    acts_fd.write(acts[order[lo:hi]].tobytes())
+                    example_i_fd.write(example_i[order[lo:hi]].tobytes())
+
+    # 2. Shuffle each bucket in memory and append it to the output shards.
+    example_i_out = np.lib.format.open_memmap(
+        os.path.join(shard_root, "example_i.npy"),
+        mode="w+",
+        dtype=np.int64,
+        shape=(n_patches,),
+    )
+    cursor = 0
+    for b in helpers.progress(range(n_buckets), every=1, desc="gather"):
+        acts_fpath = os.path.join(tmp_dpath, f"acts{b:06}.bin")
+        example_i_fpath = os.path.join(tmp_dpath, f"example_i{b:06}.bin")
+        acts = np.fromfile(acts_fpath, dtype=np.float32).reshape(-1, metadata.d_vit)
+        example_i = np.fromfile(example_i_fpath, dtype=np.int64)
+
+        perm = rng.permutation(len(example_i))
+        acts, example_i = acts[perm], example_i[perm]
+
+        example_i_out[cursor : cursor + len(example_i)] = example_i
+        while len(acts):
+            shard = cursor // cfg.n_patches_per_shard
+            pos = cursor % cfg.n_patches_per_shard
+            shape = metadata.get_shard_shape(shard)
+            n_fit = min(shape[0] - pos, len(acts))
+
+            shard_fpath = os.path.join(shard_root, f"acts{shard:06}.bin")
+            mode = "r+" if pos > 0 else "w+"
+            out = np.memmap(
+                shard_fpath,
+                mode=mode,
+                dtype=get_storage_dtype(metadata.dtype),
+                shape=shape,
+            )
+            # Activations were upcast when read, so this is lossless (int8 rows are re-quantized with the same scale).
+            out[pos : pos + n_fit] = to_storage(
+                torch.from_numpy(acts[:n_fit]), metadata.dtype
+            )
+            out.flush()
+            del out
+
+            acts = acts[n_fit:]
+            cursor += n_fit
+
+        os.remove(acts_fpath)
+        os.remove(example_i_fpath)
+
+    example_i_out.flush()
+    os.rmdir(tmp_dpath)
+    assert cursor == n_patches
+
+    shards = [
+        ShardInfo.from_shard(shard_root, shard, metadata)
+        for shard in range(metadata.n_shards)
+    ]
+    dump_index(shard_root, metadata, shards)
+    metadata.dump(os.path.join(shard_root, "metadata.json"))
+    logger.info("Wrote shuffled activations to '%s'.", shard_root)
+    return shard_root
@@ -76,7 +76,24 @@ class Ade20kDataset:
             return 20210
 
 
-DatasetConfig = ImagenetDataset | ImageFolderDataset | Ade20kDataset
+@beartype.beartype
+@dataclasses.dataclass(frozen=True)
+class ResizedDataset:
+    """Configuration for images that `saev resize` already decoded, center-cropped and resized (see `Resize`)."""
+
+    root: str = os.path.join(".", "data", "resized")
+    """Where `saev resize` wrote the images."""
+
+    @property
+    def n_imgs(self) -> int:
+        """Number of images in the dataset."""
+        import json
+
+        with open(os.path.join(self.root, "resized.json")) as fd:
+            return json.load(fd)["n_imgs"]
+
+
+DatasetConfig = ImagenetDataset | ImageFolderDataset | Ade20kDataset | ResizedDataset
 
 
 @beartype.beartype
@@ -108,6 +125,28 @@ class Activations:
     """Whether the model has a [CLS] token."""
     n_patches_per_shard: int = 2_400_000
     """Number of activations per shard; 2.4M is approximately 10GB for 1024-dimensional 4-byte activations."""
+    dtype: typing.Literal["float32", "float16", "bfloat16", "int8"] = "float32"
+    """Which dtype to store activations as. float16 and bfloat16 halve disk space and I/O; int8 (with a float32 scale per activation) quarters it. Activations are upcast to float32 when they are loaded. Use `scripts/quantization.py` to check how much precision a dtype costs."""
+    layout: typing.Literal["img-major", "layer-major"] = "img-major"
+    """How to order each shard on disk. 'img-major' keeps all of an image's layers together; 'layer-major' keeps each layer's activations contiguous, so training on one of several recorded layers only reads that layer."""
+    compression: typing.Literal["none", "zlib", "zstd"] = "none"
+    """Whether to compress shards, in independently compressed chunks of `n_imgs_per_chunk` images. Compressed shards are always img-major. Reading one patch decompresses its whole chunk, so compressed shards suit sequential reads (`Train.shuffle_buffer_size`) much better than uniformly random ones."""
+    n_imgs_per_chunk: int = 4
+    """Number of images per compressed chunk. Bigger chunks compress better; smaller chunks make random access cheaper."""
+    side_files: bool = True
+    """Whether to also write every image's [CLS] tokens (`cls.npy`) and per-layer patch means (`meanpool.npy`), which `Dataset` reads instead of the shards for `patches='cls'` and `patches='meanpool'`."""
+    resume: bool = True
+    """Whether to resume an interrupted dump with the same config, keeping the shards it finished (see `shards.json`) and starting after them. Otherwise, start over."""
+    draft_jpegs: bool = True
+    """Whether to decode JPEGs at 1/2, 1/4 or 1/8 scale when the image is still at least as big as the model's first resize, rather than decoding the full image and then resizing it down (see `activations.load_img`). This is several times faster for big images, but activations differ very slightly from decoding at full resolution."""
+    uint8_imgs: bool = True
+    """Whether dataloader workers stop at uint8 images and the main process converts them to float and normalizes them a whole batch at a time, on `device` (see `split_img_transform`). uint8 images are a quarter of the size of float32 images, so workers send much less data to the main process. The result is the same either way."""
+    host_buffers: bool = True
+    """Whether to copy recorded activations straight into a ring of preallocated host buffers (pinned on GPUs) with non-blocking copies, and hand the writer views of them, instead of allocating a new host tensor every batch. The ring has `write_queue_size + 2` buffers the size of the first batch, so no buffer is reused before the writer is done with it. Only used when dumping; `activations.WrappedVisionTransformer` leaves it off unless asked."""
+    write_queue_size: int = 1
+    """Number of batches of activations that can wait for the background thread that writes shards, so that the ViT runs its next batch while the last one is written. Each waiting batch holds `vit_batch_size` images' float32 activations in memory; when the queue is full, the ViT waits for the writer. 0 writes shards on the main thread."""
+    stats: bool = True
+    """Whether to accumulate per-layer statistics of the [CLS] tokens and patches while dumping (mean, variance, min/max, mean L2 norm and a histogram of absolute values) and save them to `act_stats.npz`. `Dataset` normalizes with them instead of sampling the shards."""
 
     seed: int = 42
     """Random seed."""
@@ -119,6 +158,8 @@ class Activations:
     """Which device to use."""
     slurm: bool = False
     """Whether to use `submitit` to run jobs on a Slurm cluster."""
+    n_jobs: int = 1
+    """Number of jobs that dump activations in parallel. Each job dumps its own contiguous range of shards; with `slurm`, every job is a task in a Slurm job array with its own GPU, otherwise they are local processes that take turns on the local GPUs."""
     slurm_acct: str = "PAS2136"
     """Slurm account string."""
     log_to: str = "./logs"
@@ -141,11 +182,114 @@ class DataLoad:
     clamp: float = 1e5
     """Maximum value for activations; activations will be clamped to within [-clamp, clamp]`."""
     n_random_samples: int = 2**19
-    """Number of random samples used to calculate approximate dataset means at startup."""
+    """Number of random samples used to calculate approximate dataset means at startup. The means are cached in the shard directory, so only the first run with a given set of activations pays for this."""
+    n_stats_workers: int = 4
+    """Number of dataloader workers used to calculate dataset means."""
     scale_mean: bool | str = True
     """Whether to subtract approximate dataset means from examples. If a string, manually load from the filepath."""
     scale_norm: bool | str = True
     """Whether to scale average dataset norm to sqrt(d_vit). If a string, manually load from the filepath."""
+    max_open_shards: int = 128
+    """Maximum number of shard memmaps each process keeps open. Set to 0 to re-open the shard on every access."""
+    max_cached_chunks: int = 64
+    """Maximum number of decompressed chunks of compressed shards each process keeps in memory."""
+    in_memory: bool = False
+    """Whether to read every (normalized) example into one contiguous tensor up front and serve examples from memory. Only use this if `n_examples * d_vit * 4` bytes fit in RAM, like [CLS] tokens or small datasets."""
+    pin_memory: bool = False
+    """With `in_memory`, whether to page-lock the tensor so copies to the GPU are faster."""
+    share_memory: bool = False
+    """With `in_memory`, whether to put the tensor in shared memory so DataLoader workers don't copy it."""
+    cache_dir: str = ""
+    """If set, a local directory (like fast scratch space on a compute node) to copy shards to the first time they are read; later reads use the local copies. Copies happen in the background."""
+    cache_gb: float = 100.0
+    """Maximum size of `cache_dir`, shared by every set of activations cached there. The least recently used shards are deleted to make room."""
+    prefetch: bool = False
+    """For passes that read every example in order (evaluation and visuals), whether to read shards in the main process with page-cache hints and a background thread that prefetches the next shard (see `activations.ShardReader`) instead of with DataLoader workers."""
+
+
+@beartype.beartype
+@dataclasses.dataclass(frozen=True)
+class Shuffle:
+    """
+    Configuration for writing a globally shuffled copy of one layer's patch activations.
+    """
+
+    data: DataLoad = dataclasses.field(default_factory=DataLoad)
+    """Which activations to shuffle. Must be `patches='patches'` and a single `layer`."""
+    dump_to: str = os.path.join(".", "shards")
+    """Where to write the shuffled shards."""
+    n_patches_per_shard: int = 2_400_000
+    """Number of activations per shuffled shard."""
+    max_memory_gb: float = 16.0
+    """Approximate upper bound on the memory used while shuffling, in GB."""
+    seed: int = 42
+    """Random seed for the permutation."""
+
+
+MODEL_FIELDS = (
+    "model_family",
+    "model_ckpt",
+    "layers",
+    "d_vit",
+    "n_patches_per_img",
+    "cls_token",
+)
+"""Fields of `Activations` that can differ between models dumped in the same pass over the images (see `expand_models`)."""
+
+
+@beartype.beartype
+def expand_models(
+    cfg: Activations, models: list[dict[str, object]]
+) -> list[Activations]:
+    """
+    Make one config per model to dump in the same pass over the images: `cfg` with each of `models`' fields (all from `MODEL_FIELDS`) replaced.
+
+    Raises:
+        ValueError: if a model sets a field that every model has to share.
+    """
+    cfgs = []
+    for model in models:
+        shared = sorted(set(model) - set(MODEL_FIELDS))
+        if shared:
+            raise ValueError(
+                f"Models can only set {', '.join(MODEL_FIELDS)}; every model shares {', '.join(shared)}."
+            )
+        cfgs.append(dataclasses.replace(cfg, **model))
+    return cfgs
+
+
+@beartype.beartype
+@dataclasses.dataclass(frozen=True)
+class Resize:
+    """
+    Configuration for decoding, center-cropping and resizing a dataset's images once, so that dumping activations for several models reads them with `ResizedDataset` instead of decoding every image again.
+    """
+
+    data: DatasetConfig = dataclasses.field(default_factory=ImagenetDataset)
+    """Which images to resize."""
+    dump_to: str = os.path.join(".", "data", "resized")
+    """Where to write the resized images."""
+    size: int = 448
+    """Side length of the square images. Should be at least the biggest size any model resizes to (moondream2 resizes to 378), so models only ever scale the images down."""
+    batch_size: int = 256
+    """Number of images per dataloader batch."""
+    n_workers: int = 8
+    """Number of dataloader workers."""
+
+
+@beartype.beartype
+@dataclasses.dataclass(frozen=True)
+class Relayout:
+    """
+    Configuration for rewriting existing activation shards in a different layout.
+    """
+
+    shard_root: str = os.path.join(".", "shards")
+    """Directory with .bin shards and a metadata.json file."""
+    layout: typing.Literal["img-major", "layer-major"] = "layer-major"
+    """Layout to rewrite the shards in; see `Activations.layout`."""
+    dump_to: str = os.path.join(".", "shards")
+    """Where to write the rewritten shards."""
 
 
 @beartype.beartype
@@ -195,6 +339,12 @@ class Train:
     """Number of learning rate warmup steps."""
     sae_batch_size: int = 1024 * 16
     """Batch size for SAE training."""
+    shuffle_buffer_size: int = 0
+    """If positive, stream contiguous chunks of activations from randomly ordered shards through an in-memory shuffle buffer of this many examples (split across dataloader workers). If 0, read examples in a uniformly random order, which is fast as long as the shards fit in the page cache."""
+    n_examples_per_chunk: int = 1024 * 16
+    """Number of consecutive examples to read at once when `shuffle_buffer_size` is positive."""
+    data_on_device: typing.Literal["auto", "always", "never"] = "auto"
+    """Whether to load every training example onto `device` once and draw shuffled batches there, without dataloader workers or host-to-device copies. 'auto' does this when the examples take up less than half of the device's free memory (RAM on the CPU)."""
 
     # Logging
     track: bool = True
@@ -3,10 +3,16 @@ Test that the cached activations are actually correct.
 These tests are quite slow
 """
 
+import dataclasses
+import math
+import os
+import pickle
 import tempfile
 
+import numpy as np
 import pytest
 import torch
+from PIL import Image
 
 from . import activations, config
 
@@ -70,3 +76,1736 @@ def test_shard_writer_and_dataset_e2e():
             from_dataset = torch.stack(acts)
             torch.testing.assert_close(cache[:, -1, 0], from_dataset)
             print(f"Batch {b} matched.")
+
+
+def write_shards(
+    tmpdir: str, *, n_imgs: int = 20, layers: tuple[int, ...] = (-2, -1), **kwargs
+) -> config.Activations:
+    """
+    Write random activations for `n_imgs` fake images to `tmpdir` and return the config used to write them.
+    """
+    imgs_root = os.path.join(tmpdir, "imgs")
+    os.makedirs(imgs_root, exist_ok=True)
+    for i in range(n_imgs):
+        open(os.path.join(imgs_root, f"{i}.jpg"), "w").close()
+
+    cfg = config.Activations(
+        data=config.ImageFolderDataset(imgs_root),
+        dump_to=os.path.join(tmpdir, "shards"),
+        d_vit=8,
+        layers=list(layers),
+        n_patches_per_img=4,
+        n_patches_per_shard=7 * len(layers) * 5,
+        **kwargs,
+    )
+    writer = activations.ShardWriter(cfg)
+    acts = torch.randn(
+        (n_imgs, len(layers), cfg.n_patches_per_img + 1, cfg.d_vit),
+        generator=torch.Generator().manual_seed(0),
+    )
+    writer[0:n_imgs] = acts
+    writer.flush()
+    return cfg
+
+
+def make_dataload(cfg: config.Activations, **kwargs) -> config.DataLoad:
+    kwargs = {"scale_mean": False, "scale_norm": False, **kwargs}
+    return config.DataLoad(shard_root=activations.get_acts_dir(cfg), **kwargs)
+
+
+@pytest.mark.parametrize("max_open_shards", [0, 1, 128])
+def test_dataset_shard_cache_matches_shards(max_open_shards):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        dataset = activations.Dataset(
+            make_dataload(cfg, layer=-1, max_open_shards=max_open_shards)
+        )
+        # Read patches out of order so that we bounce between shards.
+        for i in reversed(range(len(dataset))):
+            img_act = dataset.get_img_patches(i // cfg.n_patches_per_img)
+            expected = torch.from_numpy(img_act[1, 1 + i % cfg.n_patches_per_img])
+            torch.testing.assert_close(dataset[i]["act"], expected)
+
+        assert len(dataset._shards) <= max_open_shards
+
+
+def test_dataset_pickle_drops_shard_cache():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        dataset = activations.Dataset(make_dataload(cfg, layer=-1))
+        expected = dataset[0]["act"]
+        assert dataset._shards
+
+        restored = pickle.loads(pickle.dumps(dataset))
+        assert not restored._shards
+        torch.testing.assert_close(restored[0]["act"], expected)
+
+
+@pytest.mark.parametrize(
+    "patches,layer",
+    [
+        ("cls", -1),
+        ("cls", "meanpool"),
+        ("meanpool", -2),
+        ("meanpool", "meanpool"),
+        ("patches", -1),
+    ],
+)
+def test_dataset_getitems_matches_getitem(patches, layer):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        dataset = activations.Dataset(
+            make_dataload(cfg, patches=patches, layer=layer, clamp=1.0)
+        )
+        indices = torch.randperm(
+            len(dataset), generator=torch.Generator().manual_seed(0)
+        )
+        indices = indices.tolist()
+
+        expected = torch.utils.data.default_collate([dataset[i] for i in indices])
+        actual = dataset.__getitems__(indices)
+
+        torch.testing.assert_close(actual["act"], expected["act"])
+        torch.testing.assert_close(actual["image_i"], expected["image_i"])
+        torch.testing.assert_close(actual["patch_i"], expected["patch_i"])
+
+
+def test_dataloader_uses_getitems():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        dataset = activations.Dataset(make_dataload(cfg, layer=-2))
+        dataloader = torch.utils.data.DataLoader(
+            dataset, batch_size=16, shuffle=False, collate_fn=activations.collate
+        )
+        batches = list(dataloader)
+
+        assert sum(len(batch["act"]) for batch in batches) == len(dataset)
+        torch.testing.assert_close(batches[0]["act"][3], dataset[3]["act"])
+        assert batches[-1]["image_i"][-1].item() == cfg.data.n_imgs - 1
+
+
+def make_stream(dataset, **kwargs):
+    kwargs = {
+        "batch_size": 10,
+        "buffer_size": 30,
+        "n_examples_per_chunk": 8,
+        "seed": 0,
+        **kwargs,
+    }
+    return activations.StreamingDataset(dataset, **kwargs)
+
+
+def test_streaming_dataset_matches_dataset():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        dataset = activations.Dataset(make_dataload(cfg, layer=-1))
+        stream = make_stream(dataset)
+
+        for _, batch in zip(range(20), stream):
+            i = batch["image_i"] * cfg.n_patches_per_img + batch["patch_i"]
+            expected = dataset.__getitems__(i.tolist())
+            torch.testing.assert_close(batch["act"], expected["act"])
+
+
+def test_streaming_dataset_visits_every_example_once_per_epoch():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        dataset = activations.Dataset(make_dataload(cfg, layer=-1))
+        # With a buffer the size of a batch, the buffer is emptied every batch.
+        stream = make_stream(dataset, buffer_size=10)
+
+        n_batches = len(dataset) // 10
+        seen = torch.cat([
+            batch["image_i"] * cfg.n_patches_per_img + batch["patch_i"]
+            for _, batch in zip(range(n_batches), stream)
+        ])
+        assert sorted(seen.tolist()) == list(range(len(dataset)))
+
+
+def test_streaming_dataset_chunks_stay_in_shards():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        dataset = activations.Dataset(make_dataload(cfg, layer=-1))
+        stream = make_stream(dataset)
+
+        chunks = stream.get_chunks(0)
+        assert sorted(chunks[:, 1] - chunks[:, 0]) == sorted(
+            stream.get_chunks(1)[:, 1] - stream.get_chunks(1)[:, 0]
+        )
+        assert (chunks[:, 1] - chunks[:, 0]).sum() == len(dataset)
+        shards = chunks[:, 0] // stream.n_examples_per_shard
+        assert (shards == (chunks[:, 1] - 1) // stream.n_examples_per_shard).all()
+        # Each shard's chunks are read together.
+        assert (shards[1:] != shards[:-1]).sum() == shards.max()
+
+
+@pytest.mark.parametrize("n_workers", [0, 2])
+def test_streaming_dataset_is_deterministic(n_workers):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        dataset = activations.Dataset(make_dataload(cfg, layer=-1))
+
+        def get_batches():
+            dataloader = torch.utils.data.DataLoader(
+                make_stream(dataset), batch_size=None, num_workers=n_workers
+            )
+            return [batch["act"] for _, batch in zip(range(12), dataloader)]
+
+        for a, b in zip(get_batches(), get_batches()):
+            torch.testing.assert_close(a, b)
+
+
+def test_get_randomness():
+    n_imgs, n_patches = 1_000, 16
+    ordered = torch.arange(n_imgs * n_patches)[:256] // n_patches
+    shuffled = torch.randperm(n_imgs * n_patches)[:256] // n_patches
+
+    assert activations.get_randomness(ordered, n_imgs) < 0.1
+    assert activations.get_randomness(shuffled, n_imgs) > 0.9
+
+
+# 1e-8 GB needs more buckets than shuffle keeps open at once.
+@pytest.mark.parametrize("max_memory_gb", [1.0, 1e-6, 1e-8])
+def test_shuffle_is_a_permutation(max_memory_gb):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        data_cfg = make_dataload(cfg, layer=-1)
+        shuffle_cfg = config.Shuffle(
+            data=data_cfg,
+            dump_to=os.path.join(tmpdir, "shuffled"),
+            n_patches_per_shard=24,
+            max_memory_gb=max_memory_gb,
+        )
+        shard_root = activations.shuffle(shuffle_cfg)
+        # Buckets left behind by an interrupted shuffle are ignored.
+        os.makedirs(os.path.join(shard_root, "tmp"))
+        for fname in ("acts000000.bin", "example_i000000.bin"):
+            with open(os.path.join(shard_root, "tmp", fname), "wb") as fd:
+                fd.write(b"\0" * 64)
+        assert activations.shuffle(shuffle_cfg) == shard_root
+        original = activations.Dataset(data_cfg)
+        shuffled = activations.Dataset(
+            dataclasses.replace(data_cfg, shard_root=shard_root)
+        )
+        assert shuffled.shuffled
+        assert len(shuffled) == len(original)
+
+        batch = shuffled.__getitems__(list(range(len(shuffled))))
+        i = batch["image_i"] * cfg.n_patches_per_img + batch["patch_i"]
+        assert sorted(i.tolist()) == list(range(len(original)))
+        assert i.tolist() != list(range(len(original)))
+        torch.testing.assert_close(
+            batch["act"], original.__getitems__(i.tolist())["act"]
+        )
+
+        example = shuffled[5]
+        assert example["image_i"] == batch["image_i"][5].item()
+        assert example["patch_i"] == batch["patch_i"][5].item()
+        torch.testing.assert_close(example["act"], batch["act"][5])
+
+
+def test_shuffled_dataset_needs_single_layer_patches():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        shard_root = activations.shuffle(
+            config.Shuffle(
+                data=make_dataload(cfg, layer=-1),
+                dump_to=os.path.join(tmpdir, "shuffled"),
+            )
+        )
+        with pytest.raises(ValueError):
+            activations.Dataset(
+                config.DataLoad(shard_root=shard_root, patches="cls", layer=-1)
+            )
+
+
+@pytest.mark.parametrize("dtype", ["float16", "bfloat16"])
+@pytest.mark.parametrize("patches,layer", [("patches", -1), ("cls", -2)])
+def test_half_precision_shards(dtype, patches, layer):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Side files are float32, so skip them to read the [CLS] tokens from the shards.
+        cfg32 = write_shards(tmpdir, side_files=False)
+        cfg16 = write_shards(tmpdir, dtype=dtype, side_files=False)
+        dataset32 = activations.Dataset(
+            make_dataload(cfg32, patches=patches, layer=layer)
+        )
+        dataset16 = activations.Dataset(
+            make_dataload(cfg16, patches=patches, layer=layer)
+        )
+        assert dataset16.metadata.dtype == dtype
+
+        shard_fpath = os.path.join(activations.get_acts_dir(cfg16), "acts000000.bin")
+        assert os.path.getsize(shard_fpath) * 2 == os.path.getsize(
+            os.path.join(activations.get_acts_dir(cfg32), "acts000000.bin")
+        )
+
+        indices = list(range(len(dataset32)))
+        expected = dataset32.__getitems__(indices)["act"].to(getattr(torch, dtype))
+        actual = dataset16.__getitems__(indices)["act"]
+        assert actual.dtype == torch.float32
+        torch.testing.assert_close(actual, expected.float())
+        torch.testing.assert_close(dataset16[3]["act"], actual[3])
+
+
+@pytest.mark.parametrize("dtype", ["float16", "bfloat16"])
+def test_half_precision_meanpool(dtype):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg32 = write_shards(tmpdir)
+        cfg16 = write_shards(tmpdir, dtype=dtype)
+        dataset32 = activations.Dataset(make_dataload(cfg32, patches="meanpool"))
+        dataset16 = activations.Dataset(make_dataload(cfg16, patches="meanpool"))
+
+        indices = list(range(len(dataset32)))
+        torch.testing.assert_close(
+            dataset16.__getitems__(indices)["act"],
+            dataset32.__getitems__(indices)["act"],
+            atol=2e-2,
+            rtol=2e-2,
+        )
+
+
+def test_int8_round_trip():
+    x = torch.randn(3, 5, 64, generator=torch.Generator().manual_seed(0))
+    x = x * torch.logspace(-3, 3, 5)[:, None]
+    x[0, 0] = 0.0
+    stored = activations.to_storage(x, "int8")
+    assert stored.shape == (3, 5, activations.get_row_size("int8", 64))
+
+    x_hat = torch.from_numpy(activations.from_storage(stored, "int8"))
+    # Rounding error is at most half a quantization step.
+    step = x.abs().amax(dim=-1, keepdim=True) / 127
+    assert ((x_hat - x).abs() <= step * 0.501).all()
+    assert (x_hat[0, 0] == 0).all()
+
+
+@pytest.mark.parametrize("patches,layer", [("patches", -1), ("cls", -2)])
+def test_int8_shards(patches, layer):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg32 = write_shards(tmpdir)
+        cfg8 = write_shards(tmpdir, dtype="int8")
+        dataset32 = activations.Dataset(
+            make_dataload(cfg32, patches=patches, layer=layer)
+        )
+        dataset8 = activations.Dataset(
+            make_dataload(cfg8, patches=patches, layer=layer)
+        )
+
+        indices = list(range(len(dataset32)))
+        expected = dataset32.__getitems__(indices)["act"]
+        actual = dataset8.__getitems__(indices)["act"]
+        step = expected.abs().amax(dim=-1, keepdim=True) / 127
+        assert ((actual - expected).abs() <= step).all()
+        torch.testing.assert_close(dataset8[3]["act"], actual[3])
+
+
+@pytest.mark.parametrize("dtype", ["bfloat16", "int8"])
+def test_shuffle_keeps_dtype(dtype):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir, dtype=dtype)
+        data_cfg = make_dataload(cfg, layer=-1)
+        shard_root = activations.shuffle(
+            config.Shuffle(data=data_cfg, dump_to=os.path.join(tmpdir, "shuffled"))
+        )
+        original = activations.Dataset(data_cfg)
+        shuffled = activations.Dataset(
+            dataclasses.replace(data_cfg, shard_root=shard_root)
+        )
+        assert shuffled.metadata.dtype == dtype
+
+        batch = shuffled.__getitems__(list(range(len(shuffled))))
+        i = batch["image_i"] * cfg.n_patches_per_img + batch["patch_i"]
+        torch.testing.assert_close(
+            batch["act"], original.__getitems__(i.tolist())["act"]
+        )
+
+
+@pytest.mark.parametrize(
+    "patches,layer",
+    [("patches", -1), ("cls", -2), ("cls", "meanpool"), ("meanpool", "meanpool")],
+)
+def test_layer_major_shards(patches, layer):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        cfg_layer = write_shards(tmpdir, layout="layer-major")
+        dataset = activations.Dataset(make_dataload(cfg, patches=patches, layer=layer))
+        dataset_layer = activations.Dataset(
+            make_dataload(cfg_layer, patches=patches, layer=layer)
+        )
+        assert dataset_layer.metadata.layout == "layer-major"
+
+        indices = list(range(len(dataset)))
+        torch.testing.assert_close(
+            dataset_layer.__getitems__(indices)["act"],
+            dataset.__getitems__(indices)["act"],
+        )
+        torch.testing.assert_close(dataset_layer[5]["act"], dataset[5]["act"])
+
+
+def test_layer_major_shards_are_contiguous():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir, layout="layer-major")
+        dataset = activations.Dataset(make_dataload(cfg, layer=-2))
+
+        shard = dataset.get_shard(0)
+        raw = np.fromfile(
+            os.path.join(activations.get_acts_dir(cfg), "acts000000.bin"),
+            dtype=np.float32,
+        )
+        np.testing.assert_array_equal(raw[: shard[:, 0].size], shard[:, 0].ravel())
+
+
+def test_relayout():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir, n_imgs=23)
+        data_cfg = make_dataload(cfg, layer=-1)
+        shard_root = activations.relayout(
+            config.Relayout(
+                shard_root=data_cfg.shard_root,
+                layout="layer-major",
+                dump_to=os.path.join(tmpdir, "relayout"),
+            )
+        )
+        assert shard_root == activations.get_acts_dir(
+            dataclasses.replace(
+                cfg, layout="layer-major", dump_to=os.path.join(tmpdir, "relayout")
+            )
+        )
+
+        original = activations.Dataset(data_cfg)
+        relayed = activations.Dataset(
+            dataclasses.replace(data_cfg, shard_root=shard_root)
+        )
+        indices = list(range(len(original)))
+        torch.testing.assert_close(
+            relayed.__getitems__(indices)["act"], original.__getitems__(indices)["act"]
+        )
+
+
+def test_metadata_hash_ignores_default_fields():
+    # Hash of shards written before Metadata had any optional fields.
+    metadata = activations.Metadata(
+        "clip", "ViT-B-32/openai", (-2,), 49, True, 768, 42, 10, 1000, "data"
+    )
+    assert (
+        metadata.hash
+        == "80af613f775b9481d371ff542d13d8bf5a0afac4d814014bb57c323d44c4a747"
+    )
+    assert dataclasses.replace(metadata, dtype="float16").hash != metadata.hash
+    # Dumps in a newer shard format keep the directory of the same config.
+    assert dataclasses.replace(metadata, version=2).hash == metadata.hash
+
+
+def test_metadata_hash_includes_draft_jpegs(tmp_path):
+    write_jpegs(str(tmp_path), n_imgs=2, size=(32, 32))
+    cfg = config.Activations(data=config.ImageFolderDataset(str(tmp_path)))
+    drafted = activations.Metadata.from_cfg(cfg)
+    full = activations.Metadata.from_cfg(dataclasses.replace(cfg, draft_jpegs=False))
+    assert drafted.draft_jpegs and not full.draft_jpegs
+    assert drafted.hash != full.hash
+
+
+def test_last_shard_is_trimmed():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir, n_imgs=20)
+        shard_root = activations.get_acts_dir(cfg)
+        metadata = activations.Metadata.load(os.path.join(shard_root, "metadata.json"))
+        assert metadata.version == 2
+        assert metadata.n_imgs_per_shard == 7
+
+        index = activations.load_index(shard_root)
+        assert [shard.start for shard in index] == [0, 7, 14]
+        assert [shard.shape[0] for shard in index] == [7, 7, 6]
+        for shard in index:
+            fpath = os.path.join(shard_root, shard.fname)
+            assert os.path.getsize(fpath) == shard.nbytes
+            assert shard.nbytes == np.prod(shard.shape) * 4
+        activations.check_shards(shard_root, metadata, index, checksums=True)
+
+        dataset = activations.Dataset(make_dataload(cfg, layer=-1))
+        assert dataset.get_shard(2).shape == (6, 2, 5, 8)
+        last = dataset.__getitems__([len(dataset) - 1])["act"]
+        torch.testing.assert_close(dataset[len(dataset) - 1]["act"], last[0])
+
+
+def test_shard_writer_rejects_extra_images():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir, n_imgs=14)
+        writer = activations.ShardWriter(cfg)
+        acts = torch.zeros((15, 2, 5, 8))
+        with pytest.raises(IndexError):
+            writer[0:15] = acts
+        assert not os.path.exists(
+            os.path.join(activations.get_acts_dir(cfg), "acts000002.bin")
+        )
+
+
+def test_check_shards_detects_damage():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        shard_root = activations.get_acts_dir(cfg)
+        metadata = activations.Metadata.load(os.path.join(shard_root, "metadata.json"))
+        index = activations.load_index(shard_root)
+
+        fpath = os.path.join(shard_root, "acts000001.bin")
+        with open(fpath, "r+b") as fd:
+            fd.write(b"\x00\x01\x02\x03")
+        activations.check_shards(shard_root, metadata, index)
+        with pytest.raises(RuntimeError):
+            activations.check_shards(shard_root, metadata, index, checksums=True)
+
+        os.truncate(fpath, 100)
+        with pytest.raises(RuntimeError):
+            activations.Dataset(make_dataload(cfg, layer=-1))
+
+
+@pytest.mark.parametrize("in_place", [False, True])
+def test_version_1_shards(in_place):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir, n_imgs=20)
+        data_cfg = make_dataload(cfg, layer=-1)
+        expected = activations.Dataset(data_cfg).__getitems__(list(range(20 * 4)))
+
+        # Version 1 shards have no index and a full-size last shard.
+        shard_root = data_cfg.shard_root
+        metadata_fpath = os.path.join(shard_root, "metadata.json")
+        metadata = activations.Metadata.load(metadata_fpath)
+        dataclasses.replace(metadata, version=1).dump(metadata_fpath)
+        os.remove(os.path.join(shard_root, "shards.json"))
+        os.truncate(os.path.join(shard_root, "acts000002.bin"), 7 * 2 * 5 * 8 * 4)
+
+        dataset = activations.Dataset(data_cfg)
+        assert dataset.index is None
+        actual = dataset.__getitems__(list(range(20 * 4)))
+        torch.testing.assert_close(actual["act"], expected["act"])
+
+        # Upgrading in place keeps the directory, since the hash leaves out the version.
+        dump_to = cfg.dump_to if in_place else os.path.join(tmpdir, "v2")
+        relayed_root = activations.relayout(
+            config.Relayout(shard_root=shard_root, layout="img-major", dump_to=dump_to)
+        )
+        assert (relayed_root == shard_root) == in_place
+        assert sorted(os.listdir(dump_to)) == [os.path.basename(relayed_root)]
+        relayed = activations.Dataset(
+            dataclasses.replace(data_cfg, shard_root=relayed_root)
+        )
+        assert relayed.metadata.version == 2
+        torch.testing.assert_close(
+            relayed.__getitems__(list(range(20 * 4)))["act"], expected["act"]
+        )
+
+
+@pytest.mark.parametrize("compression", ["zlib", "zstd"])
+@pytest.mark.parametrize("dtype", ["float32", "bfloat16"])
+def test_compress_chunk_round_trip(compression, dtype):
+    acts = activations.to_storage(torch.randn(3, 2, 5, 8), dtype)
+    buf = activations.compress_chunk(acts, compression)
+    np.testing.assert_array_equal(
+        activations.decompress_chunk(
+            buf, compression, dtype=acts.dtype, shape=acts.shape
+        ),
+        acts,
+    )
+
+
+@pytest.mark.parametrize("compression", ["zlib", "zstd"])
+@pytest.mark.parametrize(
+    "patches,layer", [("patches", -1), ("cls", -2), ("meanpool", "meanpool")]
+)
+def test_compressed_shards(compression, patches, layer):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        cfg_z = write_shards(tmpdir, compression=compression, n_imgs_per_chunk=3)
+        shard_root = activations.get_acts_dir(cfg_z)
+        assert not any(fname.endswith(".raw") for fname in os.listdir(shard_root))
+
+        dataset = activations.Dataset(make_dataload(cfg, patches=patches, layer=layer))
+        dataset_z = activations.Dataset(
+            make_dataload(cfg_z, patches=patches, layer=layer, max_cached_chunks=2)
+        )
+        assert [len(shard.chunk_offsets) for shard in dataset_z.index] == [4, 4, 3]
+
+        # Out of order, with repeats, so we bounce between chunks and shards.
+        indices = np.random.default_rng(seed=0).integers(len(dataset), size=50).tolist()
+        torch.testing.assert_close(
+            dataset_z.__getitems__(indices)["act"], dataset.__getitems__(indices)["act"]
+        )
+        for i in indices[:10]:
+            torch.testing.assert_close(dataset_z[i]["act"], dataset[i]["act"])
+        assert len(dataset_z._chunks) <= 2
+
+
+def test_compressed_shards_relayout():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir, compression="zlib")
+        data_cfg = make_dataload(cfg, layer=-1)
+        shard_root = activations.relayout(
+            config.Relayout(
+                shard_root=data_cfg.shard_root,
+                layout="img-major",
+                dump_to=os.path.join(tmpdir, "raw"),
+            )
+        )
+        original = activations.Dataset(data_cfg)
+        raw = activations.Dataset(dataclasses.replace(data_cfg, shard_root=shard_root))
+        assert raw.metadata.compression == "none"
+
+        indices = list(range(len(original)))
+        torch.testing.assert_close(
+            raw.__getitems__(indices)["act"], original.__getitems__(indices)["act"]
+        )
+
+
+@pytest.mark.parametrize(
+    "patches,layer",
+    [("cls", -2), ("cls", "meanpool"), ("meanpool", -1), ("meanpool", "meanpool")],
+)
+def test_side_files_match_shards(patches, layer):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        dataset = activations.Dataset(make_dataload(cfg, patches=patches, layer=layer))
+        assert dataset.get_side_file(patches) is not None
+
+        # Same activations, so the same directory; the writer removes the old side files.
+        without = write_shards(tmpdir, side_files=False)
+        dataset_without = activations.Dataset(
+            make_dataload(without, patches=patches, layer=layer)
+        )
+        assert dataset_without.get_side_file(patches) is None
+
+        indices = [3, 0, 19, 3, 7]
+        torch.testing.assert_close(
+            dataset.__getitems__(indices)["act"],
+            dataset_without.__getitems__(indices)["act"],
+        )
+        torch.testing.assert_close(dataset[7]["act"], dataset_without[7]["act"])
+
+
+def test_dump_side_files():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        shard_root = activations.get_acts_dir(cfg)
+        expected = {
+            name: np.load(os.path.join(shard_root, f"{name}.npy"))
+            for name in ("cls", "meanpool")
+        }
+        for name in expected:
+            os.remove(os.path.join(shard_root, f"{name}.npy"))
+
+        activations.dump_side_files(shard_root, n_imgs_per_batch=3)
+        for name, side in expected.items():
+            np.testing.assert_allclose(
+                np.load(os.path.join(shard_root, f"{name}.npy")), side, rtol=1e-6
+            )
+
+
+@pytest.mark.parametrize("scale_mean", [True, False])
+def test_norm_stats_match_samples(scale_mean):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir, stats=False)
+        dataload = make_dataload(
+            cfg,
+            scale_mean=scale_mean,
+            scale_norm=True,
+            n_random_samples=50,
+            n_stats_workers=0,
+        )
+        dataset = activations.Dataset(dataload)
+
+        raw = activations.Dataset(make_dataload(cfg))
+        perm = np.random.default_rng(seed=42).permutation(len(raw))[:50]
+        samples = torch.stack([raw[i]["act"] for i in perm.tolist()])
+        act_mean = samples.mean(dim=0) if scale_mean else torch.zeros(cfg.d_vit)
+        l2_mean = torch.linalg.norm(samples - act_mean, dim=1).mean()
+
+        torch.testing.assert_close(dataset.act_mean, act_mean)
+        torch.testing.assert_close(dataset.scalar, l2_mean / math.sqrt(cfg.d_vit))
+
+
+def test_norm_stats_are_cached():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir, stats=False)
+        dataload = make_dataload(
+            cfg, scale_mean=True, scale_norm=True, n_stats_workers=0
+        )
+        dataset = activations.Dataset(dataload)
+
+        stats_dpath = os.path.join(dataload.shard_root, "stats")
+        (fname,) = os.listdir(stats_dpath)
+        # Overwrite the cached stats; a new dataset should read them instead of recomputing.
+        stats = torch.load(os.path.join(stats_dpath, fname), weights_only=True)
+        stats["act_mean"] = torch.ones_like(stats["act_mean"])
+        torch.save(stats, os.path.join(stats_dpath, fname))
+
+        cached = activations.Dataset(dataload)
+        torch.testing.assert_close(cached.act_mean, torch.ones(cfg.d_vit))
+        torch.testing.assert_close(cached.scalar, dataset.scalar)
+
+        # Different settings use different stats.
+        other = activations.Dataset(dataclasses.replace(dataload, layer=-1))
+        assert len(os.listdir(stats_dpath)) == 2
+        assert not torch.equal(other.act_mean, cached.act_mean)
+
+
+@pytest.mark.parametrize("patches", ["cls", "patches"])
+def test_act_stats_match_shards(patches):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        stats = activations.load_act_stats(activations.get_acts_dir(cfg))[patches]
+
+        dataset = activations.Dataset(make_dataload(cfg, patches=patches, layer=-1))
+        x = torch.stack([dataset[i]["act"] for i in range(len(dataset))]).double()
+        assert stats.n == len(dataset)
+        np.testing.assert_allclose(stats.mean[1], x.mean(dim=0), rtol=1e-5)
+        np.testing.assert_allclose(
+            stats.var[1], x.var(dim=0, correction=0), rtol=1e-5, atol=1e-7
+        )
+        np.testing.assert_allclose(stats.min[1], x.amin(dim=0))
+        np.testing.assert_allclose(stats.max[1], x.amax(dim=0))
+        np.testing.assert_allclose(stats.l2_mean[1], x.norm(dim=1).mean(), rtol=1e-5)
+        # Centered with running means of 7-image shards, so only roughly equal.
+        np.testing.assert_allclose(
+            stats.l2_mean_centered[1],
+            (x - x.mean(dim=0)).norm(dim=1).mean(),
+            rtol=5e-2,
+        )
+        assert stats.abs_hist[1].sum() == x.numel()
+        assert stats.get_abs_quantile(1.0)[1] == x.abs().max()
+        assert (stats.get_abs_quantile(0.5) <= stats.max_abs).all()
+
+
+def test_dataset_normalizes_with_act_stats():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        dataload = make_dataload(
+            cfg, scale_mean=False, scale_norm=True, layer=-1, n_stats_workers=0
+        )
+        stats = activations.load_act_stats(dataload.shard_root)["patches"]
+
+        dataset = activations.Dataset(dataload)
+        torch.testing.assert_close(
+            dataset.scalar,
+            torch.tensor(stats.l2_mean[1] / math.sqrt(cfg.d_vit), dtype=torch.float32),
+        )
+        assert not os.path.isdir(os.path.join(dataload.shard_root, "stats"))
+
+        # The centered norm is sampled, centered on the exact mean.
+        dataload = dataclasses.replace(dataload, scale_mean=True, n_random_samples=50)
+        dataset = activations.Dataset(dataload)
+        act_mean = torch.from_numpy(stats.mean[1]).float()
+        torch.testing.assert_close(dataset.act_mean, act_mean)
+        raw = activations.Dataset(make_dataload(cfg, layer=-1))
+        perm = np.random.default_rng(seed=42).permutation(len(raw))[:50]
+        samples = torch.stack([raw[i]["act"] for i in perm.tolist()])
+        l2_mean = torch.linalg.norm(samples - act_mean, dim=1).mean()
+        torch.testing.assert_close(dataset.scalar, l2_mean / math.sqrt(cfg.d_vit))
+        assert os.path.isdir(os.path.join(dataload.shard_root, "stats"))
+
+        # Activations that would be clamped need sampled statistics of the clamped activations.
+        clamped = activations.Dataset(dataclasses.replace(dataload, clamp=0.5))
+        assert os.path.isdir(os.path.join(dataload.shard_root, "stats"))
+        assert not torch.equal(clamped.act_mean, dataset.act_mean)
+
+
+def test_act_stats_of_unfinished_dump_are_ignored():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        shard_root = activations.get_acts_dir(cfg)
+        stats = activations.load_act_stats(shard_root)
+        stats["patches"].n -= 1
+        activations.dump_act_stats(shard_root, stats)
+
+        dataload = make_dataload(
+            cfg, scale_mean=True, scale_norm=True, n_stats_workers=0
+        )
+        activations.Dataset(dataload)
+        assert os.path.isdir(os.path.join(shard_root, "stats"))
+
+
+@pytest.mark.parametrize("patches", ["cls", "patches", "meanpool"])
+def test_in_memory_matches_shards(patches):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        dataset = activations.Dataset(make_dataload(cfg, patches=patches))
+        in_memory = activations.Dataset(
+            make_dataload(cfg, patches=patches, in_memory=True)
+        )
+        assert in_memory.memory is not None
+        assert len(in_memory) == len(dataset)
+
+        indices = np.random.default_rng(seed=0).permutation(len(dataset)).tolist()
+        expected = dataset.__getitems__(indices)
+        actual = in_memory.__getitems__(indices)
+        for key in ("act", "image_i", "patch_i"):
+            torch.testing.assert_close(actual[key], expected[key])
+
+        example = in_memory[indices[0]]
+        torch.testing.assert_close(example["act"], dataset[indices[0]]["act"])
+        assert example["image_i"] == dataset[indices[0]]["image_i"]
+
+
+def test_in_memory_shared_survives_pickle():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        dataset = activations.Dataset(
+            make_dataload(cfg, in_memory=True, share_memory=True)
+        )
+        assert dataset.memory["act"].is_shared()
+
+        clone = pickle.loads(pickle.dumps(dataset))
+        torch.testing.assert_close(clone.memory["act"], dataset.memory["act"])
+
+
+@pytest.mark.parametrize("shuffle", [True, False])
+def test_in_memory_loader_visits_every_example(shuffle):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        dataset = activations.Dataset(make_dataload(cfg, in_memory=True))
+        loader = activations.InMemoryLoader(
+            dataset, batch_size=16, shuffle=shuffle, seed=3
+        )
+        assert len(loader) == math.ceil(len(dataset) / 16)
+
+        batches = list(loader)
+        assert len(batches) == len(loader)
+        act = torch.cat([batch["act"] for batch in batches])
+        image_i = torch.cat([batch["image_i"] for batch in batches])
+        patch_i = torch.cat([batch["patch_i"] for batch in batches])
+        i = image_i * dataset.metadata.n_patches_per_img + patch_i
+        assert sorted(i.tolist()) == list(range(len(dataset)))
+        assert (i == torch.arange(len(dataset))).all() != shuffle
+        torch.testing.assert_close(act, dataset.memory["act"][i])
+
+        # Another epoch gets another order.
+        again = torch.cat([batch["image_i"] for batch in loader])
+        assert torch.equal(again, image_i) != shuffle
+
+
+def test_in_memory_loader_drop_last():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        dataset = activations.Dataset(make_dataload(cfg, in_memory=True))
+        loader = activations.InMemoryLoader(
+            dataset, batch_size=16, shuffle=False, drop_last=True
+        )
+        assert len(loader) == len(dataset) // 16
+        assert all(len(batch["act"]) == 16 for batch in loader)
+
+
+@pytest.mark.parametrize(
+    "device",
+    [
+        "cpu",
+        pytest.param(
+            "cuda",
+            marks=pytest.mark.skipif(not torch.cuda.is_available(), reason="no GPU"),
+        ),
+    ],
+)
+def test_in_memory_loader_on_device(device):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        dataset = activations.Dataset(make_dataload(cfg))
+        loader = activations.InMemoryLoader(
+            dataset, batch_size=16, shuffle=True, seed=3, device=device
+        )
+        assert dataset.memory is None
+
+        batches = list(loader)
+        assert all(batch["act"].device.type == device for batch in batches)
+        patch_i = torch.cat([batch["patch_i"] for batch in batches]).cpu()
+        image_i = torch.cat([batch["image_i"] for batch in batches]).cpu()
+        act = torch.cat([batch["act"] for batch in batches]).cpu()
+        torch.testing.assert_close(
+            act,
+            dataset.__getitems__(
+                (image_i * dataset.metadata.n_patches_per_img + patch_i).tolist()
+            )["act"],
+        )
+
+
+@pytest.mark.parametrize(
+    "patches,kwargs",
+    [
+        ("patches", {}),
+        ("patches", {"layout": "layer-major"}),
+        ("patches", {"compression": "zlib"}),
+        ("cls", {"side_files": False}),
+        ("meanpool", {}),
+    ],
+)
+def test_shard_reader_matches_dataset(patches, kwargs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir, **kwargs)
+        dataset = activations.Dataset(make_dataload(cfg, patches=patches, layer=-1))
+        reader = activations.ShardReader(dataset, batch_size=9)
+
+        batches = list(reader)
+        assert len(batches) == len(reader) == math.ceil(len(dataset) / 9)
+        expected = dataset.__getitems__(list(range(len(dataset))))
+        for key in ("act", "image_i", "patch_i"):
+            actual = torch.cat([batch[key] for batch in batches])
+            torch.testing.assert_close(actual, expected[key])
+
+        if patches == "patches":
+            assert reader.n_bytes_read > 0
+            assert reader.n_bytes_prefetched > 0
+        assert reader.stall_s > 0
+
+
+def test_shard_reader_counts_one_layer():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        counts = {}
+        for layout in ("img-major", "layer-major"):
+            cfg = write_shards(tmpdir, layout=layout)
+            dataset = activations.Dataset(make_dataload(cfg, layer=-1))
+            reader = activations.ShardReader(dataset, batch_size=9, drop_behind=False)
+            list(reader)
+            counts[layout] = reader.n_bytes_read
+
+        # Layer-major shards only have to read one of the two layers.
+        assert counts["img-major"] == 2 * counts["layer-major"]
+
+
+def test_shard_reader_shuffled_and_drop_last():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        shuffle_cfg = config.Shuffle(
+            data=make_dataload(cfg, layer=-1),
+            dump_to=os.path.join(tmpdir, "shuffled"),
+            n_patches_per_shard=30,
+        )
+        shard_root = activations.shuffle(shuffle_cfg)
+        dataset = activations.Dataset(
+            config.DataLoad(
+                shard_root=shard_root, layer=-1, scale_mean=False, scale_norm=False
+            )
+        )
+        reader = activations.ShardReader(dataset, batch_size=16, drop_last=True)
+
+        batches = list(reader)
+        assert len(batches) == len(dataset) // 16
+        actual = torch.cat([batch["act"] for batch in batches])
+        expected = dataset.__getitems__(list(range(len(actual))))["act"]
+        torch.testing.assert_close(actual, expected)
+
+
+def test_shard_cache_copies_shards():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        cache_dir = os.path.join(tmpdir, "cache")
+        dataload = make_dataload(cfg, cache_dir=cache_dir)
+        dataset = activations.Dataset(dataload)
+        expected = activations.Dataset(make_dataload(cfg)).__getitems__(
+            list(range(len(dataset)))
+        )
+
+        # The first read comes from the original shards and starts the copies.
+        actual = dataset.__getitems__(list(range(len(dataset))))
+        torch.testing.assert_close(actual["act"], expected["act"])
+        dataset._cache.wait()
+
+        n_shards = dataset.metadata.n_shards
+        (dpath,) = os.listdir(cache_dir)
+        assert sorted(os.listdir(os.path.join(cache_dir, dpath))) == [
+            f"acts{shard:06}.bin" for shard in range(n_shards)
+        ]
+
+        # Later reads come from the local copies.
+        actual = dataset.__getitems__(list(range(len(dataset))))
+        torch.testing.assert_close(actual["act"], expected["act"])
+        assert dataset.get_shard(0).filename.startswith(os.path.abspath(cache_dir))
+
+        # So do reads from a new dataset.
+        dataset = activations.Dataset(dataload)
+        assert dataset.get_shard(1).filename.startswith(os.path.abspath(cache_dir))
+
+
+def test_shard_cache_evicts_least_recently_used():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        shard_root = activations.get_acts_dir(cfg)
+        nbytes = os.path.getsize(os.path.join(shard_root, "acts000000.bin"))
+        cache = activations.ShardCache(
+            shard_root, os.path.join(tmpdir, "cache"), "key", 2 * nbytes
+        )
+
+        for fname in ("acts000000.bin", "acts000001.bin", "acts000000.bin"):
+            cache.get_fpath(fname, nbytes)
+            cache.wait()
+        # acts000000.bin was used more recently.
+        os.utime(os.path.join(cache.dpath, "acts000001.bin"), (0, 0))
+        cache.get_fpath(
+            "acts000002.bin",
+            os.path.getsize(os.path.join(shard_root, "acts000002.bin")),
+        )
+        cache.wait()
+
+        assert sorted(os.listdir(cache.dpath)) == ["acts000000.bin", "acts000002.bin"]
+
+
+def test_shard_cache_replaces_stale_copies():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        shard_root = activations.get_acts_dir(cfg)
+        cache = activations.ShardCache(
+            shard_root, os.path.join(tmpdir, "cache"), "key", 2**30
+        )
+        with open(os.path.join(cache.dpath, "acts000000.bin"), "wb") as fd:
+            fd.write(b"stale")
+
+        nbytes = os.path.getsize(os.path.join(shard_root, "acts000000.bin"))
+        assert cache.get_fpath("acts000000.bin", nbytes).startswith(shard_root)
+        cache.wait()
+        assert cache.get_fpath("acts000000.bin", nbytes).startswith(cache.dpath)
+
+
+def test_shard_cache_takes_over_dead_copies():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        shard_root = activations.get_acts_dir(cfg)
+        nbytes = os.path.getsize(os.path.join(shard_root, "acts000000.bin"))
+        cache = activations.ShardCache(
+            shard_root, os.path.join(tmpdir, "cache"), "key", 2 * nbytes
+        )
+        # Partial copies left behind by copiers that were killed.
+        for fname in ("acts000000.bin.tmp", "acts000001.bin.tmp"):
+            with open(os.path.join(cache.dpath, fname), "wb") as fd:
+                fd.write(b"\0" * nbytes)
+
+        cache.get_fpath("acts000000.bin", nbytes)
+        cache.wait()
+
+        # The first copy was taken over and the second one evicted.
+        assert os.listdir(cache.dpath) == ["acts000000.bin"]
+        with open(os.path.join(shard_root, "acts000000.bin"), "rb") as fd:
+            expected = fd.read()
+        with open(os.path.join(cache.dpath, "acts000000.bin"), "rb") as fd:
+            assert fd.read() == expected
+
+
+def test_shard_cache_skips_live_copies():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        shard_root = activations.get_acts_dir(cfg)
+        nbytes = os.path.getsize(os.path.join(shard_root, "acts000000.bin"))
+        cache = activations.ShardCache(
+            shard_root, os.path.join(tmpdir, "cache"), "key", 2 * nbytes
+        )
+        # Another process is copying shard 0.
+        tmp_fpath = os.path.join(cache.dpath, "acts000000.bin.tmp")
+        fd = activations.lock_file(tmp_fpath, os.O_CREAT | os.O_WRONLY)
+        assert fd is not None
+        try:
+            cache.get_fpath("acts000000.bin", nbytes)
+            cache.wait()
+            cache.evict(nbytes)
+            assert os.listdir(cache.dpath) == ["acts000000.bin.tmp"]
+        finally:
+            os.close(fd)
+
+
+def dump(
+    cfg: config.Activations,
+    acts: torch.Tensor,
+    batch_size: int,
+    *,
+    stop: int,
+    job: int | None = None,
+):
+    """Write `acts` like `worker_fn` does, in batches of `batch_size`, but stop (without flushing, as if we crashed) once image `stop` is written."""
+    writer = activations.ShardWriter(cfg, job=job)
+    start = writer.start // batch_size * batch_size
+    for i in range(start, writer.end, batch_size):
+        writer[i : min(i + batch_size, writer.end)] = acts[i : i + batch_size][
+            : writer.end - i
+        ]
+        if i + batch_size >= stop:
+            return writer
+    writer.flush()
+    return writer
+
+
+@pytest.mark.parametrize("stop", [3, 10, 15, 20])
+def test_resumed_dump_matches_uninterrupted_dump(stop):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        imgs_root = os.path.join(tmpdir, "imgs")
+        os.makedirs(imgs_root)
+        for i in range(20):
+            open(os.path.join(imgs_root, f"{i}.jpg"), "w").close()
+
+        cfgs = [
+            config.Activations(
+                data=config.ImageFolderDataset(imgs_root),
+                dump_to=os.path.join(tmpdir, name),
+                d_vit=8,
+                layers=[-2, -1],
+                n_patches_per_img=4,
+                n_patches_per_shard=7 * 2 * 5,
+            )
+            for name in ("uninterrupted", "resumed")
+        ]
+        acts = torch.randn((20, 2, 5, 8), generator=torch.Generator().manual_seed(0))
+
+        dump(cfgs[0], acts, 4, stop=20)
+        dump(cfgs[1], acts, 4, stop=stop)
+        writer = dump(cfgs[1], acts, 4, stop=20)
+        # Shards hold 7 images; a finished dump skips all 3.
+        assert writer.start == (21 if stop == 20 else stop // 7 * 7)
+
+        expected_root = activations.get_acts_dir(cfgs[0])
+        actual_root = activations.get_acts_dir(cfgs[1])
+        for fname in sorted(os.listdir(expected_root)):
+            if fname == "act_stats.npz":
+                continue
+            with open(os.path.join(expected_root, fname), "rb") as fd:
+                expected = fd.read()
+            with open(os.path.join(actual_root, fname), "rb") as fd:
+                assert fd.read() == expected, fname
+
+        # Statistics are merged in a different order, so they are only close.
+        expected = activations.load_act_stats(expected_root)
+        actual = activations.load_act_stats(actual_root)
+        for name, stat in expected.items():
+            assert actual[name].n == stat.n
+            np.testing.assert_allclose(actual[name].mean, stat.mean, rtol=1e-6)
+            np.testing.assert_array_equal(actual[name].abs_hist, stat.abs_hist)
+
+
+def test_dump_starts_over_without_resume():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        assert activations.ShardWriter(cfg).start == 21
+        cfg = dataclasses.replace(cfg, resume=False)
+        assert activations.ShardWriter(cfg).start == 0
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2, 3])
+def test_get_job_shards(n_jobs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir, n_imgs=50)
+    metadata = activations.Metadata.from_cfg(cfg)
+    shards = [
+        shard
+        for job in range(n_jobs)
+        for shard in activations.get_job_shards(metadata, n_jobs, job)
+    ]
+    assert shards == list(range(metadata.n_shards))
+    sizes = [
+        len(activations.get_job_shards(metadata, n_jobs, j)) for j in range(n_jobs)
+    ]
+    assert max(sizes) - min(sizes) <= 1
+
+
+@pytest.mark.parametrize("n_jobs", [2, 3])
+def test_parallel_dump_matches_single_dump(n_jobs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        imgs_root = os.path.join(tmpdir, "imgs")
+        os.makedirs(imgs_root)
+        for i in range(20):
+            open(os.path.join(imgs_root, f"{i}.jpg"), "w").close()
+
+        cfgs = [
+            config.Activations(
+                data=config.ImageFolderDataset(imgs_root),
+                dump_to=os.path.join(tmpdir, name),
+                d_vit=8,
+                layers=[-2, -1],
+                n_patches_per_img=4,
+                n_patches_per_shard=7 * 2 * 5,
+                n_jobs=n,
+            )
+            for name, n in (("single", 1), ("parallel", n_jobs))
+        ]
+        acts = torch.randn((20, 2, 5, 8), generator=torch.Generator().manual_seed(0))
+
+        dump(cfgs[0], acts, 4, stop=20)
+        activations.prepare_jobs(cfgs[1])
+        # Jobs finish in any order.
+        for job in reversed(range(n_jobs)):
+            dump(cfgs[1], acts, 4, stop=20, job=job)
+        shard_root = activations.assemble_jobs(cfgs[1])
+
+        expected_root = activations.get_acts_dir(cfgs[0])
+        for fname in sorted(os.listdir(expected_root)):
+            if fname == "act_stats.npz":
+                continue
+            with open(os.path.join(expected_root, fname), "rb") as fd:
+                expected = fd.read()
+            with open(os.path.join(shard_root, fname), "rb") as fd:
+                assert fd.read() == expected, fname
+
+        expected = activations.load_act_stats(expected_root)
+        actual = activations.load_act_stats(shard_root)
+        for name, stat in expected.items():
+            assert actual[name].n == stat.n
+            np.testing.assert_allclose(actual[name].mean, stat.mean, atol=1e-6)
+            np.testing.assert_allclose(actual[name].var, stat.var, rtol=1e-5)
+            np.testing.assert_array_equal(actual[name].max, stat.max)
+            np.testing.assert_array_equal(actual[name].abs_hist, stat.abs_hist)
+
+        dataset = activations.Dataset(make_dataload(cfgs[1], layer=-1))
+        torch.testing.assert_close(dataset[9]["act"], acts[2, 1, 2])
+
+
+def test_parallel_dump_resumes_each_job():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = dataclasses.replace(write_shards(tmpdir), n_jobs=2)
+        acts = torch.randn((20, 2, 5, 8), generator=torch.Generator().manual_seed(0))
+
+        # A single-job dump's index doesn't count for parallel jobs.
+        activations.prepare_jobs(cfg)
+        assert not os.path.isfile(
+            os.path.join(activations.get_acts_dir(cfg), "shards.json")
+        )
+        # Job 0 has shard 0 and job 1 has shards 1 and 2; job 1 crashes after shard 1.
+        dump(cfg, acts, 4, stop=20, job=0)
+        dump(cfg, acts, 4, stop=16, job=1)
+        with pytest.raises(RuntimeError, match="Job 1"):
+            activations.assemble_jobs(cfg)
+
+        activations.prepare_jobs(cfg)
+        assert activations.ShardWriter(cfg, job=0).start == 7
+        writer = dump(cfg, acts, 4, stop=20, job=1)
+        assert writer.start == 14
+        activations.assemble_jobs(cfg)
+
+        dataset = activations.Dataset(make_dataload(cfg, layer=-2))
+        assert len(dataset) == 20 * 4
+        torch.testing.assert_close(dataset[79]["act"], acts[19, 0, 4])
+
+
+@pytest.mark.parametrize("max_queue", [1, 3])
+def test_async_shard_writer_matches_shard_writer(max_queue):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = write_shards(tmpdir)
+        acts = torch.randn((20, 2, 5, 8), generator=torch.Generator().manual_seed(0))
+        shard_root = activations.get_acts_dir(cfg)
+        expected = {}
+        for fname in sorted(os.listdir(shard_root)):
+            if fname.endswith((".bin", ".npy")):
+                with open(os.path.join(shard_root, fname), "rb") as fd:
+                    expected[fname] = fd.read()
+
+        cfg = dataclasses.replace(cfg, resume=False)
+        writer = activations.AsyncShardWriter(activations.ShardWriter(cfg), max_queue)
+        for i in range(0, 20, 3):
+            writer[i : min(i + 3, 20)] = acts[i : i + 3]
+        writer.flush()
+
+        assert writer.n_bytes_written == acts.numel() * 4
+        assert 0 <= writer.mean_depth <= max_queue
+        for fname, content in expected.items():
+            with open(os.path.join(shard_root, fname), "rb") as fd:
+                assert fd.read() == content, fname
+
+
+def test_async_shard_writer_raises_writer_errors():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cfg = dataclasses.replace(write_shards(tmpdir), resume=False)
+        acts = torch.randn((24, 2, 5, 8))
+        writer = activations.AsyncShardWriter(activations.ShardWriter(cfg), 1)
+        # There are only 20 images.
+        writer[0:24] = acts
+        with pytest.raises(RuntimeError, match="Writing shards failed"):
+            writer.flush()
+        assert not writer.thread.is_alive()
+
+
+class ToyVit(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.blocks = torch.nn.ModuleList([torch.nn.Linear(8, 8) for _ in range(3)])
+
+    def get_residuals(self) -> list[torch.nn.Module]:
+        return self.blocks
+
+    def truncate(self, n_blocks: int) -> None:
+        self.blocks = self.blocks[:n_blocks]
+
+    def get_patches(self, cfg: config.Activations) -> slice:
+        return slice(None)
+
+    def forward(self, x):
+        for block in self.blocks:
+            x = block(x)
+        return x
+
+
+@pytest.mark.parametrize("write_queue_size", [0, 2])
+def test_recorder_host_buffers(write_queue_size):
+    cfg = config.Activations(
+        d_vit=8,
+        layers=[-2, -1],
+        n_patches_per_img=4,
+        vit_batch_size=4,
+        write_queue_size=write_queue_size,
+        device="cpu",
+    )
+    vit = ToyVit()
+    recorders = {
+        host_buffers: activations.Recorder(
+            cfg, vit, host_buffers=host_buffers
+        ).register(list(vit.blocks))
+        for host_buffers in (True, False)
+    }
+
+    n_buffers = write_queue_size + 2
+    batches = [torch.randn(4, 5, 8) for _ in range(n_buffers + 1)] + [
+        torch.randn(3, 5, 8)
+    ]
+    seen = []
+    with torch.inference_mode():
+        for x in batches:
+            for recorder in recorders.values():
+                recorder.reset()
+            vit(x)
+            acts = recorders[True].activations
+            torch.testing.assert_close(acts, recorders[False].activations)
+            assert acts.shape == (len(x), 2, 5, 8)
+            # Batches the writer may still hold are intact.
+            for prev, expected in seen[-(n_buffers - 1) :]:
+                torch.testing.assert_close(prev, expected)
+            seen.append((acts, acts.clone()))
+
+    # The ring reuses its buffers.
+    assert seen[n_buffers][0].data_ptr() == seen[0][0].data_ptr()
+
+
+def test_host_buffers_fit_the_batch(monkeypatch):
+    cfg = config.Activations(
+        d_vit=8, layers=[-1], n_patches_per_img=4, vit_batch_size=1024, device="cpu"
+    )
+    monkeypatch.setattr(activations, "make_vit", lambda cfg: ToyVit())
+    x = torch.randn(2, 5, 8)
+
+    # Off unless asked for, like in the web app.
+    wrapped = activations.WrappedVisionTransformer(cfg)
+    with torch.inference_mode():
+        wrapped(x)
+    assert not wrapped.recorder._ring
+
+    # Sized to the batch, not to `vit_batch_size`.
+    wrapped = activations.WrappedVisionTransformer(cfg, host_buffers=True)
+    with torch.inference_mode():
+        wrapped(x)
+    assert [len(buffer) for buffer in wrapped.recorder._ring] == [2, 2, 2]
+
+
+@pytest.mark.parametrize("host_buffers", [True, False])
+def test_recorder_to_device(host_buffers):
+    cfg = config.Activations(
+        d_vit=8,
+        layers=[-1],
+        n_patches_per_img=4,
+        vit_batch_size=4,
+        device="cpu",
+    )
+    vit = ToyVit()
+    recorder = activations.Recorder(cfg, vit, host_buffers=host_buffers).register(
+        list(vit.blocks)
+    )
+    x = torch.randn(4, 5, 8)
+    with torch.inference_mode():
+        recorder.reset()
+        vit(x)
+        expected = recorder.activations.clone()
+
+        # Moving the recorder (as worker_fn does with the wrapped ViT) keeps working.
+        recorder = recorder.to("cpu")
+        recorder.reset()
+        vit(x)
+        torch.testing.assert_close(recorder.activations, expected)
+
+
+@pytest.mark.parametrize("layers", [[-1], [-2], [0], [0, -2]])
+def test_truncated_vit_records_same_activations(monkeypatch, layers):
+    cfg = config.Activations(d_vit=8, layers=layers, n_patches_per_img=4)
+    vit = ToyVit()
+    monkeypatch.setattr(activations, "make_vit", lambda cfg: vit)
+    full = activations.Recorder(cfg, vit).register(vit.get_residuals())
+    x = torch.randn(4, 5, 8)
+    with torch.inference_mode():
+        full.reset()
+        vit(x)
+        expected = full.activations.clone()
+
+    wrapped = activations.WrappedVisionTransformer(cfg)
+    assert len(vit.blocks) == max(layer % 3 for layer in layers) + 1
+    with torch.inference_mode():
+        # `full` still records, too.
+        full.reset()
+        _, actual = wrapped(x)
+    torch.testing.assert_close(actual, expected, rtol=0, atol=0)
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize(
+    "model_family,model_ckpt,d_vit,n_patches_per_img",
+    [
+        ("clip", "ViT-B-32/openai", 768, 49),
+        ("siglip", "ViT-B-16-SigLIP/webli", 768, 196),
+    ],
+)
+def test_truncated_vit_matches_full_forward(
+    model_family, model_ckpt, d_vit, n_patches_per_img
+):
+    pytest.importorskip("open_clip")
+    cfg = config.Activations(
+        model_family=model_family,
+        model_ckpt=model_ckpt,
+        d_vit=d_vit,
+        n_patches_per_img=n_patches_per_img,
+        cls_token=model_family == "clip",
+        layers=[2, -2],
+    )
+    vit = activations.make_vit(cfg).eval()
+    full = activations.Recorder(cfg, vit).register(vit.get_residuals())
+    wrapped = activations.WrappedVisionTransformer(cfg).eval()
+
+    x = torch.randn(2, 3, 224, 224, generator=torch.Generator().manual_seed(0))
+    with torch.inference_mode():
+        full.reset()
+        vit(x)
+        expected = full.activations
+        _, actual = wrapped(x)
+    torch.testing.assert_close(actual, expected, rtol=0, atol=0)
+
+
+def make_open_clip_like_transform():
+    from torchvision import transforms
+
+    return transforms.Compose([
+        transforms.Resize(224, interpolation=transforms.InterpolationMode.BICUBIC),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+        transforms.Normalize(
+            mean=(0.48145466, 0.4578275, 0.40821073),
+            std=(0.26862954, 0.26130258, 0.27577711),
+        ),
+    ])
+
+
+@pytest.mark.parametrize("model_family", ["clip", "dinov2", "moondream2"])
+def test_split_img_transform_matches_img_transform(model_family):
+    if model_family == "clip":
+        img_transform = make_open_clip_like_transform()
+    else:
+        img_transform = activations.make_img_transform(model_family, "")
+    uint8_transform, img_normalize = activations.split_img_transform(img_transform)
+
+    rng = np.random.default_rng(0)
+    imgs = [
+        Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8))
+        for h, w in [(300, 400), (256, 256), (500, 240)]
+    ]
+    expected = torch.stack([img_transform(img) for img in imgs])
+    batch = torch.stack([uint8_transform(img) for img in imgs])
+    assert batch.dtype == torch.uint8
+    torch.testing.assert_close(img_normalize(batch), expected, rtol=0, atol=0)
+
+
+def test_split_img_transform_rejects_unknown_transforms():
+    from torchvision.transforms import v2
+
+    with pytest.raises(TypeError):
+        activations.split_img_transform(lambda img: img)
+    with pytest.raises(ValueError):
+        activations.split_img_transform(v2.Compose([v2.ToImage()]))
+
+
+def write_jpegs(dpath: str, n_imgs: int = 4, size: tuple[int, int] = (1200, 900)):
+    """Write smooth, photo-like JPEGs to `dpath`/`cls`/."""
+    os.makedirs(os.path.join(dpath, "cls"))
+    rng = np.random.default_rng(0)
+    w, h = size
+    y, x = np.mgrid[0:h, 0:w] / max(w, h)
+    for i in range(n_imgs):
+        freqs = rng.uniform(1, 20, size=(3, 2))
+        img = np.stack(
+            [
+                np.sin(fx * x * 2 * np.pi) * np.cos(fy * y * 2 * np.pi)
+                for fx, fy in freqs
+            ],
+            axis=-1,
+        )
+        img = (img + 1) * 127.5 + rng.normal(0, 4, img.shape)
+        img = Image.fromarray(img.clip(0, 255).astype(np.uint8))
+        img.save(os.path.join(dpath, "cls", f"{i}.jpg"), quality=90)
+
+
+def test_load_img_drafts_jpegs():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_jpegs(tmpdir, n_imgs=1)
+        fpath = os.path.join(tmpdir, "cls", "0.jpg")
+        assert activations.load_img(fpath).size == (1200, 900)
+        # 1/4 scale would be 300x225, smaller than 256.
+        assert activations.load_img(fpath, min_size=256).size == (600, 450)
+        with open(fpath, "rb") as fd:
+            img = activations.load_img(fd.read(), min_size=100)
+        assert img.size == (150, 113) and img.mode == "RGB"
+
+
+@pytest.mark.parametrize("model_family", ["dinov2", "moondream2"])
+def test_drafted_jpegs_match_full_decode(model_family):
+    img_transform = activations.make_img_transform(model_family, "")
+    cfg = config.ImageFolderDataset()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_jpegs(tmpdir)
+        cfg = dataclasses.replace(cfg, root=tmpdir)
+        full = activations.get_dataset(cfg, img_transform=img_transform)
+        drafted = activations.get_dataset(
+            cfg, img_transform=img_transform, draft_jpegs=True
+        )
+        assert activations.get_min_img_size(img_transform) is not None
+
+        for i in range(len(full)):
+            expected, actual = full[i]["image"], drafted[i]["image"]
+            assert drafted[i]["decode_s"] > 0
+            assert actual.shape == expected.shape
+            rel_err = (actual - expected).norm() / expected.norm()
+            assert rel_err < 0.05
+            # Patch means, which are roughly what a patch embedding sees.
+            patch_err = (
+                torch.nn.functional.avg_pool2d(actual - expected, 14).abs().max()
+            )
+            assert patch_err < 0.1
+
+
+class PatchToyVit(torch.nn.Module):
+    """A tiny ViT-shaped model with a real patch embedding, so its activations see every pixel."""
+
+    def __init__(self, d_vit: int = 32, patch_size: int = 14):
+        super().__init__()
+        torch.manual_seed(0)
+        self.embed = torch.nn.Conv2d(3, d_vit, patch_size, stride=patch_size)
+        self.blocks = torch.nn.ModuleList([
+            torch.nn.Sequential(
+                torch.nn.LayerNorm(d_vit),
+                torch.nn.Linear(d_vit, d_vit),
+                torch.nn.GELU(),
+            )
+            for _ in range(3)
+        ])
+
+    def forward(self, x):
+        """Every block's residual stream, like `Recorder.activations`."""
+        x = self.embed(x).flatten(2).transpose(1, 2)
+        residuals = []
+        for block in self.blocks:
+            x = x + block(x)
+            residuals.append(x)
+        return torch.stack(residuals, dim=1)
+
+
+def make_open_clip_img_transform():
+    """The eval transform that open_clip builds for OpenAI's CLIP (see `open_clip.image_transform`), without importing open_clip."""
+    from torchvision import transforms
+
+    return transforms.Compose([
+        transforms.Resize(224, interpolation=transforms.InterpolationMode.BICUBIC),
+        transforms.CenterCrop(224),
+        lambda img: img.convert("RGB"),
+        transforms.ToTensor(),
+        transforms.Normalize(
+            mean=(0.48145466, 0.4578275, 0.40821073),
+            std=(0.26862954, 0.26130258, 0.27577711),
+        ),
+    ])
+
+
+def test_min_img_size_of_open_clip_transform():
+    open_clip = pytest.importorskip("open_clip")
+    img_transform = open_clip.image_transform(224, is_train=False)
+    assert activations.get_min_img_size(img_transform) == 224
+    assert activations.get_min_img_size(make_open_clip_img_transform()) == 224
+
+
+@pytest.mark.parametrize("model_family", ["clip", "dinov2", "moondream2"])
+def test_drafted_jpegs_match_full_decode_activations(model_family):
+    if model_family == "clip":
+        img_transform = make_open_clip_img_transform()
+    else:
+        img_transform = activations.make_img_transform(model_family, "")
+    assert activations.get_min_img_size(img_transform) is not None
+
+    vit = PatchToyVit().eval()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_jpegs(tmpdir)
+        cfg = config.ImageFolderDataset(root=tmpdir)
+        full = activations.get_dataset(cfg, img_transform=img_transform)
+        drafted = activations.get_dataset(
+            cfg, img_transform=img_transform, draft_jpegs=True
+        )
+        with torch.inference_mode():
+            expected = vit(torch.stack([ex["image"] for ex in full]))
+            actual = vit(torch.stack([ex["image"] for ex in drafted]))
+
+    # About 1% overall (see the guide), and no patch far off.
+    assert (actual - expected).norm() / expected.norm() < 0.03
+    patch_err = (actual - expected).norm(dim=-1) / expected.norm(dim=-1)
+    assert patch_err.max() < 0.1
+    cos = torch.nn.functional.cosine_similarity(actual, expected, dim=-1)
+    assert cos.min() > 0.995
+
+
+def test_resized_imgs_match_source_dataset():
+    from torchvision.transforms import v2
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src_root = os.path.join(tmpdir, "src")
+        write_jpegs(src_root, n_imgs=3, size=(300, 200))
+        os.rename(os.path.join(src_root, "cls"), os.path.join(src_root, "a"))
+        write_jpegs(src_root, n_imgs=2, size=(150, 250))
+        src = config.ImageFolderDataset(root=src_root)
+
+        cfg = config.Resize(
+            data=src, dump_to=os.path.join(tmpdir, "resized"), size=64, n_workers=0
+        )
+        assert activations.resize_imgs(cfg) == cfg.dump_to
+        data = config.ResizedDataset(root=cfg.dump_to)
+        assert data.n_imgs == 5
+
+        source = activations.get_dataset(src, img_transform=None)
+        resized = activations.get_dataset(data, img_transform=None)
+        assert isinstance(resized, activations.ResizedImgs)
+        transform = v2.Compose([v2.Resize(64), v2.CenterCrop(64)])
+        for i in range(5):
+            example = resized[i]
+            assert example["image"].size == (64, 64)
+            path, target = source.samples[i]
+            expected = transform(activations.load_img(path, min_size=64))
+            np.testing.assert_array_equal(
+                np.asarray(example["image"]), np.asarray(expected)
+            )
+            assert example["target"] == target
+            assert example["label"] == source.classes[target]
+            assert example["src_index"] == i
+
+        # Models' transforms work on resized images.
+        img_transform = activations.make_img_transform("dinov2", "")
+        dataloader = activations.get_dataloader(
+            config.Activations(data=data, vit_batch_size=2, n_workers=0),
+            img_transform=img_transform,
+        )
+        batch = next(iter(dataloader))
+        assert batch["image"].shape == (2, 3, 224, 224)
+
+
+class ImgToyVit(torch.nn.Module):
+    """A tiny ViT-shaped model: average-pooled patches, a [CLS] token and linear blocks."""
+
+    def __init__(self, cfg: config.Activations):
+        super().__init__()
+        self.grid = math.isqrt(cfg.n_patches_per_img)
+        torch.manual_seed(cfg.d_vit)
+        self.embed = torch.nn.Linear(3, cfg.d_vit)
+        self.blocks = torch.nn.ModuleList([
+            torch.nn.Linear(cfg.d_vit, cfg.d_vit) for _ in range(3)
+        ])
+
+    def get_residuals(self) -> list[torch.nn.Module]:
+        return self.blocks
+
+    def truncate(self, n_blocks: int) -> None:
+        self.blocks = self.blocks[:n_blocks]
+
+    def get_patches(self, cfg: config.Activations) -> slice:
+        return slice(None)
+
+    def forward(self, x):
+        x = torch.nn.functional.adaptive_avg_pool2d(x, self.grid)
+        x = self.embed(x.flatten(2).transpose(1, 2))
+        x = torch.cat((x.mean(dim=1, keepdim=True), x), dim=1)
+        for block in self.blocks:
+            x = block(x)
+        return x
+
+
+def make_toy_img_transform(model_family: str, model_ckpt: str):
+    from torchvision.transforms import v2
+
+    size = int(model_ckpt)
+    return v2.Compose([
+        v2.Resize(size),
+        v2.CenterCrop(size),
+        v2.ToImage(),
+        v2.ToDtype(torch.float32, scale=True),
+        v2.Normalize(mean=[0.5, 0.4, 0.3], std=[0.2, 0.3, 0.4]),
+    ])
+
+
+@pytest.mark.parametrize("n_jobs", [1, 3])
+def test_multi_model_dump_matches_single_model_dumps(monkeypatch, n_jobs):
+    monkeypatch.setattr(activations, "make_vit", ImgToyVit)
+    monkeypatch.setattr(activations, "make_img_transform", make_toy_img_transform)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_jpegs(os.path.join(tmpdir, "imgs"), n_imgs=10, size=(80, 60))
+        cfg = config.Activations(
+            data=config.ImageFolderDataset(os.path.join(tmpdir, "imgs")),
+            vit_batch_size=3,
+            n_workers=0,
+            n_patches_per_shard=20,
+            n_jobs=n_jobs,
+            device="cpu",
+        )
+        # 4 images per shard for the first model, 2 for the second.
+        models = [
+            {"model_ckpt": "32", "d_vit": 8, "layers": [-1], "n_patches_per_img": 4},
+            {"model_ckpt": "48", "d_vit": 6, "layers": [0], "n_patches_per_img": 9},
+        ]
+        multi = config.expand_models(
+            dataclasses.replace(cfg, dump_to=os.path.join(tmpdir, "multi")), models
+        )
+        singles = config.expand_models(
+            dataclasses.replace(cfg, dump_to=os.path.join(tmpdir, "single")), models
+        )
+
+        def run(cfgs):
+            activations.check_models(cfgs)
+            if n_jobs == 1:
+                activations.worker_fn(cfgs)
+                return
+            for c in cfgs:
+                activations.prepare_jobs(c)
+            for job in range(n_jobs):
+                activations.worker_fn(cfgs, job)
+            for c in cfgs:
+                activations.assemble_jobs(c)
+
+        run(multi)
+        for single in singles:
+            run([single])
+
+        for m, single in zip(multi, singles):
+            expected_root = activations.get_acts_dir(single)
+            actual_root = activations.get_acts_dir(m)
+            fnames = [f for f in os.listdir(expected_root) if f.endswith(".bin")]
+            assert len(fnames) == activations.Metadata.from_cfg(m).n_shards
+            for fname in [*fnames, "shards.json", "cls.npy"]:
+                with open(os.path.join(expected_root, fname), "rb") as fd:
+                    expected = fd.read()
+                with open(os.path.join(actual_root, fname), "rb") as fd:
+                    assert fd.read() == expected, fname
+
+
+def test_check_models_rejects_unshared_fields(tmp_path):
+    write_jpegs(str(tmp_path), n_imgs=2, size=(32, 32))
+    cfg = config.Activations(data=config.ImageFolderDataset(str(tmp_path)))
+    with pytest.raises(ValueError, match="vit_batch_size"):
+        config.expand_models(cfg, [{"vit_batch_size": 2}])
+    with pytest.raises(ValueError, match="vit_batch_size"):
+        activations.check_models([cfg, dataclasses.replace(cfg, vit_batch_size=2)])
+    with pytest.raises(ValueError, match="same shards"):
+        activations.check_models([cfg, cfg])
+
+
+def test_multi_transform_min_img_size():
+    transform = activations.MultiTransform([
+        make_toy_img_transform("toy", "32"),
+        make_toy_img_transform("toy", "48"),
+    ])
+    assert activations.get_min_img_size(transform) == 48
+    a, b = transform(Image.new("RGB", (80, 60)))
+    assert a.shape == (3, 32, 32)
+    assert b.shape == (3, 48, 48)
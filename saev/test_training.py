@@ -1,4 +1,10 @@
-from . import config, training
+import tempfile
+
+import pytest
+import torch
+
+from . import activations, config, training
+from .test_activations import make_dataload, write_shards
 
 
 def test_split_cfgs_on_single_key():
@@ -85,3 +91,35 @@ def test_split_cfgs_no_bad_keys():
     actual = training.split_cfgs(cfgs)
 
     assert actual == expected
+
+
+def test_batch_limiter_with_batch_size_none():
+    class Stream(torch.utils.data.IterableDataset):
+        batch_size = 4
+
+        def __iter__(self):
+            while True:
+                yield torch.zeros(self.batch_size)
+
+    dataloader = torch.utils.data.DataLoader(Stream(), batch_size=None)
+    limiter = training.BatchLimiter(dataloader, 20)
+
+    assert len(limiter) == 5
+    assert 5 <= len(list(limiter)) <= 6
+
+
+@pytest.mark.parametrize(
+    "data_on_device,n_free,expected",
+    [
+        ("always", 0, True),
+        ("never", 2**40, False),
+        ("auto", 2**40, True),
+        ("auto", 1_000, False),
+    ],
+)
+def test_use_data_on_device(monkeypatch, data_on_device, n_free, expected):
+    monkeypatch.setattr(training, "get_free_memory", lambda device: n_free)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dataset = activations.Dataset(make_dataload(write_shards(tmpdir)))
+        cfg = config.Train(data_on_device=data_on_device, device="cpu")
+        assert training.use_data_on_device(cfg, dataset) == expected
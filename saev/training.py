@@ -183,9 +183,39 @@ def train(
         Warmup(0.0, c.sae.sparsity_coeff, c.n_sparsity_warmup) for c in cfgs
     ]
 
-    dataloader = torch.utils.data.DataLoader(
-        dataset, batch_size=cfg.sae_batch_size, num_workers=cfg.n_workers, shuffle=True
-    )
+    if use_data_on_device(cfg, dataset):
+        # Uniformly random batches are cheap in memory, so there's no need for a shuffle buffer.
+        dataloader = activations.InMemoryLoader(
+            dataset,
+            batch_size=cfg.sae_batch_size,
+            shuffle=True,
+            seed=cfg.seed,
+            device=cfg.device,
+        )
+    elif cfg.data.in_memory:
+        dataloader = activations.InMemoryLoader(
+            dataset, batch_size=cfg.sae_batch_size, shuffle=True, seed=cfg.seed
+        )
+    elif cfg.shuffle_buffer_size > 0:
+        stream = activations.StreamingDataset(
+            dataset,
+            batch_size=cfg.sae_batch_size,
+            buffer_size=cfg.shuffle_buffer_size,
+            n_examples_per_chunk=cfg.n_examples_per_chunk,
+            seed=cfg.seed,
+        )
+        dataloader = torch.utils.data.DataLoader(
+            stream, batch_size=None, num_workers=cfg.n_workers
+        )
+    else:
+        dataloader = torch.utils.data.DataLoader(
+            dataset,
+            batch_size=cfg.sae_batch_size,
+            num_workers=cfg.n_workers,
+            # Shuffled activations are read sequentially.
+            shuffle=not dataset.shuffled,
+            collate_fn=activations.collate,
+        )
 
     dataloader = BatchLimiter(dataloader, cfg.n_patches)
 
@@ -205,6 +235,9 @@ def train(
 
         with torch.no_grad():
             if (global_step + 1) % cfg.log_every == 0:
+                randomness = activations.get_randomness(
+                    batch["image_i"], dataset.metadata.n_imgs
+                )
                 metrics = [
                     {
                         "losses/mse": loss.mse.item(),
@@ -217,6 +250,7 @@ def train(
                         "progress/n_patches_seen": n_patches_seen,
                         "progress/learning_rate": group["lr"],
                         "progress/sparsity_coeff": sae.sparsity_coeff,
+                        "progress/batch_randomness": randomness,
                     }
                     for loss, sae, group in zip(losses, saes, optimizer.param_groups)
                 ]
@@ -254,6 +288,41 @@ def train(
     return saes, run, global_step
 
 
+@beartype.beartype
+def use_data_on_device(cfg: config.Train, dataset: activations.Dataset) -> bool:
+    """
+    Decide whether to keep every training example on `cfg.device`; see `config.Train.data_on_device`.
+    """
+    if cfg.data_on_device != "auto":
+        return cfg.data_on_device == "always"
+
+    # Activations plus image and patch indices; leave the other half of free memory for the SAEs and their optimizer state.
+    n_bytes = len(dataset) * (dataset.d_vit * 4 + 2 * 8)
+    n_free = get_free_memory(cfg.device)
+    fits = n_bytes < n_free / 2
+    logger.info(
+        "Training data takes %.1f GB and %s has %.1f GB free; %s.",
+        n_bytes / 1e9,
+        cfg.device,
+        n_free / 1e9,
+        "loading it onto the device" if fits else "reading it from disk",
+    )
+    return fits
+
+
+@beartype.beartype
+def get_free_memory(device: str) -> int:
+    """
+    Get the number of free bytes on `device`: free memory on a CUDA device and available RAM otherwise.
+    """
+    if torch.device(device).type == "cuda":
+        if not torch.cuda.is_available():
+            return 0
+        n_free, _ = torch.cuda.mem_get_info(torch.device(device))
+        return n_free
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
 @beartype.beartype
 @dataclasses.dataclass(frozen=True)
 class EvalMetrics:
@@ -315,8 +384,8 @@ def evaluate(cfgs: list[config.Train], saes: torch.nn.ModuleList) -> list[EvalMe
     dense_lim = 1e-2
 
     dataset = activations.Dataset(cfg.data)
-    dataloader = torch.utils.data.DataLoader(
-        dataset, batch_size=cfg.sae_batch_size, num_workers=cfg.n_workers, shuffle=False
+    dataloader = activations.get_sequential_loader(
+        dataset, batch_size=cfg.sae_batch_size, n_workers=cfg.n_workers
     )
 
     n_fired = torch.zeros((len(cfgs), saes[0].cfg.d_sae))
@@ -363,7 +432,8 @@ class BatchLimiter:
     def __init__(self, dataloader: torch.utils.data.DataLoader, n_samples: int):
         self.dataloader = dataloader
         self.n_samples = n_samples
-        self.batch_size = dataloader.batch_size
+        # Datasets that yield whole batches (like activations.StreamingDataset) are loaded with batch_size=None.
+        self.batch_size = dataloader.batch_size or dataloader.dataset.batch_size
 
     def __len__(self) -> int:
         return self.n_samples // self.batch_size
@@ -394,6 +464,9 @@ CANNOT_PARALLELIZE = set([
     "n_workers",
     "n_patches",
     "sae_batch_size",
+    "shuffle_buffer_size",
+    "n_examples_per_chunk",
+    "data_on_device",
     "track",
     "wandb_project",
     "tag",
@@ -187,12 +187,8 @@ def get_topk_img(cfg: config.Visuals) -> TopKImg:
         cfg.percentile, len(dataset), shape=(sae.cfg.d_sae,)
     )
 
-    dataloader = torch.utils.data.DataLoader(
-        dataset,
-        batch_size=cfg.topk_batch_size,
-        shuffle=False,
-        num_workers=cfg.n_workers,
-        drop_last=False,
+    dataloader = activations.get_sequential_loader(
+        dataset, batch_size=cfg.topk_batch_size, n_workers=cfg.n_workers
     )
 
     logger.info("Loaded SAE and data.")
@@ -268,6 +264,10 @@ def get_topk_patch(cfg: config.Visuals) -> TopKPatch:
 
     sae = nn.load(cfg.ckpt).to(cfg.device)
     dataset = activations.Dataset(cfg.data)
+    if dataset.shuffled:
+        raise ValueError(
+            "Visuals need every patch of an image in order; use the original (unshuffled) activations."
+        )
 
     top_values_p = torch.full(
         (sae.cfg.d_sae, cfg.top_k, dataset.metadata.n_patches_per_img),
@@ -293,11 +293,10 @@ def get_topk_patch(cfg: config.Visuals) -> TopKPatch:
     )
     n_imgs_per_batch = batch_size // dataset.metadata.n_patches_per_img
 
-    dataloader = torch.utils.data.DataLoader(
+    dataloader = activations.get_sequential_loader(
         dataset,
         batch_size=batch_size,
-        shuffle=False,
-        num_workers=cfg.n_workers,
+        n_workers=cfg.n_workers,
         # See if you can change this to false and still pass the beartype check.
         drop_last=True,
     )
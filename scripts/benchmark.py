@@ -0,0 +1,391 @@
+"""
+Microbenchmarks for reading activations from disk.
+
+Each benchmark writes synthetic shards to a temporary directory (or `--dump-to`) and reports examples/sec, so you can compare data-loading changes without a ViT or a real dataset.
+
+Run `uv run python scripts/benchmark.py --help` to see the available benchmarks.
+"""
+
+import dataclasses
+import logging
+import os
+import tempfile
+import time
+import typing
+
+import beartype
+import numpy as np
+import torch
+
+import saev.activations
+import saev.config
+
+log_format = "[%(asctime)s] [%(levelname)s] [%(name)s] %(message)s"
+logging.basicConfig(level=logging.INFO, format=log_format)
+logger = logging.getLogger("benchmark")
+
+
+@beartype.beartype
+@dataclasses.dataclass(frozen=True)
+class Shards:
+    """Shape of the synthetic shards to benchmark against."""
+
+    n_imgs: int = 4_096
+    """Number of fake images."""
+    n_layers: int = 2
+    """Number of recorded layers."""
+    n_patches_per_img: int = 196
+    """Number of patches per image (not including [CLS])."""
+    d_vit: int = 768
+    """ViT activation dimension."""
+    n_patches_per_shard: int = 200_000
+    """Number of activations per shard."""
+    dtype: typing.Literal["float32", "float16", "bfloat16", "int8"] = "float32"
+    """Which dtype to store activations as."""
+    layout: typing.Literal["img-major", "layer-major"] = "img-major"
+    """How to order each shard on disk."""
+    compression: typing.Literal["none", "zlib", "zstd"] = "none"
+    """How to compress shards."""
+    n_imgs_per_chunk: int = 4
+    """Number of images per compressed chunk."""
+    dump_to: str = ""
+    """Where to write the shards. If empty, use a temporary directory."""
+    seed: int = 42
+    """Random seed."""
+
+
+@beartype.beartype
+def write_shards(cfg: Shards, dpath: str) -> str:
+    """
+    Write random activations in the same layout as `saev.activations.ShardWriter`.
+
+    Returns:
+        The shard root with the .bin shards and a metadata.json file.
+    """
+    metadata = saev.activations.Metadata(
+        model_family="clip",
+        model_ckpt="synthetic",
+        layers=tuple(range(cfg.n_layers)),
+        n_patches_per_img=cfg.n_patches_per_img,
+        cls_token=True,
+        d_vit=cfg.d_vit,
+        seed=cfg.seed,
+        n_imgs=cfg.n_imgs,
+        n_patches_per_shard=cfg.n_patches_per_shard,
+        data="synthetic",
+        dtype=cfg.dtype,
+        layout=cfg.layout,
+        compression=cfg.compression,
+        n_imgs_per_chunk=cfg.n_imgs_per_chunk,
+        version=2,
+    )
+    shard_root = os.path.join(dpath, metadata.hash)
+    os.makedirs(shard_root, exist_ok=True)
+    metadata.dump(os.path.join(shard_root, "metadata.json"))
+
+    dtype = saev.activations.get_storage_dtype(cfg.dtype)
+    rng = np.random.default_rng(seed=cfg.seed)
+    shards = []
+    for shard in range(metadata.n_shards):
+        acts_fpath = os.path.join(shard_root, f"acts{shard:06}.bin")
+        raw_fpath = acts_fpath
+        if cfg.compression != "none":
+            raw_fpath = os.path.join(shard_root, f"acts{shard:06}.raw")
+
+        shape = metadata.get_shard_shape(shard)
+        acts = saev.activations.open_shard(
+            raw_fpath, mode="w+", dtype=dtype, shape=shape, layout=cfg.layout
+        )
+        acts_np = rng.standard_normal((*shape[:-1], cfg.d_vit), dtype=np.float32)
+        acts[:] = saev.activations.to_storage(torch.from_numpy(acts_np), cfg.dtype)
+        acts.flush()
+        del acts
+
+        chunk_offsets = ()
+        if cfg.compression != "none":
+            chunk_offsets = saev.activations.compress_shard(
+                raw_fpath, acts_fpath, metadata=metadata, shape=shape
+            )
+            os.remove(raw_fpath)
+
+        shards.append(
+            saev.activations.ShardInfo.from_shard(
+                shard_root, shard, metadata, chunk_offsets=chunk_offsets
+            )
+        )
+
+    saev.activations.dump_index(shard_root, metadata, shards)
+    logger.info("Wrote %d images to '%s'.", cfg.n_imgs, shard_root)
+    return shard_root
+
+
+@beartype.beartype
+def time_getitem(
+    dataset: saev.activations.Dataset, indices: np.ndarray, *, n_warmup: int = 1_000
+) -> float:
+    """
+    Returns:
+        Examples per second for `dataset[i]` over `indices`.
+    """
+    for i in indices[:n_warmup]:
+        dataset[i.item()]
+
+    start = time.perf_counter()
+    for i in indices:
+        dataset[i.item()]
+    return len(indices) / (time.perf_counter() - start)
+
+
+@beartype.beartype
+def shard_cache(shards: Shards, n_examples: int = 100_000):
+    """
+    Compare random-access example fetch with and without the per-process shard memmap cache.
+
+    Args:
+        shards: Synthetic shard shape.
+        n_examples: Number of random patches to fetch.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shard_root = write_shards(shards, shards.dump_to or tmpdir)
+
+        cfg = saev.config.DataLoad(
+            shard_root=shard_root,
+            patches="patches",
+            layer=shards.n_layers - 1,
+            scale_mean=False,
+            scale_norm=False,
+        )
+        dataset = saev.activations.Dataset(cfg)
+        indices = np.random.default_rng(seed=shards.seed).integers(
+            len(dataset), size=n_examples
+        )
+
+        for max_open_shards in (0, cfg.max_open_shards):
+            dataset = saev.activations.Dataset(
+                dataclasses.replace(cfg, max_open_shards=max_open_shards)
+            )
+            per_sec = time_getitem(dataset, indices)
+            logger.info(
+                "max_open_shards=%d: %.1f examples/sec", max_open_shards, per_sec
+            )
+
+
+@beartype.beartype
+def getitems(shards: Shards, batch_size: int = 16_384, n_batches: int = 8):
+    """
+    Compare building shuffled batches one `__getitem__` at a time (plus default collation) against the batched `__getitems__` path.
+
+    Args:
+        shards: Synthetic shard shape.
+        batch_size: Examples per batch.
+        n_batches: Number of batches to time.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shard_root = write_shards(shards, shards.dump_to or tmpdir)
+
+        cfg = saev.config.DataLoad(
+            shard_root=shard_root,
+            patches="patches",
+            layer=shards.n_layers - 1,
+            scale_mean=False,
+            scale_norm=False,
+        )
+        dataset = saev.activations.Dataset(cfg)
+        rng = np.random.default_rng(seed=shards.seed)
+        batches = [
+            rng.integers(len(dataset), size=batch_size).tolist()
+            for _ in range(n_batches)
+        ]
+
+        start = time.perf_counter()
+        for batch in batches:
+            torch.utils.data.default_collate([dataset[i] for i in batch])
+        per_sec = batch_size * n_batches / (time.perf_counter() - start)
+        logger.info("__getitem__: %.1f examples/sec", per_sec)
+
+        start = time.perf_counter()
+        for batch in batches:
+            dataset.__getitems__(batch)
+        per_sec = batch_size * n_batches / (time.perf_counter() - start)
+        logger.info("__getitems__: %.1f examples/sec", per_sec)
+
+
+@beartype.beartype
+def streaming(
+    shards: Shards,
+    batch_size: int = 16_384,
+    n_batches: int = 16,
+    buffer_size: int = 2**18,
+    n_examples_per_chunk: int = 16_384,
+):
+    """
+    Compare uniformly random batches against `saev.activations.StreamingDataset` in examples/sec and in batch randomness (see `saev.activations.get_randomness`).
+
+    Run it with shards bigger than your page cache (and `--shards.dump-to` on the disk you care about) to see the difference on real storage.
+
+    Args:
+        shards: Synthetic shard shape.
+        batch_size: Examples per batch.
+        n_batches: Number of batches to time.
+        buffer_size: Shuffle buffer size.
+        n_examples_per_chunk: Number of consecutive examples to read at once.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shard_root = write_shards(shards, shards.dump_to or tmpdir)
+
+        cfg = saev.config.DataLoad(
+            shard_root=shard_root,
+            patches="patches",
+            layer=shards.n_layers - 1,
+            scale_mean=False,
+            scale_norm=False,
+        )
+        dataset = saev.activations.Dataset(cfg)
+        stream = saev.activations.StreamingDataset(
+            dataset,
+            batch_size=batch_size,
+            buffer_size=buffer_size,
+            n_examples_per_chunk=n_examples_per_chunk,
+            seed=shards.seed,
+        )
+        dataloaders = {
+            "random": torch.utils.data.DataLoader(
+                dataset,
+                batch_size=batch_size,
+                shuffle=True,
+                collate_fn=saev.activations.collate,
+            ),
+            "streaming": torch.utils.data.DataLoader(stream, batch_size=None),
+        }
+
+        for name, dataloader in dataloaders.items():
+            randomness = []
+            start = time.perf_counter()
+            for _, batch in zip(range(n_batches), dataloader):
+                randomness.append(
+                    saev.activations.get_randomness(
+                        batch["image_i"], dataset.metadata.n_imgs
+                    )
+                )
+            per_sec = batch_size * n_batches / (time.perf_counter() - start)
+            logger.info(
+                "%s: %.1f examples/sec, randomness %.3f",
+                name,
+                per_sec,
+                np.mean(randomness),
+            )
+
+
+@beartype.beartype
+def compression(
+    shards: Shards,
+    batch_size: int = 4_096,
+    n_batches: int = 8,
+    n_examples_per_chunk: int = 16_384,
+):
+    """
+    Compare uncompressed (memmap) shards against zlib- and zstd-compressed shards of the same activations: bytes on disk, decoding throughput for uniformly random batches, and throughput for sequential chunks like `saev.activations.StreamingDataset` reads.
+
+    Random Gaussian activations compress much worse than real ViT activations, so run this with `--shards.dump-to` pointing at a copy of real shards' parent directory if you want realistic compression ratios; the synthetic shards only give decode speeds.
+
+    Args:
+        shards: Synthetic shard shape; `--shards.compression` is ignored.
+        batch_size: Examples per random batch.
+        n_batches: Number of random batches and sequential chunks to time.
+        n_examples_per_chunk: Number of consecutive examples per sequential chunk.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for codec in ("none", "zlib", "zstd"):
+            shard_root = write_shards(
+                dataclasses.replace(shards, compression=codec), shards.dump_to or tmpdir
+            )
+            n_bytes = sum(
+                os.path.getsize(os.path.join(shard_root, fname))
+                for fname in os.listdir(shard_root)
+                if fname.endswith(".bin")
+            )
+
+            cfg = saev.config.DataLoad(
+                shard_root=shard_root,
+                patches="patches",
+                layer=shards.n_layers - 1,
+                scale_mean=False,
+                scale_norm=False,
+            )
+            dataset = saev.activations.Dataset(cfg)
+            rng = np.random.default_rng(seed=shards.seed)
+            batches = [
+                rng.integers(len(dataset), size=batch_size).tolist()
+                for _ in range(n_batches)
+            ]
+            starts = rng.integers(len(dataset) - n_examples_per_chunk, size=n_batches)
+
+            start = time.perf_counter()
+            for batch in batches:
+                dataset.__getitems__(batch)
+            random_per_sec = batch_size * n_batches / (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for chunk_start in starts.tolist():
+                dataset.__getitems__(
+                    list(range(chunk_start, chunk_start + n_examples_per_chunk))
+                )
+            seq_per_sec = (
+                n_examples_per_chunk * n_batches / (time.perf_counter() - start)
+            )
+
+            logger.info(
+                "%s: %.1f MB on disk, %.1f random examples/sec, %.1f sequential examples/sec",
+                codec,
+                n_bytes / 1024**2,
+                random_per_sec,
+                seq_per_sec,
+            )
+
+
+@beartype.beartype
+def sequential(shards: Shards, batch_size: int = 16_384, n_workers: int = 4):
+    """
+    Compare reading every example in order with a DataLoader against `saev.activations.ShardReader`, which prefetches the next shard in a background thread with page-cache hints.
+
+    Run it with shards bigger than your page cache (and `--shards.dump-to` on the disk you care about) to see the difference on real storage.
+
+    Args:
+        shards: Synthetic shard shape.
+        batch_size: Examples per batch.
+        n_workers: DataLoader workers.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shard_root = write_shards(shards, shards.dump_to or tmpdir)
+
+        cfg = saev.config.DataLoad(
+            shard_root=shard_root,
+            patches="patches",
+            layer=shards.n_layers - 1,
+            scale_mean=False,
+            scale_norm=False,
+        )
+        for prefetch in (False, True):
+            dataset = saev.activations.Dataset(
+                dataclasses.replace(cfg, prefetch=prefetch)
+            )
+            loader = saev.activations.get_sequential_loader(
+                dataset, batch_size=batch_size, n_workers=n_workers
+            )
+            start = time.perf_counter()
+            for _ in loader:
+                pass
+            per_sec = len(dataset) / (time.perf_counter() - start)
+            logger.info("prefetch=%s: %.1f examples/sec", prefetch, per_sec)
+
+
+if __name__ == "__main__":
+    import tyro
+
+    tyro.extras.subcommand_cli_from_dict({
+        "shard-cache": shard_cache,
+        "getitems": getitems,
+        "streaming": streaming,
+        "compression": compression,
+        "sequential": sequential,
+    })
@@ -0,0 +1,125 @@
+"""
+Measure how much precision each activation storage dtype (see `saev.config.Activations.dtype`) loses on real activations.
+
+Reads a random sample of float32 activations, round-trips them through every storage dtype and reports the reconstruction error, along with how much each trained SAE's MSE drifts when it is fed the round-tripped activations instead of the originals. Use it to decide, per model family, whether smaller shards are acceptable before re-dumping activations.
+
+Run `uv run python scripts/quantization.py --help` to see the options.
+"""
+
+import dataclasses
+import logging
+import math
+
+import beartype
+import numpy as np
+import torch
+
+import saev.activations
+import saev.config
+import saev.nn
+
+log_format = "[%(asctime)s] [%(levelname)s] [%(name)s] %(message)s"
+logging.basicConfig(level=logging.INFO, format=log_format)
+logger = logging.getLogger("quantization")
+
+
+@beartype.beartype
+@torch.no_grad()
+def main(
+    data: saev.config.DataLoad,
+    ckpts: tuple[str, ...] = (),
+    dtypes: tuple[str, ...] = ("float16", "bfloat16", "int8"),
+    n_examples: int = 65_536,
+    batch_size: int = 4_096,
+    seed: int = 42,
+    device: str = "cpu",
+):
+    """
+    Args:
+        data: Float32 reference activations, normalized the same way as when the SAEs in `ckpts` were trained.
+        ckpts: SAE checkpoints to measure MSE drift for.
+        dtypes: Storage dtypes to compare against float32.
+        n_examples: Number of random activations to measure on.
+        batch_size: SAE batch size.
+        seed: Random seed for picking activations.
+        device: Device to run the SAEs on.
+    """
+    dataset = saev.activations.Dataset(data)
+    if dataset.metadata.dtype != "float32":
+        raise ValueError(
+            f"Reference activations in '{data.shard_root}' are stored as {dataset.metadata.dtype}, not float32."
+        )
+    raw = saev.activations.Dataset(
+        dataclasses.replace(data, clamp=math.inf, scale_mean=False, scale_norm=False)
+    )
+
+    rng = np.random.default_rng(seed=seed)
+    n_examples = min(n_examples, len(raw))
+    indices = np.sort(rng.choice(len(raw), size=n_examples, replace=False))
+    x_ND = raw.__getitems__(indices.tolist())["act"].numpy()
+
+    saes = {ckpt: saev.nn.load(ckpt, device=device).eval() for ckpt in ckpts}
+    mse_ref = {
+        ckpt: get_sae_mse(sae, dataset, x_ND, x_ND, batch_size, device)
+        for ckpt, sae in saes.items()
+    }
+
+    d_vit = dataset.d_vit
+    for dtype in dtypes:
+        stored = saev.activations.to_storage(torch.from_numpy(x_ND), dtype)
+        x_hat_ND = saev.activations.from_storage(stored, dtype)
+
+        n_bytes = saev.activations.get_row_size(dtype, d_vit) * stored.itemsize
+        err_ND = x_hat_ND - x_ND
+        rel_mse = (err_ND**2).sum() / (x_ND**2).sum()
+        cos_N = (x_hat_ND * x_ND).sum(axis=1) / (
+            np.linalg.norm(x_hat_ND, axis=1) * np.linalg.norm(x_ND, axis=1) + 1e-12
+        )
+        logger.info(
+            "%s: %.2fx smaller, relative MSE %.3g, max abs error %.3g, min cosine similarity %.6f",
+            dtype,
+            d_vit * 4 / n_bytes,
+            rel_mse,
+            np.abs(err_ND).max(),
+            cos_N.min(),
+        )
+
+        for ckpt, sae in saes.items():
+            mse = get_sae_mse(sae, dataset, x_hat_ND, x_ND, batch_size, device)
+            logger.info(
+                "%s: SAE '%s' MSE %.5g -> %.5g (%+.3f%%)",
+                dtype,
+                ckpt,
+                mse_ref[ckpt],
+                mse,
+                (mse / mse_ref[ckpt] - 1) * 100,
+            )
+
+
+@beartype.beartype
+@torch.no_grad()
+def get_sae_mse(
+    sae: saev.nn.SparseAutoencoder,
+    dataset: saev.activations.Dataset,
+    x_ND: np.ndarray,
+    target_ND: np.ndarray,
+    batch_size: int,
+    device: str,
+) -> float:
+    """
+    Mean squared error between the SAE's reconstruction of `x_ND` and `target_ND`, after normalizing both with `dataset.transform`.
+    """
+    sq_err, n = 0.0, 0
+    for start in range(0, len(x_ND), batch_size):
+        x_BD = dataset.transform(x_ND[start : start + batch_size]).to(device)
+        target_BD = dataset.transform(target_ND[start : start + batch_size]).to(device)
+        x_hat_BD, _, _ = sae(x_BD)
+        sq_err += ((x_hat_BD - target_BD) ** 2).mean(dim=1).sum().item()
+        n += len(x_BD)
+    return sq_err / n
+
+
+if __name__ == "__main__":
+    import tyro
+
+    tyro.cli(main)